@@ -0,0 +1,208 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+##
+#   Times exposures from the display updates that start and end them,
+#   rather than from a sleep after the image was asked for.
+#
+#   The projector gives the time pygame.display.update returned for its
+#   frame.  That is when the frame was handed to the display, not when it
+#   was scanned out: the screen is updated in part, so there is no vsync'd
+#   flip to take the time from.  The exposure deadline is counted from there
+#   on the monotonic clock, so image decode no longer shortens or stretches
+#   it.  The blank is stamped the same way, so the scan-out latency is
+#   common to both ends and drops out, leaving up to a refresh of jitter
+#   that is not measured.  The blank is asked for half a frame before the
+#   deadline to center that jitter on the deadline.  Every exposure is
+#   recorded with the time it was asked for and the time it got.
+#
+#   A run of "cont" layers is exposed as one streaming move of the lift,
+#   each slice going up as the lift reaches the step its layer starts at.
+##
+###############################################################################
+
+import threading
+
+import motion
+from motion import step_tracker
+
+# Refresh rate of the projector
+FRAME_RATE      = 60        # frames/s
+
+
+class exposure_scheduler:
+    ###########################################################################
+    ##
+    #   @param  display     projector that shows the exposures
+    #   @param  telemetry   span_log that records them as "exposure" spans
+    #   @param  frame_rate  Refresh rate of the projector
+    ##
+    ###########################################################################
+    def __init__(self, display, telemetry, frame_rate=FRAME_RATE):
+        self.display = display
+        self.telemetry = telemetry
+        self.half_frame = 0.5 / frame_rate
+
+        # Achieved minus requested seconds, of every finished exposure
+        self.errors = []
+
+    def clear(self):
+        del self.errors[:]
+
+    ###########################################################################
+    ##
+    #   Takes the time a frame was handed to the display.  Projectors that
+    #   cannot tell are taken to have shown it right away.
+    ##
+    ###########################################################################
+    def shown_time(self, shown_at):
+        if shown_at is None:
+            return motion.monotonic()
+        return shown_at
+
+    ###########################################################################
+    ##
+    #   Shows an image for a given time
+    #
+    #   @param  image_path  Path of the image, see projector.display
+    #   @param  duration    Seconds the image should be lit
+    #   @param  cancel      cancel_token that ends the exposure early, or None
+    #   @param  during      Function run once the image is up, e.g. the move
+    #                       of a "cont" layer, or None
+    #   @param  blank       False to leave the image up at the deadline, for
+    #                       the next image to replace
+    #   @return seconds of the exposure left when it was cancelled, else 0
+    ##
+    ###########################################################################
+    def expose(self, image_path, duration, cancel=None, during=None, blank=True):
+        lit_at = self.shown_time(self.display.display(image_path))
+        deadline = lit_at + duration
+
+        if during:
+            during()
+
+        if blank:
+            late = motion.wait_until(deadline - self.half_frame, cancel)
+        else:
+            late = motion.wait_until(deadline, cancel)
+
+        if late < 0 or (cancel and cancel.cancelled):
+            now = motion.monotonic()
+            self.telemetry.record("exposure", lit_at, now - lit_at, duration, image_path)
+            return max(deadline - now, 0.0)
+
+        if blank:
+            dark_at = self.shown_time(self.display.black())
+        else:
+            dark_at = motion.monotonic()
+
+        self.telemetry.record("exposure", lit_at, dark_at - lit_at, duration, image_path)
+        self.errors.append(dark_at - lit_at - duration)
+        return 0.0
+
+    ###########################################################################
+    ##
+    #   Exposes a run of layers while the lift moves through them without
+    #   stopping.  The move runs on a thread of its own and each image
+    #   replaces the last when the lift reaches the step its layer starts
+    #   at, so an exposure lasts as long as its layer's share of the move.
+    #   The last image is left up, for the next one to replace.
+    #
+    #   @param  lift        BED_servo, or stepper_process, to stream
+    #   @param  layers      List of (image path, microns to move, seconds)
+    #                       for each layer
+    #   @param  cancel      cancel_token of the lift, set when the exposure
+    #                       fails so the move does not carry on, or None
+    #   @param  started     Function called with the index in layers of
+    #                       each layer after the first, once its image is
+    #                       up, or None
+    #   @return number of layers finished, all of them unless the move was
+    #           cancelled
+    ##
+    ###########################################################################
+    def expose_stream(self, lift, layers, cancel=None, started=None):
+        stretches = [(thickness, float(thickness) / duration) for image_path, thickness, duration in layers]
+
+        # Step count at which each layer after the first starts
+        marks = []
+        travel = 0.0
+        for image_path, thickness, duration in layers[:-1]:
+            travel += thickness
+            marks.append(int(round(travel / lift.microns_per_step)))
+        if any(mark <= last for last, mark in zip([0] + marks, marks)):
+            raise ValueError("Layers of less than a step cannot be streamed")
+
+        tracker = step_tracker(marks)
+        mover = threading.Thread(target=lift.stream, args=(stretches, tracker), name="lift")
+        mover.daemon = True
+
+        lit_at = self.shown_time(self.display.display(layers[0][0]))
+        mover.start()
+
+        finished = 0
+        try:
+            for i in xrange(1, len(layers)):
+                if tracker.wait(i - 1) is None:
+                    break
+
+                shown_at = self.shown_time(self.display.display(layers[i][0]))
+                self.record_moving(layers[i - 1], lit_at, shown_at)
+                lit_at = shown_at
+                finished = i
+
+                if started:
+                    started(i)
+        except:
+            # Only one move may drive the lift at a time
+            if cancel:
+                cancel.cancel("stopped")
+            raise
+        finally:
+            mover.join()
+
+        # The last image is done once the move is, if the move got there
+        image_path, thickness, duration = layers[finished]
+        now = motion.monotonic()
+        if finished < len(layers) - 1 or (cancel and cancel.cancelled):
+            self.telemetry.record("exposure", lit_at, now - lit_at, duration, image_path)
+            return finished
+
+        self.record_moving(layers[finished], lit_at, now)
+        return len(layers)
+
+    ###########################################################################
+    ##
+    #   Records the finished exposure of a layer of expose_stream
+    ##
+    ###########################################################################
+    def record_moving(self, layer, lit_at, dark_at):
+        image_path, thickness, duration = layer
+        self.telemetry.record("exposure", lit_at, dark_at - lit_at, duration, image_path)
+        self.errors.append(dark_at - lit_at - duration)
+
+    ###########################################################################
+    ##
+    #   Sums up how far the exposures were from the times asked for
+    ##
+    ###########################################################################
+    def summary(self):
+        if not self.errors:
+            return "No exposures finished"
+
+        mean = sum(self.errors) / len(self.errors)
+        worst = max(self.errors, key=abs)
+        return "{:d} exposures, {:+.1f} ms from the requested time on average, {:+.1f} ms at worst".format(
+            len(self.errors), mean * 1000.0, worst * 1000.0)
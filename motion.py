@@ -0,0 +1,592 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time, threading
+from array import array
+from bisect import bisect_right
+
+# Waits longer than this are slept off, the rest is spun for accuracy
+SPIN_THRESHOLD          = 0.0005    # seconds
+
+# The Big Easy Driver needs the step pin held high, and then low, for at
+# least a microsecond each.  Twice that leaves a margin.
+MIN_PULSE_WIDTH         = 0.000002  # seconds
+
+# Fastest stepping that keeps the pin high and low for MIN_PULSE_WIDTH
+MAX_STEP_RATE           = int(1 / (2 * MIN_PULSE_WIDTH))    # steps/s
+
+# Cancellable waits check their token this often
+CANCEL_POLL_INTERVAL    = 0.01      # seconds
+
+# Upper bounds of the pulse lateness histogram of jitter_stats
+JITTER_BUCKETS          = [0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005]  # seconds
+
+# Pulses later than this are counted as late, a risk of missed steps
+LATE_PULSE              = 0.001     # seconds
+
+
+###############################################################################
+##
+#   Builds a monotonic clock.  Python 2 has no time.monotonic, so the POSIX
+#   CLOCK_MONOTONIC is read through ctypes when it is available.
+#
+#   @return function returning seconds from an arbitrary fixed point
+##
+###############################################################################
+def _monotonic_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    try:
+        import ctypes, ctypes.util, os
+
+        CLOCK_MONOTONIC = 1
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        ts = timespec()
+        ts_ref = ctypes.byref(ts)
+
+        def monotonic():
+            if clock_gettime(CLOCK_MONOTONIC, ts_ref) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except Exception:
+        return time.time
+
+monotonic = _monotonic_clock()
+
+
+###############################################################################
+##
+#   Waits until a monotonic deadline.  The bulk of the wait is slept so other
+#   processes get the CPU, and only the last SPIN_THRESHOLD is busy-waited.
+#
+#   @param  deadline    Time, from monotonic(), to return at
+#   @param  cancel      cancel_token that ends the wait early, or None
+#   @return lateness    Seconds past the deadline when the wait ended,
+#                       negative when it was cancelled
+##
+###############################################################################
+def wait_until(deadline, cancel=None):
+    now = monotonic()
+    remaining = deadline - now
+
+    if cancel:
+        while remaining > CANCEL_POLL_INTERVAL:
+            if cancel.cancelled:
+                return now - deadline
+            time.sleep(CANCEL_POLL_INTERVAL)
+            now = monotonic()
+            remaining = deadline - now
+        if cancel.cancelled:
+            return now - deadline
+
+    if remaining > SPIN_THRESHOLD:
+        time.sleep(remaining - SPIN_THRESHOLD)
+        now = monotonic()
+
+    while now < deadline:
+        now = monotonic()
+
+    return now - deadline
+
+
+###############################################################################
+##
+#   Sleeps on the same clock as wait_until
+#
+#   @param  duration    Seconds to sleep
+##
+###############################################################################
+def sleep(duration):
+    wait_until(monotonic() + duration)
+
+
+###############################################################################
+##
+#   Runs monotonic, wait_until and everything built on them on another
+#   clock, e.g. the simulator's virtual clock.  Modules that imported the
+#   functions by name keep the real clock.
+#
+#   @param  now     Function returning the time in seconds
+#   @param  wait    Function standing in for wait_until
+##
+###############################################################################
+def use_clock(now, wait):
+    global monotonic, wait_until
+
+    monotonic = now
+    wait_until = wait
+
+
+###############################################################################
+##
+#   Tells long waits and moves to stop early, for Abort and Pause.  It is
+#   set from another thread and only read by the waits, so a plain attribute
+#   is enough and costs one lookup per step pulse.
+##
+###############################################################################
+class cancel_token:
+    def __init__(self):
+        self.cancelled = False
+        self.reason = None
+
+    def cancel(self, reason=None):
+        self.reason = reason
+        self.cancelled = True
+
+    def clear(self):
+        self.cancelled = False
+        self.reason = None
+
+    ###########################################################################
+    ##
+    #   Sleeps unless cancelled
+    #
+    #   @param  duration    Seconds to sleep
+    #   @return seconds of the sleep left when it was cancelled, 0 otherwise
+    ##
+    ###########################################################################
+    def sleep(self, duration):
+        late = wait_until(monotonic() + duration, self)
+        return max(-late, 0.0)
+
+
+###############################################################################
+##
+#   Lets other threads follow a move running in the background.  The move
+#   tells the tracker each time it reaches one of the marks, a step count
+#   from its start, and waiters are woken at that pulse.  The move only
+#   compares one integer per pulse.
+##
+###############################################################################
+class step_tracker:
+    ###########################################################################
+    ##
+    #   @param  marks   Step counts to report, in increasing order
+    ##
+    ###########################################################################
+    def __init__(self, marks):
+        self.marks = marks
+        self.cond = threading.Condition()
+        self.finished = False
+
+        # monotonic() time each mark was reached, in order
+        self.reached_at = []
+
+    ###########################################################################
+    ##
+    #   @return the first mark, or -1 if there are none
+    ##
+    ###########################################################################
+    def first_mark(self):
+        if self.marks:
+            return self.marks[0]
+        return -1
+
+    ###########################################################################
+    ##
+    #   Called by the move as it reaches a mark
+    #
+    #   @param  at      monotonic() time the mark was reached, None for now
+    #   @return the next mark, or -1 if there are no more
+    ##
+    ###########################################################################
+    def reached(self, at=None):
+        if at is None:
+            at = monotonic()
+
+        with self.cond:
+            self.reached_at.append(at)
+            self.cond.notify_all()
+            count = len(self.reached_at)
+
+        if count < len(self.marks):
+            return self.marks[count]
+        return -1
+
+    ###########################################################################
+    ##
+    #   Called by the move when it ends, whether or not every mark was reached
+    ##
+    ###########################################################################
+    def finish(self):
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+    ###########################################################################
+    ##
+    #   Waits for the move to reach a mark
+    #
+    #   @param  index   Index of the mark in marks
+    #   @return monotonic() time the mark was reached, or None if the move
+    #           ended first
+    ##
+    ###########################################################################
+    def wait(self, index):
+        with self.cond:
+            while len(self.reached_at) <= index and not self.finished:
+                self.cond.wait()
+            if len(self.reached_at) > index:
+                return self.reached_at[index]
+            return None
+
+
+###############################################################################
+##
+#   Builds the table of step pulse times for a move at a constant rate
+#
+#   @param  steps   Number of steps in the move, always positive
+#   @param  speed   Step rate in steps per second
+#   @return array of pulse times in seconds, relative to the start of the
+#           move.  The extra last entry is the time the move ends.
+##
+###############################################################################
+def constant_rate_profile(steps, speed):
+    period = 1.0 / speed
+    return array('d', (i * period for i in xrange(steps + 1)))
+
+
+###############################################################################
+##
+#   Builds the table for a pause in a sequence of moves
+#
+#   @param  duration    Length of the pause in seconds
+#   @return array with no pulses, only the end time
+##
+###############################################################################
+def hold_profile(duration):
+    return array('d', [duration])
+
+
+###############################################################################
+##
+#   Describes the ramp from standstill up to a peak speed.  Without a jerk
+#   limit the ramp is a constant acceleration (trapezoidal profile).  With a
+#   jerk limit the acceleration itself ramps up and down (S-curve profile).
+#
+#   @param  peak    Speed at the end of the ramp in steps per second
+#   @param  accel   Acceleration limit in steps per second^2
+#   @param  jerk    Jerk limit in steps per second^3, or None
+#   @return tuple of (jerk phase time, constant acceleration time, peak
+#           acceleration), with the jerk phase time 0 for a trapezoid
+##
+###############################################################################
+def _ramp_shape(peak, accel, jerk):
+    if not jerk:
+        return 0.0, peak / accel, accel
+
+    if peak <= accel * accel / jerk:
+        jerk_time = (peak / jerk) ** 0.5
+        return jerk_time, 0.0, jerk * jerk_time
+
+    return accel / jerk, peak / accel - accel / jerk, accel
+
+
+###############################################################################
+##
+#   Duration and length of the ramp from standstill up to a peak speed
+#
+#   @return tuple of (seconds, steps)
+##
+###############################################################################
+def _ramp_length(peak, accel, jerk):
+    jerk_time, accel_time, peak_accel = _ramp_shape(peak, accel, jerk)
+    duration = 2 * jerk_time + accel_time
+
+    # Both trapezoid and S-curve ramps are symmetric about their midpoint
+    return duration, peak * duration / 2.0
+
+
+###############################################################################
+##
+#   Position and speed a given time into the ramp
+#
+#   @return tuple of (steps, steps per second)
+##
+###############################################################################
+def _ramp_state(t, shape, jerk):
+    jerk_time, accel_time, peak_accel = shape
+
+    if not jerk:
+        return peak_accel * t * t / 2.0, peak_accel * t
+
+    if t < jerk_time:
+        return jerk * t ** 3 / 6.0, jerk * t * t / 2.0
+
+    s1 = jerk * jerk_time ** 3 / 6.0
+    v1 = jerk * jerk_time ** 2 / 2.0
+    tau = min(t - jerk_time, accel_time)
+    s2 = s1 + v1 * tau + peak_accel * tau * tau / 2.0
+    v2 = v1 + peak_accel * tau
+    if t < jerk_time + accel_time:
+        return s2, v2
+
+    tau = t - jerk_time - accel_time
+    return (s2 + v2 * tau + peak_accel * tau * tau / 2.0 - jerk * tau ** 3 / 6.0,
+            v2 + peak_accel * tau - jerk * tau * tau / 2.0)
+
+
+###############################################################################
+##
+#   Times at which the ramp reaches each whole step, found by Newton's method
+#   kept inside a bisection bracket
+#
+#   @param  steps       Number of whole steps in the ramp, the first at t=0
+#   @param  shape       Ramp shape from _ramp_shape
+#   @param  jerk        Jerk limit in steps per second^3, or None
+#   @param  duration    Duration of the ramp in seconds
+#   @return list of step times in seconds
+##
+###############################################################################
+def _ramp_times(steps, shape, jerk, duration):
+    times = [0.0]
+    t = 0.0
+
+    for n in xrange(1, steps):
+        low = t
+        high = duration
+        t = min(t + (high - t) / 2.0, high)
+        for _ in xrange(50):
+            position, speed = _ramp_state(t, shape, jerk)
+            error = position - n
+            if abs(error) < 1e-6:
+                break
+            if error > 0:
+                high = t
+            else:
+                low = t
+            if speed > 0:
+                t = t - error / speed
+            if not (low < t < high):
+                t = (low + high) / 2.0
+        times.append(t)
+
+    return times
+
+
+###############################################################################
+##
+#   Builds the table of step pulse times for a move that accelerates from a
+#   standstill, cruises, and decelerates back to a standstill.  Moves that
+#   are too short to reach the cruise speed peak at a lower speed.
+#
+#   @param  steps   Number of steps in the move, always positive
+#   @param  speed   Cruise step rate in steps per second
+#   @param  accel   Acceleration limit in steps per second^2.  None gives a
+#                   constant rate move.
+#   @param  jerk    Jerk limit in steps per second^3.  None gives a
+#                   trapezoidal profile, otherwise an S-curve.
+#   @return array of pulse times in seconds, relative to the start of the
+#           move.  The extra last entry is the time the move ends.
+##
+###############################################################################
+def accelerated_profile(steps, speed, accel=None, jerk=None):
+    if not accel or steps == 0:
+        return constant_rate_profile(steps, speed)
+
+    peak = float(speed)
+    accel = float(accel)
+    if jerk:
+        jerk = float(jerk)
+    ramp_time, ramp_steps = _ramp_length(peak, accel, jerk)
+
+    # Find the highest peak speed that fits both ramps in the move
+    if 2 * ramp_steps > steps:
+        low = 0.0
+        high = peak
+        for _ in xrange(60):
+            peak = (low + high) / 2.0
+            if 2 * _ramp_length(peak, accel, jerk)[1] > steps:
+                high = peak
+            else:
+                low = peak
+        peak = low
+        ramp_time, ramp_steps = _ramp_length(peak, accel, jerk)
+
+    shape = _ramp_shape(peak, accel, jerk)
+    ramp = _ramp_times(int(ramp_steps) + 1, shape, jerk, ramp_time)
+
+    cruise_time = (steps - 2 * ramp_steps) / peak
+    total = 2 * ramp_time + cruise_time
+
+    profile = array('d', ramp[:min(len(ramp), steps + 1)])
+    for n in xrange(len(profile), steps + 1):
+        if steps - n < len(ramp):
+            profile.append(total - ramp[steps - n])
+        else:
+            profile.append(ramp_time + (n - ramp_steps) / peak)
+
+    return profile
+
+
+###############################################################################
+##
+#   Builds the table of step pulse times to bring a move to a standstill at a
+#   constant deceleration, used when a move is cancelled part way
+#
+#   @param  speed   Current step rate in steps per second
+#   @param  accel   Deceleration in steps per second^2
+#   @return array of pulse times in seconds, relative to the last pulse
+#           of the cancelled move.  The extra last entry is the time the
+#           lift comes to rest.
+##
+###############################################################################
+def stopping_profile(speed, accel):
+    speed = float(speed)
+    accel = float(accel)
+    steps = int(speed * speed / (2 * accel))
+
+    profile = array('d')
+    for n in xrange(1, steps + 1):
+        profile.append((speed - max(speed * speed - 2 * accel * n, 0.0) ** 0.5) / accel)
+    profile.append(speed / accel)
+
+    return profile
+
+
+###############################################################################
+##
+#   Summarizes how closely a move followed its pulse table
+#
+#   @param  steps       Steps requested
+#   @param  done        Steps actually pulsed
+#   @param  planned     Planned duration of the move in seconds
+#   @param  elapsed     Measured duration of the move in seconds
+#   @param  max_late    Worst lateness of a single pulse in seconds
+#   @param  cancelled   True when the move was stopped before its end
+#   @return dictionary of the move statistics
+##
+###############################################################################
+def move_report(steps, done, planned, elapsed, max_late, cancelled=False):
+    if planned > 0:
+        requested_rate = steps / planned
+    else:
+        requested_rate = 0.0
+
+    if elapsed > 0:
+        achieved_rate = done / elapsed
+    else:
+        achieved_rate = 0.0
+
+    return {'steps': steps,
+            'done': done,
+            'planned': planned,
+            'elapsed': elapsed,
+            'requested_rate': requested_rate,
+            'achieved_rate': achieved_rate,
+            'max_late': max_late,
+            'cancelled': cancelled}
+
+
+###############################################################################
+##
+#   Formats a move report for the console or the status page
+#
+#   @param  report  Dictionary from move_report
+#   @return string with the achieved and requested step rates
+##
+###############################################################################
+def format_move_report(report):
+    text = "Moved {:d} of {:d} steps at {:.0f} of {:.0f} steps/s ({:.2f}s, worst pulse {:.1f}ms late)".format(
+        report['done'], report['steps'], report['achieved_rate'], report['requested_rate'],
+        report['elapsed'], report['max_late'] * 1000.0)
+    if report['cancelled']:
+        text += ", stopped early"
+    return text
+
+
+###############################################################################
+##
+#   Counts how late step pulses went out, in a histogram of JITTER_BUCKETS.
+#   Plain numbers only, so the stats of a move can be sent between processes
+#   and merged.
+##
+###############################################################################
+class jitter_stats:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.late = 0
+        self.buckets = [0] * (len(JITTER_BUCKETS) + 1)
+
+    ###########################################################################
+    ##
+    #   Counts one pulse
+    #
+    #   @param  late    Seconds past its time the pulse went out
+    ##
+    ###########################################################################
+    def add(self, late):
+        self.count += 1
+        self.total += late
+        if late > self.worst:
+            self.worst = late
+        if late > LATE_PULSE:
+            self.late += 1
+        self.buckets[bisect_right(JITTER_BUCKETS, late)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.worst = max(self.worst, other.worst)
+        self.late += other.late
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    ###########################################################################
+    ##
+    #   Returns the lateness below which a fraction of the pulses went out,
+    #   to the resolution of the histogram
+    #
+    #   @param  fraction    e.g. 0.99
+    #   @return upper bound of the bucket, or the worst lateness for the last
+    ##
+    ###########################################################################
+    def percentile(self, fraction):
+        needed = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= needed and bucket < len(JITTER_BUCKETS):
+                return JITTER_BUCKETS[bucket]
+        return self.worst
+
+    ###########################################################################
+    ##
+    #   Formats the stats for the console or the status page
+    ##
+    ###########################################################################
+    def summary(self):
+        if not self.count:
+            return "No step pulses timed"
+
+        return "{:d} step pulses, {:.1f} us late on average, 99% within {:.0f} us, worst {:.1f} ms, {:d} over {:.0f} ms".format(
+            self.count, 1e6 * self.total / self.count, 1e6 * self.percentile(0.99), 1000.0 * self.worst,
+            self.late, 1000.0 * LATE_PULSE)
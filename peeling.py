@@ -0,0 +1,217 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+##
+#   Chooses how to peel each layer from the size of its cross-section.
+#
+#   The pull of the vat on a cured layer grows with the area of its largest
+#   connected island, and the resin takes longer to flow back under a large
+#   layer.  Every slice is measured once, when the job is indexed (see
+#   sliceindex.py).  The policy then turns the scheduled full dips into
+#   continuous moves or short fast dips where the layer is small, and scales
+#   the settle time with the lit area.
+#   The choices are written into the schedule as per layer overrides, so the
+#   print loop and the ETA plan both follow them.
+##
+###############################################################################
+
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Layers no larger than these, in pixels, are exposed while moving up
+CONT_MAX_ISLAND         = 400
+CONT_MAX_AREA           = 2000
+
+# Layers whose largest island is no larger than this get a short fast dip
+SHORT_DIP_MAX_ISLAND    = 20000
+SHORT_DIP_DISTANCE      = 1000      # microns
+SHORT_DIP_SPEED         = 2000      # microns/s
+
+# Lit area, in pixels, that needs the whole settle time
+SETTLE_FULL_AREA        = 150000
+MIN_SETTLE_FRACTION     = 0.25
+SETTLE_RESOLUTION       = 0.1       # seconds
+
+###############################################################################
+##
+#   Size of a layer's cross-section
+#
+#   area        Lit pixels in the layer
+#   island      Lit pixels in the largest connected island
+##
+###############################################################################
+layer_stats = namedtuple('layer_stats', 'area island')
+
+
+###############################################################################
+##
+#   Finds the lit runs of each row of a mask
+#
+#   @param  lit     2D numpy array of booleans
+#   @return list per row of [(start, end)], end exclusive
+##
+###############################################################################
+def row_runs(lit):
+    height, width = lit.shape
+    padded = numpy.zeros((height, width + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = lit
+
+    edges = numpy.diff(padded, axis=1)
+    start_rows, starts = numpy.nonzero(edges == 1)
+    end_rows, ends = numpy.nonzero(edges == -1)
+
+    runs = [[] for row in xrange(height)]
+    for row, start, end in zip(start_rows.tolist(), starts.tolist(), ends.tolist()):
+        runs[row].append((start, end))
+    return runs
+
+
+###############################################################################
+##
+#   Measures the lit area of an image and the area of its largest island of
+#   8-connected lit pixels.  Runs of lit pixels are joined to the touching
+#   runs of the row above with a union-find, so the work follows the number
+#   of runs rather than the number of pixels.
+#
+#   @param  image   PIL image, any nonzero pixel is lit
+#   @return layer_stats
+##
+###############################################################################
+def measure_image(image):
+    image = image.convert('L')
+
+    if numpy is None:
+        area = image.point(lambda value: value and 255).histogram()[255]
+
+        # Without numpy, the whole layer counts as one island
+        return layer_stats(area, area)
+
+    lit = numpy.asarray(image) > 0
+    area = int(lit.sum())
+    if area == 0:
+        return layer_stats(0, 0)
+
+    parent = []
+    sizes = []
+
+    def find(run):
+        while parent[run] != run:
+            parent[run] = parent[parent[run]]
+            run = parent[run]
+        return run
+
+    above = []
+    for runs in row_runs(lit):
+        row = []
+        j = 0
+        for start, end in runs:
+            run = len(parent)
+            parent.append(run)
+            sizes.append(end - start)
+            row.append((start, end, run))
+
+            # Skip runs above that end left of this one, diagonals included
+            while j < len(above) and above[j][1] < start:
+                j += 1
+
+            k = j
+            while k < len(above) and above[k][0] <= end:
+                root, other = find(run), find(above[k][2])
+                if root != other:
+                    parent[other] = root
+                    sizes[root] += sizes[other]
+                k += 1
+        above = row
+
+    island = max(sizes[run] for run in xrange(len(parent)) if parent[run] == run)
+    return layer_stats(area, island)
+
+
+class peel_policy:
+    ###########################################################################
+    ##
+    #   @param  settle          Settle time of a full dip, in seconds
+    #   @param  first_layers    Number of bottom layers, which hold the part
+    #                           to the plate and are never adapted
+    ##
+    ###########################################################################
+    def __init__(self, settle, first_layers=0):
+        self.settle = settle
+        self.first_layers = first_layers
+
+    ###########################################################################
+    ##
+    #   Chooses how to peel a layer
+    #
+    #   @param  stats   layer_stats of the layer
+    #   @return dictionary of schedule overrides for the layer
+    ##
+    ###########################################################################
+    def choose(self, stats):
+        if stats.island <= CONT_MAX_ISLAND and stats.area <= CONT_MAX_AREA:
+            return {"method": "cont"}
+
+        fraction = min(1.0, max(MIN_SETTLE_FRACTION, float(stats.area) / SETTLE_FULL_AREA))
+        settle = round(self.settle * fraction / SETTLE_RESOLUTION) * SETTLE_RESOLUTION
+
+        if stats.island <= SHORT_DIP_MAX_ISLAND:
+            return {"method": "dip", "dip_distance": SHORT_DIP_DISTANCE, "dip_speed": SHORT_DIP_SPEED, "settle": settle}
+
+        return {"settle": settle}
+
+    ###########################################################################
+    ##
+    #   Applies the policy to the full dips of a schedule.  The first
+    #   layers, slow dips, continuous layers, and layers the job overrides
+    #   itself are kept as they are.
+    #
+    #   @param  schedule    schedule.slice_schedule of the print
+    #   @param  stats       List of layer_stats, see sliceindex.slice_index
+    #   @return dictionary of method to the number of layers given it
+    ##
+    ###########################################################################
+    def adapt(self, schedule, stats):
+        counts = {}
+
+        for layer, layer_stats in enumerate(stats):
+            if layer < self.first_layers:
+                continue
+            if layer in schedule.overrides or schedule[layer].method != "dip":
+                continue
+
+            fields = self.choose(layer_stats)
+            schedule.set_override(layer, **fields)
+
+            if fields.get("dip_distance") == SHORT_DIP_DISTANCE:
+                method = "short dip"
+            else:
+                method = schedule[layer].method
+            counts[method] = counts.get(method, 0) + 1
+
+        return counts
+
+
+###############################################################################
+##
+#   Formats the counts from peel_policy.adapt for the console and the status
+##
+###############################################################################
+def format_counts(counts):
+    return ", ".join("{:d} {:s}".format(counts[method], method) for method in sorted(counts)) or "no dips adapted"
@@ -13,15 +13,40 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, sys, re, time, traceback
-
-from servo import BED_servo
-from projector import projector
+import os, sys, time, traceback
+
+# Runs the job on simulated hardware and a virtual clock, see simulator.py
+SIMULATE = "simulate" in sys.argv[1:]
+
+# Only plans the print and shows how long it will take
+ESTIMATE = "estimate" in sys.argv[1:]
+
+if SIMULATE or ESTIMATE:
+	from simulator import BED_servo, projector
+	import simulator
+	simulator.install()
+else:
+	from servo import BED_servo
+	from stepper import stepper_process
+	from projector import projector
+
+import motion
+from slicepack import open_slices, ARCHIVE_EXTENSION
+from motion import format_move_report, cancel_token
+from telemetry import span_log, PEEL_SEGMENTS, TELEMETRY_FILE
+from eta import estimator, plan_print
+from exposure import exposure_scheduler
+from schedule import load_schedule, save_schedule, schedule_path, ADAPTED_NAME
+from peeling import peel_policy, format_counts
+from sliceindex import get_index
 
 usageStr = """
-Usage:      sudo python pidish.py object_dir
+Usage:      sudo python pidish.py object_dir [calibrate|supercali] [simulate|estimate]
 
-	object_dir  Directory path with slice images
+	object_dir  Directory path with slice images, or a slice archive
+	simulate    Run without the printer, on a virtual clock, and write
+	            the timeline of moves and frames to timeline.csv
+	estimate    Only show how long the print is planned to take
 
 Ensure the lift is in the home position (the top) before running.
 
@@ -29,10 +54,13 @@ Ensure the lift is in the home position (the top) before running.
 
 OBJECT_PATH = None
 GCODE_FILE = None
-SLICE_PREFIX = None
+SLICES = None
+INDEX = None
 CALIBRATE = False
 SUPERCALI = False
 NUM_SLICES = 0
+TELEMETRY = span_log()
+ETA = None
 
 SERVO_ENABLE    = 40
 SERVO_MS1       = 38
@@ -48,6 +76,17 @@ Z_DISTANCE_PER_STEP     = 0.439453125 # microns
 LIFT_LENGTH             = 103000    # microns
 OPTIMUM_LIFT_SPEED      = 5280      # microns/s
 
+# Motion profile for the long lift moves (homing, approaching the resin)
+CRUISE_LIFT_SPEED       = 8000      # microns/s
+LIFT_ACCELERATION       = 20000     # microns/s^2
+LIFT_JERK               = 200000    # microns/s^3, None for trapezoidal
+
+# Step pulses come from a process of their own, see stepper.py
+STEPPER_PROCESS         = True
+STEPPER_CPU             = 3         # CPU to pin it to, best kept free with isolcpus=3
+STEPPER_PRIORITY        = 50        # SCHED_FIFO priority once pinned, None for the normal scheduler
+STEPPER_LOCK_MEMORY     = True
+
 # Resin vat maintenance
 RESIN_TOP               = 25400     # microns
 LIFT_PLATE_THICKNESS    = 5000      # microns
@@ -62,9 +101,13 @@ RESIN_SETTLE            = 8.0       # seconds
 SLOW_DIP_SPEED          = 20        # microns/s
 SLOW_DIP_DIST           = 1000      # microns
 
+# Peel small layers lighter, see peeling.py
+ADAPTIVE_PEEL           = True
+
 # Exposure controls
 SLICE_DISPLAY_TIME      = 18.0      # seconds
 SLICE_THICKNESS         = 100       # microns
+PREFETCH_DEPTH          = 1         # slices prepared ahead of the exposing one
 
 FIRST_SLICE_TIME        = 55.0      # seconds
 FIRST_SLICE_NUM         = 3
@@ -88,6 +131,19 @@ SUPERCALI_BASE_HEIGHT   = 0000      # microns
 SUPERCALI_POST_HEIGHT   = 5000      # microns
 
 
+###############################################################################
+##
+#   Opens the lift, in the stepper process when printing for real
+#
+#   @return BED_servo, or stepper_process standing in for it
+##
+###############################################################################
+def open_lift():
+	if STEPPER_PROCESS and not (SIMULATE or ESTIMATE):
+		return stepper_process(Z_DISTANCE_PER_STEP, STEPPER_CPU, STEPPER_PRIORITY, STEPPER_LOCK_MEMORY)
+	return BED_servo(Z_DISTANCE_PER_STEP)
+
+
 ###############################################################################
 ##
 #   Sets up the printer to have the lift below the resin top without bubbles
@@ -101,13 +157,17 @@ def setup_resin(display, lift):
 	display.black()
 
 	# Quickly move to resin
-	lift.move_to(RESIN_TOP-LIFT_PLATE_THICKNESS, OPTIMUM_LIFT_SPEED)
+	print(format_move_report(lift.move_to(RESIN_TOP-LIFT_PLATE_THICKNESS, CRUISE_LIFT_SPEED, LIFT_ACCELERATION, LIFT_JERK)))
 
 	# Slowly dip
 	lift.move_to(RESIN_TOP+DIP_DISTANCE, DIP_SPEED_DOWN)
-	time.sleep(DIP_WAIT)
+	motion.sleep(DIP_WAIT)
 	lift.move_to(RESIN_TOP, DIP_SPEED_UP)
 
+	# Nobody to pop bubbles in a simulation
+	if SIMULATE:
+		return
+
 	print("Pop any bubbles that formed. Handle water spots.")
 	adjust = 1
 	while adjust != '':
@@ -126,33 +186,80 @@ def setup_resin(display, lift):
 ###############################################################################
 def display_status(start_time, current_slice):
 	if (current_slice > 0):
-		delta = time.time() - start_time
-		time_remain = ((NUM_SLICES+0.0)/current_slice - 1.0)*(delta)
+		if ETA:
+			time_remain = ETA.remaining(current_slice)
+		else:
+			delta = motion.monotonic() - start_time
+			time_remain = ((NUM_SLICES+0.0)/current_slice - 1.0)*(delta)
 		time_remain_str = time.strftime('%H:%M:%S', time.gmtime(time_remain))
 		print "Layer {:d} of {:d}. {:s} Remaining.".format(current_slice, NUM_SLICES, time_remain_str)
 
 ###############################################################################
 ##
-#   Expands SLICE_DIRECTIONS to give explicit directions per slice, as
-#   SLICE_DIRECTIONS implies the same parameters are used between slices
+#   Loads the schedule of the print, from the job if it has one, otherwise
+#   from SLICE_DIRECTIONS, which is then saved with the job.  With
+#   ADAPTIVE_PEEL, the dips are then chosen from the measured size of each
+#   layer, and the adapted schedule saved too.
 #
-#   @return tuple with directions for every slice
+#   @return schedule.slice_schedule
 ##
 ###############################################################################
-def expand_slice_directions():
-	global SLICE_DIRECTIONS
+def print_schedule():
+	schedule = load_schedule(OBJECT_PATH, SLICE_DIRECTIONS, NUM_SLICES)
+	# An estimate leaves the job as it is
+	if not ESTIMATE and not os.path.isfile(schedule_path(OBJECT_PATH)):
+		save_schedule(schedule, OBJECT_PATH)
 
-	step = 0
-	slice_stats = []
+	if ADAPTIVE_PEEL:
+		counts = peel_policy(RESIN_SETTLE, FIRST_SLICE_NUM).adapt(schedule, INDEX.stats())
+		print "Adapted peels: " + format_counts(counts)
+		if not ESTIMATE:
+			save_schedule(schedule, OBJECT_PATH, ADAPTED_NAME)
 
-	for i in xrange(NUM_SLICES):
-		if step < len(SLICE_DIRECTIONS)-1:
-			if i == SLICE_DIRECTIONS[step + 1][0]:
-				step = step + 1
+	return schedule
 
-		slice_stats.append(SLICE_DIRECTIONS[step][1:])
+###############################################################################
+##
+#   Fills in a layer's directions with the defaults
+#
+#   @param  layer_directive     schedule.directive of the layer
+#   @return tuple of (peel, display time, thickness).  The peel is the
+#           arguments of BED_servo.peel, or None if the layer has no peel.
+##
+###############################################################################
+def layer_plan(layer_directive):
+	thickness = layer_directive.thickness or SLICE_THICKNESS
+
+	if layer_directive.method == "dip":
+		depth = layer_directive.dip_distance or DIP_DISTANCE
+		speed_down = layer_directive.dip_speed or DIP_SPEED_DOWN
+		speed_up = layer_directive.dip_speed or DIP_SPEED_UP
+	elif layer_directive.method == "slow dip":
+		depth = layer_directive.dip_distance or SLOW_DIP_DIST
+		speed_down = layer_directive.dip_speed or SLOW_DIP_SPEED
+		speed_up = speed_down
+	else:
+		return None, layer_directive.time, thickness
 
-	return slice_stats
+	if layer_directive.settle is None:
+		settle = RESIN_SETTLE
+	else:
+		settle = layer_directive.settle
+
+	peel = (depth, depth-thickness, speed_down, speed_up, DIP_WAIT, settle, LIFT_ACCELERATION, LIFT_JERK)
+	return peel, layer_directive.time, thickness
+
+###############################################################################
+##
+#   Plans the time each layer of the print will take
+#
+#   @param  schedule    schedule.slice_schedule of the print
+#   @return eta.estimator
+##
+###############################################################################
+def plan_eta(schedule):
+	layers = [layer_plan(schedule[i])[:2] for i in xrange(len(schedule))]
+	return estimator(plan_print(layers, Z_DISTANCE_PER_STEP))
 
 ###############################################################################
 ##
@@ -161,39 +268,36 @@ def expand_slice_directions():
 ###############################################################################
 def calibrate():
 	display = projector()
-	lift = BED_servo(Z_DISTANCE_PER_STEP)
+	lift = open_lift()
 
 	try:
 		setup_resin(display, lift)
-		start_time = time.time()
+		start_time = motion.monotonic()
 
 		for i in xrange(NUM_SLICES):
 			display_status(start_time,i)
 
-			lift.move_microns(DIP_DISTANCE, DIP_SPEED_DOWN)
-			time.sleep(DIP_WAIT)
-			lift.move_microns(-DIP_DISTANCE+SLICE_THICKNESS, DIP_SPEED_UP)
-			time.sleep(RESIN_SETTLE)
+			lift.peel(DIP_DISTANCE, DIP_DISTANCE-SLICE_THICKNESS, DIP_SPEED_DOWN, DIP_SPEED_UP, DIP_WAIT, RESIN_SETTLE, LIFT_ACCELERATION, LIFT_JERK)
 
-			display.display(SLICE_PREFIX+"0000.png")
+			display.display(SLICES.layer_path(0))
 
 			if i < FIRST_SLICE_NUM:
-				time.sleep(FIRST_SLICE_TIME)
+				motion.sleep(FIRST_SLICE_TIME)
 			else:
-				time.sleep(CALIBRATE_MIN_TIME)
+				motion.sleep(CALIBRATE_MIN_TIME)
 
 				for j in xrange(1,9):
-					display.display(SLICE_PREFIX+"{:04d}.png".format(j))
-					time.sleep(CALIBRATE_TIME_DELTA)
+					display.display(SLICES.layer_path(j))
+					motion.sleep(CALIBRATE_TIME_DELTA)
 
 			display.black()
 
-		print "Print completed in " + time.strftime('%H:%M:%S', time.gmtime(time.time()-start_time))
+		print "Print completed in " + time.strftime('%H:%M:%S', time.gmtime(motion.monotonic()-start_time))
 
 	except:
 		traceback.print_exception(*sys.exc_info())
 
-	lift.home(OPTIMUM_LIFT_SPEED)
+	lift.home(CRUISE_LIFT_SPEED, LIFT_ACCELERATION, LIFT_JERK)
 	lift.shutdown()
 	display.shutdown()
 
@@ -204,11 +308,11 @@ def calibrate():
 ###############################################################################
 def supercali():
 	display = projector()
-	lift = BED_servo(Z_DISTANCE_PER_STEP)
+	lift = open_lift()
 
 	try:
 		setup_resin(display, lift)
-		start_time = time.time()
+		start_time = motion.monotonic()
 
 		base_num_slices = (SUPERCALI_BASE_HEIGHT-FIRST_SLICE_THICKNESS)/SLICE_THICKNESS + 1
 		base_num_slices = 0
@@ -243,27 +347,24 @@ def supercali():
 		for i in xrange(post_num_slices):
 			display_status(start_time,i+base_num_slices)
 
-			lift.move_microns(DIP_DISTANCE, DIP_SPEED_DOWN)
-			time.sleep(DIP_WAIT)
-			lift.move_microns(-DIP_DISTANCE+SLICE_THICKNESS, DIP_SPEED_UP)
-			time.sleep(RESIN_SETTLE)
+			lift.peel(DIP_DISTANCE, DIP_DISTANCE-SLICE_THICKNESS, DIP_SPEED_DOWN, DIP_SPEED_UP, DIP_WAIT, RESIN_SETTLE, LIFT_ACCELERATION, LIFT_JERK)
 
-			display.display(SLICE_PREFIX+"0000.png")
+			display.display(SLICES.layer_path(0))
 
-			time.sleep(SUPERCALI_MIN_TIME)
+			motion.sleep(SUPERCALI_MIN_TIME)
 
 			for j in xrange(1,9):
-				display.display(SLICE_PREFIX+"{:04d}.png".format(j))
-				time.sleep(SUPERCALI_TIME_DELTA)
+				display.display(SLICES.layer_path(j))
+				motion.sleep(SUPERCALI_TIME_DELTA)
 
 			display.black()
 
-		print "Print completed in " + time.strftime('%H:%M:%S', time.gmtime(time.time()-start_time))
+		print "Print completed in " + time.strftime('%H:%M:%S', time.gmtime(motion.monotonic()-start_time))
 
 	except:
 		traceback.print_exception(*sys.exc_info())
 
-	lift.home(OPTIMUM_LIFT_SPEED)
+	lift.home(CRUISE_LIFT_SPEED, LIFT_ACCELERATION, LIFT_JERK)
 	lift.shutdown()
 	display.shutdown()
 
@@ -273,66 +374,103 @@ def supercali():
 ##
 ###############################################################################
 def print_object():
+	global ETA
+
 	display = projector()
-	lift = BED_servo(Z_DISTANCE_PER_STEP)
+	lift = open_lift()
 
-	try:
-		slice_stats = expand_slice_directions()
+	display.telemetry = TELEMETRY
+	TELEMETRY.start()
 
-		setup_resin(display, lift)
-		start_time = time.time()
+	# Times each exposure from the display update that shows it
+	exposures = exposure_scheduler(display, TELEMETRY)
 
-		for i in xrange(NUM_SLICES):
+	# Stops a streaming move if the print fails
+	lift.cancel = cancel_token()
 
-			display_status(start_time, i)
+	try:
+		schedule = print_schedule()
 
-			method, display_time = slice_stats[i]
+		# Measured phases correct the plan as the print goes
+		ETA = plan_eta(schedule)
+		TELEMETRY.listeners[:] = [ETA.measure]
 
-			slice_image = SLICE_PREFIX+"{:04d}.png".format(i)
+		with TELEMETRY.span("setup"):
+			setup_resin(display, lift)
+		start_time = motion.monotonic()
 
-			if method == "dip":
+		# Layer being printed and its monotonic() start
+		current = [0, 0.0]
 
-				display.black()
+		def start_layer(i):
+			current[:] = [i, motion.monotonic()]
+			TELEMETRY.layer = i
 
-				lift.move_microns(DIP_DISTANCE, DIP_SPEED_DOWN)
-				time.sleep(DIP_WAIT)
-				lift.move_microns(-DIP_DISTANCE+SLICE_THICKNESS, DIP_SPEED_UP)
+			# Status and logging run on the log thread, alongside the peel
+			TELEMETRY.defer(display_status, start_time, i)
 
-				time.sleep(RESIN_SETTLE)
+			display.prefetch([SLICES.layer_path(j) for j in xrange(i, min(i+PREFETCH_DEPTH+1, NUM_SLICES))])
 
-				display.display(slice_image)
-				time.sleep(display_time)
+		def finish_layer():
+			TELEMETRY.defer(ETA.layer_done, current[0], motion.monotonic() - current[1])
 
-			elif method == "cont":
-				display.display(slice_image)
-				lift.move_microns(SLICE_THICKNESS, SLICE_THICKNESS / display_time)
+		i = 0
+		while i < NUM_SLICES:
+			start_layer(i)
 
-			elif method == "bottom":
-				display.display(slice_image)
-				time.sleep(display_time)
+			method = schedule[i].method
+			peel, display_time, thickness = layer_plan(schedule[i])
+
+			slice_image = SLICES.layer_path(i)
+
+			if method == "dip" or method == "slow dip":
 
-			elif method == "slow dip":
 				display.black()
 
-				lift.move_microns(SLOW_DIP_DIST, SLOW_DIP_SPEED)
-				time.sleep(DIP_WAIT)
-				lift.move_microns(-SLOW_DIP_DIST+SLICE_THICKNESS, SLOW_DIP_SPEED)
+				peel_start = motion.monotonic()
+				TELEMETRY.record_moves(peel_start, lift.peel(*peel), PEEL_SEGMENTS)
 
-				time.sleep(RESIN_SETTLE)
+				exposures.expose(slice_image, display_time)
 
-				display.display(slice_image)
-				time.sleep(display_time)
+			elif method == "cont":
+				# The lift streams through the whole run of "cont" layers,
+				# each image replacing the last without a blank
+				run = [(slice_image, thickness, display_time)]
+				while i + len(run) < NUM_SLICES and schedule[i + len(run)].method == "cont":
+					peel, display_time, thickness = layer_plan(schedule[i + len(run)])
+					run.append((SLICES.layer_path(i + len(run)), thickness, display_time))
 
+				def next_layer(j, first=i):
+					finish_layer()
+					start_layer(first + j)
 
-		print "Print completed in " + time.strftime('%H:%M:%S', time.gmtime(time.time()-start_time))
+				exposures.expose_stream(lift, run, lift.cancel, next_layer)
+				i = current[0]
+
+			elif method == "bottom":
+				exposures.expose(slice_image, display_time)
+
+			finish_layer()
+			i += 1
+
+		print "Print completed in " + time.strftime('%H:%M:%S', time.gmtime(motion.monotonic()-start_time))
 	except:
 		traceback.print_exception(*sys.exc_info())
 
+	# Homing must not be cut short by the failure that stopped a stream
+	lift.cancel.clear()
+
 	display.black()
-	lift.home(OPTIMUM_LIFT_SPEED)
+	print(format_move_report(lift.home(CRUISE_LIFT_SPEED, LIFT_ACCELERATION, LIFT_JERK)))
 	lift.shutdown()
 	display.shutdown()
 
+	TELEMETRY.stop()
+	print(TELEMETRY.summary())
+	print(exposures.summary())
+	print(lift.jitter.summary())
+	print("Phase timings written to " + TELEMETRY_FILE + ", see telemetry.py for a Chrome trace")
+
 ###############################################################################
 ##
 #   Process arguments from the command line. Sets up global variables for the
@@ -342,7 +480,8 @@ def print_object():
 def process_arguments(arguments):
 	global OBJECT_PATH
 	global GCODE_FILE
-	global SLICE_PREFIX
+	global SLICES
+	global INDEX
 	global CALIBRATE
 	global SUPERCALI
 	global NUM_SLICES
@@ -350,12 +489,14 @@ def process_arguments(arguments):
 	for arg in arguments[1:]:
 		if arg == "calibrate":
 			CALIBRATE = True
-		if arg == "supercali":
+		elif arg == "supercali":
 			SUPERCALI = True
-		if (os.path.isdir(arg)):
+		elif arg == "simulate" or arg == "estimate":
+			pass
+		elif (os.path.isdir(arg) or arg.endswith(ARCHIVE_EXTENSION)):
 			OBJECT_PATH = os.path.abspath(arg)
 		else:
-			print(arg + " is not a directory!")
+			print(arg + " is not a directory or slice archive!")
 			exit()
 
 	# Path not given
@@ -364,21 +505,23 @@ def process_arguments(arguments):
 		exit()
 
 	# Look for slices
-	for objs in os.listdir(OBJECT_PATH):
-		total_path = OBJECT_PATH+"/"+objs
+	SLICES = open_slices(OBJECT_PATH)
 
-		slice_match = re.match("(.+?)[0-9]+\.png", total_path)
-		if slice_match:
-			NUM_SLICES += 1
-			SLICE_PREFIX = slice_match.group(1)
-
-	if not SLICE_PREFIX:
+	if not SLICES:
 		print "Missing slices!"
 		exit()
 
-	print "Image path prefix: " + SLICE_PREFIX
+	NUM_SLICES = SLICES.num_slices
+
+	print "Slices: " + OBJECT_PATH
 	print "Found {:d} slice images.".format(NUM_SLICES)
 
+	# Decodes every slice once, unless the job's index is up to date
+	INDEX = get_index(OBJECT_PATH)
+	if INDEX.errors():
+		print "\n".join(INDEX.errors())
+		exit()
+
 	if CALIBRATE:
 		NUM_SLICES = CALIBRATE_HEIGHT/SLICE_THICKNESS
 
@@ -388,9 +531,15 @@ def process_arguments(arguments):
 
 if __name__ == '__main__':
 	process_arguments(sys.argv)
-	if CALIBRATE:
+	if ESTIMATE:
+		print(plan_eta(print_schedule()).summary())
+	elif CALIBRATE:
 		calibrate()
 	elif SUPERCALI:
 		supercali()
 	else:
 		print_object()
+
+	if SIMULATE:
+		simulator.save_timeline()
+		print simulator.summary()
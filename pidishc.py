@@ -13,15 +13,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, sys, re, time, traceback
+import os, sys, time, traceback, threading
 
 from servo import BED_servo
+from stepper import stepper_process
 from projector import projector
+from slicepack import open_slices, ARCHIVE_EXTENSION
+from motion import format_move_report, step_tracker, cancel_token
 
 usageStr = """
 Usage:      sudo python pidishc.py object_dir
 
-    object_dir  Directory path with slice images
+    object_dir  Directory path with slice images, or a slice archive
 
 Ensure the lift is in the home position (the top) before running.
 
@@ -29,7 +32,7 @@ Ensure the lift is in the home position (the top) before running.
 
 OBJECT_PATH = None
 GCODE_FILE = None
-SLICE_PREFIX = None
+SLICES = None
 NUM_SLICES = 0
 
 SERVO_ENABLE    = 40
@@ -46,6 +49,17 @@ Z_DISTANCE_PER_STEP     = 0.44      # microns
 LIFT_LENGTH             = 103000    # microns
 OPTIMUM_LIFT_SPEED      = 5280      # microns/s
 
+# Motion profile for the long lift moves (homing, approaching the resin)
+CRUISE_LIFT_SPEED       = 8000      # microns/s
+LIFT_ACCELERATION       = 20000     # microns/s^2
+LIFT_JERK               = 200000    # microns/s^3, None for trapezoidal
+
+# Step pulses come from a process of their own, see stepper.py
+STEPPER_PROCESS         = True
+STEPPER_CPU             = 3         # CPU to pin it to, best kept free with isolcpus=3
+STEPPER_PRIORITY        = 50        # SCHED_FIFO priority once pinned, None for the normal scheduler
+STEPPER_LOCK_MEMORY     = True
+
 # Resin vat maintenance
 RESIN_TOP               = 25400     # microns
 LIFT_PLATE_THICKNESS    = 5000      # microns
@@ -58,6 +72,7 @@ DIP_SPEED               = 1000      # microns/s
 # Exposure controls
 SLICE_DISPLAY_TIME      = 1.5       # seconds
 SLICE_THICKNESS         = 10        # microns
+PREFETCH_DEPTH          = 1         # slices prepared ahead of the exposing one
 LIFT_SPEED              = SLICE_THICKNESS / SLICE_DISPLAY_TIME  # microns/sec
 
 FIRST_SLICE_TIME        = 2.0       # seconds
@@ -80,7 +95,7 @@ def setup_resin(display, lift):
     display.black()
 
     # Quickly move to resin
-    lift.move_to(RESIN_TOP-LIFT_PLATE_THICKNESS, OPTIMUM_LIFT_SPEED)
+    print(format_move_report(lift.move_to(RESIN_TOP-LIFT_PLATE_THICKNESS, CRUISE_LIFT_SPEED, LIFT_ACCELERATION, LIFT_JERK)))
 
     # Slowly dip
     lift.move_to(RESIN_TOP+DIP_DISTANCE, DIP_SPEED)
@@ -112,31 +127,92 @@ def display_status(start_time, current_slice):
 
 ###############################################################################
 ##
-#   Prints an object
+#   Plans the whole print as one move
+#
+#   @param  microns_per_step    Lift travel per step
+#   @return tuple of (stretches for BED_servo.stream, step count at which
+#           each layer after the first starts)
+##
+###############################################################################
+def plan_stream(microns_per_step):
+    first_slices = min(FIRST_SLICE_NUM, NUM_SLICES)
+    stretches = [(first_slices * SLICE_THICKNESS, FIRST_SLICE_LIFT_SPEED)]
+    if NUM_SLICES > first_slices:
+        stretches.append(((NUM_SLICES - first_slices) * SLICE_THICKNESS, LIFT_SPEED))
+
+    marks = [int(round(i * SLICE_THICKNESS / microns_per_step)) for i in xrange(1, NUM_SLICES)]
+    return stretches, marks
+
+###############################################################################
+##
+#   Prints an object.  The lift makes the whole print as one constant speed
+#   move on a thread of its own, and each slice goes up at the step where
+#   its layer starts, so the lift never stops between layers.
 ##
 ###############################################################################
 def print_object():
     display = projector()
-    lift = BED_servo(Z_DISTANCE_PER_STEP)
+    if STEPPER_PROCESS:
+        lift = stepper_process(Z_DISTANCE_PER_STEP, STEPPER_CPU, STEPPER_PRIORITY, STEPPER_LOCK_MEMORY)
+    else:
+        lift = BED_servo(Z_DISTANCE_PER_STEP)
+
+    # Stops the streaming move if the print fails or is interrupted
+    cancel = cancel_token()
+    lift.cancel = cancel
+    mover = None
 
     try:
         setup_resin(display, lift)
         start_time = time.time()
 
-        for i in xrange(NUM_SLICES):
+        stretches, marks = plan_stream(lift.microns_per_step)
+        tracker = step_tracker(marks)
+        reports = {}
+        mover = threading.Thread(target=lambda: reports.update(lift.stream(stretches, tracker)), name="lift")
+        mover.daemon = True
+
+        # Seconds from a layer's step to its slice going up
+        swap_lag = []
+
+        display.prefetch([SLICES.layer_path(j) for j in xrange(0, min(PREFETCH_DEPTH+1, NUM_SLICES))])
+        display.display(SLICES.layer_path(0))
+        mover.start()
+
+        for i in xrange(1, NUM_SLICES):
+            display.prefetch([SLICES.layer_path(j) for j in xrange(i, min(i+PREFETCH_DEPTH+1, NUM_SLICES))])
+
+            reached_at = tracker.wait(i - 1)
+            if reached_at is None:
+                print "The lift stopped before layer {:d}".format(i)
+                break
+
+            shown_at = display.display(SLICES.layer_path(i))
+            swap_lag.append(shown_at - reached_at)
             display_status(start_time, i)
-            display.display(SLICE_PREFIX+"{:04d}.png".format(i))
-            if i < FIRST_SLICE_NUM:
-                lift.move_microns(SLICE_THICKNESS, FIRST_SLICE_LIFT_SPEED)
-            else:
-                lift.move_microns(SLICE_THICKNESS, LIFT_SPEED)
+
+        mover.join()
+        display.black()
+
+        for name in sorted(reports):
+            print(format_move_report(reports[name]))
+        if swap_lag:
+            print "Slices went up {:.1f} ms after their step on average, {:.1f} ms at worst".format(
+                1000.0 * sum(swap_lag) / len(swap_lag), 1000.0 * max(swap_lag))
+        print lift.jitter.summary()
 
         print "Print completed in " + time.strftime('%H:%M:%S', time.gmtime(time.time()-start_time))
     except:
         traceback.print_exception(*sys.exc_info())
 
+    # Only one move may drive the lift at a time
+    if mover and mover.is_alive():
+        cancel.cancel("stopped")
+        mover.join()
+    cancel.clear()
+
     display.black()
-    lift.home(OPTIMUM_LIFT_SPEED)
+    print(format_move_report(lift.home(CRUISE_LIFT_SPEED, LIFT_ACCELERATION, LIFT_JERK)))
     lift.shutdown()
     display.shutdown()
 
@@ -149,14 +225,14 @@ def print_object():
 def process_arguments(arguments):
     global OBJECT_PATH
     global GCODE_FILE
-    global SLICE_PREFIX
+    global SLICES
     global NUM_SLICES
 
     for arg in arguments[1:]:
-        if (os.path.isdir(arg)):
+        if (os.path.isdir(arg) or arg.endswith(ARCHIVE_EXTENSION)):
             OBJECT_PATH = os.path.abspath(arg)
         else:
-            print(arg + " is not a directory!")
+            print(arg + " is not a directory or slice archive!")
             exit()
 
     # Path not given
@@ -165,19 +241,15 @@ def process_arguments(arguments):
         exit()
 
     # Look for slices
-    for objs in os.listdir(OBJECT_PATH):
-        total_path = OBJECT_PATH+"/"+objs
+    SLICES = open_slices(OBJECT_PATH)
 
-        slice_match = re.match("(.+?)[0-9]+\.png", total_path)
-        if slice_match:
-            NUM_SLICES += 1
-            SLICE_PREFIX = slice_match.group(1)
-
-    if not SLICE_PREFIX:
+    if not SLICES:
         print "Missing slices!"
         exit()
 
-    print "Image path prefix: " + SLICE_PREFIX
+    NUM_SLICES = SLICES.num_slices
+
+    print "Slices: " + OBJECT_PATH
     print "Found {:d} slice images.".format(NUM_SLICES)
 
 
@@ -13,12 +13,210 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys, time
 import pygame
+import threading
+from Queue import Queue
+from collections import OrderedDict, namedtuple
 from PIL import Image
 from PIL import ImageChops
+import motion
+from slicepack import open_image, source_mtime, content_hash, image_bytes
+from telemetry import span_log
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 BLACK = 0, 0, 0
 
+# Palette that makes an 8-bit surface display as grayscale
+GRAY_PALETTE = [(i, i, i) for i in xrange(256)]
+
+# Vignette gain maps, by resolution.  Gains are 8.8 fixed point, so 256 is 1.0
+GAIN_MAPS = {}
+
+# Memory kept for prepared frames between displays, in bytes
+FRAME_CACHE_BYTES = 64 * 1024 * 1024
+
+###############################################################################
+##
+#   An image ready to blit
+#
+#   surface     pygame surface the size of the image
+#   rect        pygame Rect of the lit pixels, None for a blank image
+##
+###############################################################################
+frame = namedtuple('frame', 'surface rect')
+
+
+###############################################################################
+##
+#   Converts the vignette to a single channel fixed point gain map, scaled to
+#   the given resolution.  Maps are computed once per resolution and cached.
+#
+#   @param  vignette    Vignette PIL image
+#   @param  size        (width, height) of the images it will be applied to
+#   @return numpy uint16 array of gains
+##
+###############################################################################
+def vignette_gain_map(vignette, size):
+    if size not in GAIN_MAPS:
+        gray = vignette.convert('L')
+        if gray.size != size:
+            gray = gray.resize(size, Image.BILINEAR)
+
+        # Matches ImageChops.multiply, which scales by value/255
+        gain = numpy.asarray(gray, dtype=numpy.uint16)
+        GAIN_MAPS[size] = (gain * 256 + 127) // 255
+
+    return GAIN_MAPS[size]
+
+
+###############################################################################
+##
+#   Opens an image, or a slice archive layer, as 8-bit grayscale
+#
+#   @param  image_path  Path to image
+#   @return PIL image in 'L' mode
+##
+###############################################################################
+def open_gray(image_path):
+    image = open_image(image_path)
+    if image.mode != 'L':
+        image = image.convert('L')
+    return image
+
+
+###############################################################################
+##
+#   Wraps 8-bit grayscale pixel data in a pygame surface.  The surface stays
+#   8-bit and is only converted to the screen format when it is blitted.
+#
+#   @param  data    Grayscale pixel data, one byte per pixel
+#   @param  size    (width, height) of the image
+#   @return pygame surface
+##
+###############################################################################
+def gray_surface(data, size):
+    surface = pygame.image.fromstring(data, size, 'P')
+    surface.set_palette(GRAY_PALETTE)
+    return surface
+
+
+###############################################################################
+##
+#   Applies the vignette inverse to a slice in one vectorized pass
+#
+#   @param  slice_pil_image     Grayscale ('L') slice PIL image
+#   @param  vignette            Vignette PIL image
+#   @return numpy uint8 array of the corrected grayscale slice
+##
+###############################################################################
+def apply_vignette(slice_pil_image, vignette):
+    gray = numpy.asarray(slice_pil_image, dtype=numpy.uint16)
+    gain = vignette_gain_map(vignette, slice_pil_image.size)
+
+    return ((gray * gain) >> 8).astype(numpy.uint8)
+
+###############################################################################
+##
+#   Prepared frames, ready to blit, kept within a memory budget.  The least
+#   recently displayed frames are dropped first.
+#
+#   Frames are stored by the hash of their pixels, so identical images under
+#   different paths share one frame.  Each path is remembered with the
+#   modification time of its file and the hash it had, so a repeated path is
+#   found without opening the image, and a changed file is loaded again.
+##
+###############################################################################
+class frame_cache:
+    ###########################################################################
+    ##
+    #   @param  budget  Bytes of frames to keep
+    ##
+    ###########################################################################
+    def __init__(self, budget=FRAME_CACHE_BYTES):
+        self.budget = budget
+        self.used = 0
+
+        # (content hash, vignetted) -> (frame, bytes), oldest first
+        self.frames = OrderedDict()
+
+        # (image path, mtime) -> content hash
+        self.hashes = {}
+
+        # Shared by display() and the prefetch worker
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    ###########################################################################
+    ##
+    #   Looks up a frame, by its path or by its pixels
+    #
+    #   @param  image_path  Path to image
+    #   @param  mtime       Modification time of the image's file
+    #   @param  vignetted   Whether the frame has the vignette inverse applied
+    #   @param  digest      Content hash of the image, None if not loaded yet
+    #   @return frame, or None if the frame is not kept
+    ##
+    ###########################################################################
+    def get(self, image_path, mtime, vignetted, digest=None):
+        with self.lock:
+            if digest is None:
+                digest = self.hashes.get((image_path, mtime))
+            else:
+                self.hashes[(image_path, mtime)] = digest
+
+            key = (digest, vignetted)
+            if digest is None or key not in self.frames:
+                return None
+
+            # Most recently used go to the end
+            entry = self.frames.pop(key)
+            self.frames[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    ###########################################################################
+    ##
+    #   Keeps a newly prepared frame, dropping the oldest ones to stay within
+    #   the budget
+    #
+    #   @param  image_path  Path to image
+    #   @param  mtime       Modification time of the image's file
+    #   @param  vignetted   Whether the frame has the vignette inverse applied
+    #   @param  digest      Content hash of the image
+    #   @param  prepared    Prepared frame
+    ##
+    ###########################################################################
+    def put(self, image_path, mtime, vignetted, digest, prepared):
+        size = prepared.surface.get_pitch() * prepared.surface.get_height()
+
+        with self.lock:
+            self.misses += 1
+            self.hashes[(image_path, mtime)] = digest
+
+            key = (digest, vignetted)
+            if key in self.frames or size > self.budget:
+                return
+
+            while self.used + size > self.budget:
+                old_frame, old_size = self.frames.popitem(last=False)[1]
+                self.used -= old_size
+
+            self.frames[key] = (prepared, size)
+            self.used += size
+
+    def summary(self):
+        with self.lock:
+            return "Frame cache: {:d} hits, {:d} misses, {:d} frames in {:.1f} of {:.1f} MB".format(
+                self.hits, self.misses, len(self.frames), self.used / 1048576.0, self.budget / 1048576.0)
+
+
 class projector:
     ###########################################################################
     ##
@@ -33,17 +231,48 @@ class projector:
         # Hide the mouse cursor
         pygame.mouse.set_visible(False)
 
-        # Get the vignette image
-        self.vignette = Image.open('vignette.png')
+        # Only the lit part of the screen is cleared and redrawn, from a black
+        # frame made once in the screen's format
+        self.black_surface = pygame.Surface(size).convert()
+        self.black_surface.fill(BLACK)
+        self.screen.fill(BLACK)
+        pygame.display.flip()
+        self.lit_rect = None
+
+        # Get the vignette image.  Only luminance matters for exposure, so
+        # everything is handled as 8-bit grayscale up to the screen.
+        self.vignette = Image.open('vignette.png').convert('L')
+
+        # Replaced with the printer's log to time the display phases
+        self.telemetry = span_log()
+
+        # Frames already prepared, for images that are displayed again
+        self.frames = frame_cache()
+
+        # Slices decoded ahead of time by the prefetch worker, by image path
+        self.prepared = {}
+        self.in_flight = set()
+        self.prepared_cond = threading.Condition()
+        self.prefetch_queue = Queue()
+
+        self.prefetch_thread = threading.Thread(target=self.prefetch_worker, name="prefetch")
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
 
     ###########################################################################
     ##
     #   Displays a black screen
+    #
+    #   @return monotonic() time the black frame was handed to the display
     ##
     ###########################################################################
     def black(self):
-        self.screen.fill(BLACK)
-        pygame.display.flip()
+        with self.telemetry.span("blit/update", detail="black"):
+            if self.lit_rect:
+                self.screen.blit(self.black_surface, self.lit_rect, self.lit_rect)
+                pygame.display.update(self.lit_rect)
+                self.lit_rect = None
+            return motion.monotonic()
 
     ###########################################################################
     ##
@@ -54,28 +283,158 @@ class projector:
         color = (gray_value,gray_value,gray_value)
         self.screen.fill(color)
         pygame.display.flip()
+        self.lit_rect = self.screen.get_rect()
 
     ###########################################################################
     ##
     #   Displays an image on the projector with an applied vignette inverse
     #
     #   @param  image       Path to image
+    #   @return monotonic() time the image was handed to the display
     ##
     ###########################################################################
     def display(self, image_path):
 
-        slice_pil_image = Image.open(image_path)
-        slice_vig_image = ImageChops.multiply(slice_pil_image,self.vignette)
+        with self.telemetry.span("prefetch wait"):
+            slice_frame = self.take_prepared(image_path)
+        if slice_frame is None:
+            slice_frame = self.prepare(image_path)
 
-        #slice_image = pygame.image.load(image_path)
-        slice_image = pygame.image.fromstring(slice_vig_image.tostring(),slice_vig_image.size,slice_vig_image.mode)
-        slice_rect = slice_image.get_rect()
+        with self.telemetry.span("blit/update", detail=image_path):
+            return self.show(slice_frame)
 
-        self.screen.fill(BLACK)
-        self.screen.blit(slice_image, slice_rect)
-        pygame.display.flip()
+    ###########################################################################
+    ##
+    #   Replaces what is on the screen with a frame.  Only the previously lit
+    #   area is cleared and only the frame's lit area is drawn, and just those
+    #   rectangles are pushed to the display.  The time is taken after
+    #   pygame.display.update returns, which is not a vsync: the frame
+    #   reaches the screen on one of the next refreshes.
+    #
+    #   @param  slice_frame     Prepared frame
+    #   @return monotonic() time the frame was handed to the display
+    ##
+    ###########################################################################
+    def show(self, slice_frame):
+        dirty = []
+
+        if self.lit_rect:
+            self.screen.blit(self.black_surface, self.lit_rect, self.lit_rect)
+            dirty.append(self.lit_rect)
+
+        if slice_frame.rect:
+            self.screen.blit(slice_frame.surface, slice_frame.rect, slice_frame.rect)
+            dirty.append(slice_frame.rect)
+
+        pygame.display.update(dirty)
+        self.lit_rect = slice_frame.rect
+        return motion.monotonic()
 
 
+    ###########################################################################
+    ##
+    #   Loads an image and applies the vignette inverse, ready to blit.  Frames
+    #   in the cache are reused rather than prepared again.
+    #
+    #   @param  image_path  Path to image
+    #   @param  vignetted   False to leave the image as it is
+    #   @return frame
+    ##
+    ###########################################################################
+    def prepare(self, image_path, vignetted=True):
+        mtime = source_mtime(image_path)
+        slice_frame = self.frames.get(image_path, mtime, vignetted)
+        if slice_frame is not None:
+            return slice_frame
+
+        with self.telemetry.span("image load", detail=image_path):
+            slice_pil_image = open_gray(image_path)
+            digest = content_hash(slice_pil_image)
+
+        # The same pixels may already be prepared under another path
+        slice_frame = self.frames.get(image_path, mtime, vignetted, digest)
+        if slice_frame is not None:
+            return slice_frame
+
+        if not vignetted:
+            slice_image = gray_surface(image_bytes(slice_pil_image), slice_pil_image.size)
+        else:
+            with self.telemetry.span("vignette", detail=image_path):
+                if numpy is not None:
+                    slice_vig_data = apply_vignette(slice_pil_image, self.vignette)
+                    slice_image = gray_surface(slice_vig_data.tostring(), slice_pil_image.size)
+                else:
+                    slice_vig_image = ImageChops.multiply(slice_pil_image,self.vignette)
+                    slice_image = gray_surface(image_bytes(slice_vig_image), slice_vig_image.size)
+
+        # Only the lit part of the frame is ever blitted
+        bbox = slice_pil_image.getbbox()
+        lit_rect = None
+        if bbox:
+            lit_rect = pygame.Rect(bbox[0], bbox[1], bbox[2] - bbox[0], bbox[3] - bbox[1])
+
+        slice_frame = frame(slice_image, lit_rect)
+
+        self.frames.put(image_path, mtime, vignetted, digest, slice_frame)
+        return slice_frame
+
+    ###########################################################################
+    ##
+    #   Queues images to be prepared in the background, so display() only has
+    #   to blit them.  Prepared images that are no longer in the list are
+    #   dropped to keep memory bounded.
+    #
+    #   @param  image_paths     Paths of the images that will be displayed next
+    ##
+    ###########################################################################
+    def prefetch(self, image_paths):
+        with self.prepared_cond:
+            for image_path in self.prepared.keys():
+                if image_path not in image_paths:
+                    del self.prepared[image_path]
+
+            for image_path in image_paths:
+                if image_path not in self.prepared and image_path not in self.in_flight:
+                    self.in_flight.add(image_path)
+                    self.prefetch_queue.put(image_path)
+
+    ###########################################################################
+    ##
+    #   Background thread that prepares the queued images.  Failures are left
+    #   for display() to hit again, so the error shows up in the print.
+    ##
+    ###########################################################################
+    def prefetch_worker(self):
+        while True:
+            image_path = self.prefetch_queue.get()
+            if image_path is None:
+                return
+
+            try:
+                slice_frame = self.prepare(image_path)
+            except Exception:
+                slice_frame = None
+
+            with self.prepared_cond:
+                self.in_flight.discard(image_path)
+                if slice_frame is not None:
+                    self.prepared[image_path] = slice_frame
+                self.prepared_cond.notify_all()
+
+    ###########################################################################
+    ##
+    #   Removes a prepared image, waiting for it if it is still being prepared
+    #
+    #   @param  image_path  Path to image
+    #   @return frame, or None if the image was never prefetched
+    ##
+    ###########################################################################
+    def take_prepared(self, image_path):
+        with self.prepared_cond:
+            while image_path in self.in_flight:
+                self.prepared_cond.wait()
+            return self.prepared.pop(image_path, None)
+
     ###########################################################################
     ##
     #   Displays an image on the projector
@@ -84,12 +443,7 @@ class projector:
     ##
     ###########################################################################
     def image(self, image_path):
-        slice_image = pygame.image.load(image_path)
-        slice_rect = slice_image.get_rect()
-
-        self.screen.fill(BLACK)
-        self.screen.blit(slice_image, slice_rect)
-        pygame.display.flip()
+        self.show(self.prepare(image_path, vignetted=False))
 
     ###########################################################################
     ##
@@ -97,4 +451,51 @@ class projector:
     ##
     ###########################################################################
     def shutdown(self):
+        self.prefetch_queue.put(None)
+        self.prefetch_thread.join()
         pygame.quit()
+        print(self.frames.summary())
+
+
+###############################################################################
+##
+#   Times the vignette correction of a slice with PIL and with numpy.  The
+#   numpy timing does not include building the cached gain map.
+#
+#   @param  image_path      Path to a slice image
+#   @param  vignette_path   Path to the vignette image
+#   @param  repeat          Number of times to run each path
+#   @return tuple of (PIL seconds, numpy seconds) per slice
+##
+###############################################################################
+def benchmark_vignette(image_path, vignette_path='vignette.png', repeat=20):
+    vignette = Image.open(vignette_path).convert('L')
+    slice_pil_image = open_gray(image_path)
+
+    start = time.time()
+    for _ in xrange(repeat):
+        image_bytes(ImageChops.multiply(slice_pil_image, vignette))
+    pil_time = (time.time() - start) / repeat
+
+    numpy_time = None
+    if numpy is not None:
+        vignette_gain_map(vignette, slice_pil_image.size)
+        start = time.time()
+        for _ in xrange(repeat):
+            apply_vignette(slice_pil_image, vignette).tostring()
+        numpy_time = (time.time() - start) / repeat
+
+    return pil_time, numpy_time
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print "Usage:      python projector.py slice.png [vignette.png]"
+        exit()
+
+    pil_time, numpy_time = benchmark_vignette(*sys.argv[1:3])
+    print "PIL vignette:   {:.1f} ms per slice".format(pil_time * 1000.0)
+    if numpy_time is None:
+        print "numpy is not installed"
+    else:
+        print "numpy vignette: {:.1f} ms per slice".format(numpy_time * 1000.0)
@@ -0,0 +1,196 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+##
+#   The per layer directions of a print, stored as the ranges they were
+#   given in plus any layers overridden one by one.
+#
+#   A job can carry its own schedule as JSON, in schedule.json inside a slice
+#   directory, or next to any other job as <job>.schedule.json:
+#
+#   {"directions": [[0, "dip", 2.5], [3, "dip", 1.0]],
+#    "overrides":  {"12": {"time": 1.5, "thickness": 50}}}
+#
+#   Each direction is [first layer, method, display time] and lasts until the
+#   next one.  Overrides may set any of OVERRIDE_FIELDS for a single layer.
+#
+#   A job printed without a schedule is given the one it was built from the
+#   printer's SLICE_DIRECTIONS, so it prints the same way again.  The peels
+#   chosen by peeling.peel_policy are saved on their own, as
+#   adapted_schedule.json or <job>.adapted_schedule.json, so they are kept
+#   apart from what the job asks for.
+##
+###############################################################################
+
+import os, json
+from bisect import bisect_right
+from collections import namedtuple
+from slicepack import sidecar_path
+
+SCHEDULE_NAME       = "schedule"
+ADAPTED_NAME        = "adapted_schedule"
+
+###############################################################################
+##
+#   Directions for one layer
+#
+#   method          "dip", "slow dip", "cont" or "bottom"
+#   time            Display time, in seconds or as a factor of the exposure
+#                   time, as the printer's SLICE_DIRECTIONS give it
+#   thickness       Layer thickness in microns, None for the default
+#   dip_distance    Depth of the peel in microns, None for the default
+#   dip_speed       Speed of the peel in microns/s, None for the default
+#   settle          Seconds to let the resin settle after the peel, None for
+#                   the default
+##
+###############################################################################
+directive = namedtuple('directive', 'method time thickness dip_distance dip_speed settle')
+
+OVERRIDE_FIELDS = directive._fields
+
+
+class slice_schedule:
+    ###########################################################################
+    ##
+    #   @param  directions  List of [first layer, method, display time],
+    #                       starting at layer 0, in order
+    #   @param  num_slices  Number of layers in the print
+    #   @param  overrides   Dictionary of layer to a dictionary of fields
+    ##
+    ###########################################################################
+    def __init__(self, directions, num_slices, overrides=None):
+        self.starts = [int(d[0]) for d in directions]
+        self.directives = [directive(d[1], d[2], None, None, None, None) for d in directions]
+        self.num_slices = num_slices
+        self.overrides = {}
+
+        if not self.starts or self.starts[0] != 0 or self.starts != sorted(self.starts):
+            raise ValueError("Slice directions must start at layer 0 and be in order")
+
+        for layer, fields in (overrides or {}).items():
+            self.set_override(int(layer), **fields)
+
+    def __len__(self):
+        return self.num_slices
+
+    ###########################################################################
+    ##
+    #   Looks up the directions for a layer
+    #
+    #   @param  layer   Layer number
+    #   @return directive
+    ##
+    ###########################################################################
+    def __getitem__(self, layer):
+        if not 0 <= layer < self.num_slices:
+            raise IndexError("Layer {:d} is not in the schedule".format(layer))
+
+        layer_directive = self.directives[bisect_right(self.starts, layer) - 1]
+        if layer in self.overrides:
+            layer_directive = layer_directive._replace(**self.overrides[layer])
+        return layer_directive
+
+    ###########################################################################
+    ##
+    #   Overrides some directions of a single layer
+    #
+    #   @param  layer   Layer number
+    #   @param  fields  Keyword arguments named from OVERRIDE_FIELDS
+    ##
+    ###########################################################################
+    def set_override(self, layer, **fields):
+        for field in fields:
+            if field not in OVERRIDE_FIELDS:
+                raise ValueError("Unknown layer override " + field)
+        self.overrides.setdefault(layer, {}).update(fields)
+
+    def to_dict(self):
+        return {"directions": [[start, d.method, d.time] for start, d in zip(self.starts, self.directives)],
+                "overrides": dict((str(layer), fields) for layer, fields in self.overrides.items())}
+
+    ###########################################################################
+    ##
+    #   Writes the schedule as JSON.  It is written to a temporary file that
+    #   then replaces the old one, so a print never reads half a schedule.
+    ##
+    ###########################################################################
+    def save(self, path):
+        f = open(path + ".tmp", 'w')
+        try:
+            json.dump(self.to_dict(), f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(path + ".tmp", path)
+
+
+###############################################################################
+##
+#   Where a job keeps its schedule
+#
+#   @param  object_path     Slice directory, archive, or "zip#folder" path
+#   @param  name            SCHEDULE_NAME, or ADAPTED_NAME for the adapted
+#                           schedule
+#   @return path of the schedule file
+##
+###############################################################################
+def schedule_path(object_path, name=SCHEDULE_NAME):
+    return sidecar_path(object_path, name)
+
+
+###############################################################################
+##
+#   Loads the schedule of a job.  Without a schedule file, or without
+#   directions in it, the given directions are used.
+#
+#   @param  object_path     Slice directory, archive, or "zip#folder" path
+#   @param  directions      Default list of [first layer, method, time]
+#   @param  num_slices      Number of layers in the print
+#   @param  name            SCHEDULE_NAME, or ADAPTED_NAME for the adapted
+#                           schedule
+#   @return slice_schedule
+##
+###############################################################################
+def load_schedule(object_path, directions, num_slices, name=SCHEDULE_NAME):
+    path = schedule_path(object_path, name)
+    if not os.path.isfile(path):
+        return slice_schedule(directions, num_slices)
+
+    f = open(path)
+    try:
+        metadata = json.load(f)
+    finally:
+        f.close()
+
+    return slice_schedule(metadata.get("directions") or directions, num_slices, metadata.get("overrides"))
+
+
+###############################################################################
+##
+#   Saves the schedule of a job next to it.  A job that cannot be written to
+#   still prints, so a failure is only reported.
+#
+#   @param  schedule        slice_schedule to save
+#   @param  object_path     Slice directory, archive, or "zip#folder" path
+#   @param  name            SCHEDULE_NAME, or ADAPTED_NAME for the adapted
+#                           schedule
+##
+###############################################################################
+def save_schedule(schedule, object_path, name=SCHEDULE_NAME):
+    path = schedule_path(object_path, name)
+    try:
+        schedule.save(path)
+    except (IOError, OSError) as e:
+        print "Could not save the schedule {:s}: {:s}".format(path, str(e))
@@ -0,0 +1,176 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+##
+#   Estimates the time left in a print from a plan of every layer, built
+#   from the slice directions, the lift's motion profiles and the exposure
+#   times.  The plan is corrected as the print runs with the measured
+#   duration of each phase.
+##
+###############################################################################
+
+from motion import accelerated_profile
+
+# Weight of the newest measurement in the running corrections
+EWMA_WEIGHT     = 0.2
+
+# Planned peel phases, by the peel's parameters
+PEEL_PLANS      = {}
+
+
+###############################################################################
+##
+#   Plans the phases of a peel, see BED_servo.peel
+#
+#   @param  microns_per_step    Lift travel per step
+#   @return list of (phase, seconds) with the telemetry names of the phases
+##
+###############################################################################
+def peel_phases(microns_per_step, depth, rise, speed_down, speed_up, dwell, settle, accel=None, jerk=None):
+    key = (microns_per_step, depth, rise, speed_down, speed_up, dwell, settle, accel, jerk)
+    if key not in PEEL_PLANS:
+        if accel:
+            accel = accel / microns_per_step
+        if jerk:
+            jerk = jerk / microns_per_step
+
+        down = accelerated_profile(int(depth / microns_per_step), speed_down / microns_per_step, accel, jerk)
+        up = accelerated_profile(int(rise / microns_per_step), speed_up / microns_per_step, accel, jerk)
+
+        PEEL_PLANS[key] = [("lift down", down[-1]),
+                           ("lift dwell", dwell),
+                           ("lift up", up[-1]),
+                           ("lift settle", settle)]
+
+    return PEEL_PLANS[key]
+
+
+###############################################################################
+##
+#   Plans every layer of a print
+#
+#   @param  layers              Per layer (peel, display time in seconds).
+#                               The peel is the arguments of BED_servo.peel,
+#                               or None for layers that only expose.
+#   @param  microns_per_step    Lift travel per step
+#   @return list of lists of (phase, seconds), one per layer
+##
+###############################################################################
+def plan_print(layers, microns_per_step):
+    plan = []
+
+    for peel, display_time in layers:
+        phases = []
+        if peel:
+            phases.extend(peel_phases(microns_per_step, *peel))
+        phases.append(("exposure", display_time))
+        plan.append(phases)
+
+    return plan
+
+
+###############################################################################
+##
+#   Formats seconds the way the status lines do
+##
+###############################################################################
+def format_duration(seconds):
+    hours, rest = divmod(int(seconds + 0.5), 3600)
+    return "{:02d}:{:02d}:{:02d}".format(hours, rest // 60, rest % 60)
+
+
+class estimator:
+    ###########################################################################
+    ##
+    #   @param  plan    List of the planned phases of each layer, from
+    #                   plan_print
+    ##
+    ###########################################################################
+    def __init__(self, plan):
+        self.plan = plan
+
+        # Measured over planned duration, by phase
+        self.ratios = {}
+
+        # Seconds per layer spent outside the planned phases
+        self.overhead = 0.0
+
+    def planned_layer(self, layer):
+        return sum(seconds for phase, seconds in self.plan[layer])
+
+    def corrected_layer(self, layer):
+        return sum(seconds * self.ratios.get(phase, 1.0) for phase, seconds in self.plan[layer]) + self.overhead
+
+    ###########################################################################
+    ##
+    #   Takes in a measured phase.  The arguments match span_log.record, so
+    #   the estimator can listen to the telemetry.
+    #
+    #   @param  phase       Phase name, e.g. "exposure" or "lift down"
+    #   @param  start       Unused
+    #   @param  duration    Measured seconds
+    #   @param  planned     Planned seconds, or None for phases that are
+    #                       not planned
+    ##
+    ###########################################################################
+    def measure(self, phase, start, duration, planned=None, detail=""):
+        if not planned or planned <= 0:
+            return
+
+        ratio = duration / planned
+        if phase in self.ratios:
+            ratio = self.ratios[phase] + EWMA_WEIGHT * (ratio - self.ratios[phase])
+        self.ratios[phase] = ratio
+
+    ###########################################################################
+    ##
+    #   Takes in the measured duration of a whole layer, to learn the time
+    #   spent between the planned phases
+    #
+    #   @param  layer       Layer just finished
+    #   @param  duration    Measured seconds
+    ##
+    ###########################################################################
+    def layer_done(self, layer, duration):
+        unplanned = duration - (self.corrected_layer(layer) - self.overhead)
+        self.overhead += EWMA_WEIGHT * (max(unplanned, 0.0) - self.overhead)
+
+    ###########################################################################
+    ##
+    #   @param  layer   First layer not yet finished
+    #   @return estimated seconds to finish the print
+    ##
+    ###########################################################################
+    def remaining(self, layer):
+        return sum(self.corrected_layer(i) for i in xrange(layer, len(self.plan)))
+
+    ###########################################################################
+    ##
+    #   Sums up the plan, for a dry run
+    #
+    #   @return string with the total time and the time in each phase
+    ##
+    ###########################################################################
+    def summary(self):
+        phases = {}
+        for layer in self.plan:
+            for phase, seconds in layer:
+                phases[phase] = phases.get(phase, 0.0) + seconds
+
+        lines = ["{:d} layers, {:s} planned".format(len(self.plan), format_duration(self.remaining(0)))]
+        for phase in sorted(phases, key=lambda p: -phases[p]):
+            lines.append("{:<12s} {:s}".format(phase, format_duration(phases[phase])))
+        return "\n".join(lines)
@@ -0,0 +1,61 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+##
+#   Messages passed over the pipe between the model and the printer process.
+#   Both ends block on the pipe, so a message is handled as soon as it
+#   arrives.
+##
+###############################################################################
+
+from collections import namedtuple
+
+###############################################################################
+##
+#   Model to printer.  Asks the printer to run one of its commands.
+#
+#   id      Number the printer's reply_msg refers back to
+#   name    Command, e.g. "print_object", "Pause" or "Abort"
+#   args    Dictionary of the command's arguments, empty if it takes none
+##
+###############################################################################
+command_msg = namedtuple('command_msg', 'id name args')
+
+###############################################################################
+##
+#   Printer to model.  Answers a command_msg once the command is finished,
+#   or once it has been acted on for commands sent during a print.
+#
+#   id      id of the command_msg
+#   ok      False when the printer did not know the command
+#   error   Why the command failed, None if it did not
+##
+###############################################################################
+reply_msg = namedtuple('reply_msg', 'id ok error')
+
+###############################################################################
+##
+#   Printer to model.  The status shown on the web pages.
+#
+#   title   Headline status, "SHUTDOWN" once the printer process has stopped
+#   sub     Details as text
+#   details Dictionary with the layer, layers, eta and phase of a print
+##
+###############################################################################
+status_msg = namedtuple('status_msg', 'title sub details')
+
+# Title of the status_msg the printer sends as its last message
+SHUTDOWN_TITLE = "SHUTDOWN"
@@ -13,25 +13,59 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from multiprocessing import Process, Pipe
-from subprocess import call
+from multiprocessing import Process, Pipe, cpu_count
+import itertools
 import threading
+import zipfile
 import printer
+from messages import command_msg, reply_msg, status_msg, SHUTDOWN_TITLE
+from slicepack import ARCHIVE_EXTENSION, ZIP_EXTENSION, open_archive, close_archive
+from sliceindex import get_index
+from upload import UploadError
 import time
 import os
 import re
 
+# Indexing leaves a CPU to the printer process
+INDEX_PROCESSES = max(1, cpu_count() - 1)
+
+# Settings kept from one run to the next, in the working directory
+VARIABLES_FILE = "printer_variables.txt"
+
 class model(threading.Thread):
     def __init__(self):
         super(model, self).__init__()
         self.running = True
+
+        # Guards the state below, shared with the server's request threads.
+        # It is only held to read or change that state, never across file
+        # work or the printer pipe, so status readers are not held up.
+        self.lock = threading.RLock()
+
+        # Sends on the printer pipe one at a time
+        self.send_lock = threading.Lock()
+
+        # Writes the saved variables one at a time
+        self.save_lock = threading.Lock()
+
+        # Signalled whenever anything shown on the status page changes
+        self.status_changed = threading.Condition(self.lock)
+        self.status_version = 0
+
         self.title_status = "Awaiting printer status"
         self.sub_status = ""
+        self.status_details = {}
 
         self.is_printing = False
-        self.printer_received_cmd = False
         self.is_paused = False
 
+        # Commands sent to the printer and not yet answered, by id
+        self.command_ids = itertools.count(1)
+        self.pending_commands = {}
+
+        # (bytes received, bytes total) of the upload in progress, or None
+        self.upload_status = None
+
         self.type_dict_regex = {
         "float":"([0-9]+\.?[0-9]+?)",
         "int":"([0-9]+)"
@@ -52,6 +86,12 @@ class model(threading.Thread):
         self.load_printer_variables()
 
         self.object_paths = []
+
+        # Slice index of each object, by path, once it is built
+        self.object_indexes = {}
+        self.index_thread = None
+        self.reindex = False
+
         self.refresh_list()
 
         self.printer_conn, child_conn = Pipe()
@@ -62,15 +102,17 @@ class model(threading.Thread):
     def run(self):
         try:
             while self.running:
-                if self.printer_conn.poll():
-                    self.title_status, self.sub_status = self.printer_conn.recv()
-                if self.title_status == "SHUTDOWN":
-                    self.shutdown()
-                if self.title_status == "Ready" and self.printer_received_cmd:
-                    self.is_printing = False
-                if self.title_status != "Ready":
-                    self.printer_received_cmd = True
-                time.sleep(0.5)
+                # Sleeps until the printer has something to say
+                message = self.printer_conn.recv()
+
+                with self.lock:
+                    if isinstance(message, reply_msg):
+                        self.command_replied(message)
+                    elif isinstance(message, status_msg):
+                        self.title_status, self.sub_status, self.status_details = message
+                        if self.title_status == SHUTDOWN_TITLE:
+                            self.shutdown()
+                    self.notify_status()
         except:
             pass
         printer.shutdown()
@@ -79,42 +121,78 @@ class model(threading.Thread):
     def refresh_list(self):
         folder_listing = os.listdir(os.getcwd())
 
-        self.object_paths = []
+        object_paths = []
 
         for listing in folder_listing:
-            if re.match(".+\.slice$",listing):
-                self.object_paths.append(listing)
+            if re.match(".+\.slice$",listing) or listing.endswith(ARCHIVE_EXTENSION):
+                object_paths.append(listing)
+            elif listing.endswith(ZIP_EXTENSION):
+                try:
+                    object_paths.extend(open_archive(listing).object_paths())
+                except zipfile.BadZipfile:
+                    pass
 
-    def send_command(self, command):
-        # Save any variables coming from the command
-        for some_var, default_val, var_type in self.saved_variables:
-            if some_var in command:
-                if re.match(self.type_dict_regex[var_type]+"$", command[some_var]) != None:
-                    exec("self.{0} = {1}(command['{0}'])".format(some_var,var_type))
-                else:
-                    # Argument is invalid, do not execute!
+        # New or changed objects are indexed in the background
+        with self.lock:
+            self.object_paths = object_paths
+            self.reindex = True
+            if self.index_thread is None:
+                self.index_thread = threading.Thread(target=self.index_objects, name="index")
+                self.index_thread.daemon = True
+                self.index_thread.start()
+
+    def index_objects(self):
+        while True:
+            with self.lock:
+                if not self.reindex:
+                    self.index_thread = None
                     return
-                    
-        self.save_printer_variables()
+                self.reindex = False
+                object_paths = list(self.object_paths)
+
+            # Indexes that are up to date are only read
+            for object_path in object_paths:
+                try:
+                    index = get_index(object_path, INDEX_PROCESSES)
+                except Exception:
+                    index = None
+
+                with self.lock:
+                    self.object_indexes[object_path] = index
+                    self.notify_status()
 
-        if command["command"] == "calibration":
-            self.is_printing = True
-            self.printer_received_cmd = False
+    def send_command(self, command):
+        # Commands come from several server threads at once
+        with self.lock:
+            # Save any variables coming from the command
+            for some_var, default_val, var_type in self.saved_variables:
+                if some_var in command:
+                    if re.match(self.type_dict_regex[var_type]+"$", command[some_var]) != None:
+                        exec("self.{0} = {1}(command['{0}'])".format(some_var,var_type))
+                    else:
+                        # Argument is invalid, do not execute!
+                        return
 
-        if command["command"] == "print_object":
-            command["object_path"] = os.getcwd() + '/' + command["object_path"]
-            self.is_printing = True
-            self.printer_received_cmd = False
+            if command["command"] == "calibration":
+                self.is_printing = True
 
-        if command["command"] == "Pause":
-            self.is_paused = True
+            if command["command"] == "print_object":
+                command["object_path"] = os.getcwd() + '/' + command["object_path"]
+                self.is_printing = True
 
-        if command["command"] == "Unpause":
-            self.is_paused = False
+            if command["command"] == "Pause":
+                self.is_paused = True
+
+            if command["command"] == "Unpause":
+                self.is_paused = False
+
+            if command["command"] == "Abort":
+                self.is_printing = False
+
+            self.notify_status()
+
+        self.save_printer_variables()
 
-        if command["command"] == "Abort":
-            self.is_printing = False
-        
         if command["command"] == "refresh_list":
             self.refresh_list()
         elif command["command"] == ["upload"]:
@@ -122,27 +200,158 @@ class model(threading.Thread):
             command["command"].pop()
             self.upload(command)
         else:
-            self.printer_conn.send(command)
+            name = command.pop("command")
+            self.send_printer(name, command)
+
+    ###########################################################################
+    ##
+    #   Sends a command to the printer process
+    #
+    #   @param  name    Command for the printer
+    #   @param  args    Dictionary of arguments for the command
+    #   @return id the printer's reply will carry
+    ##
+    ###########################################################################
+    def send_printer(self, name, args):
+        with self.lock:
+            command_id = next(self.command_ids)
+            self.pending_commands[command_id] = name
+
+        with self.send_lock:
+            self.printer_conn.send(command_msg(command_id, name, args))
+        return command_id
+
+    ###########################################################################
+    ##
+    #   Matches a reply from the printer to the command it answers
+    ##
+    ###########################################################################
+    def command_replied(self, reply):
+        name = self.pending_commands.pop(reply.id, None)
+        if not reply.ok:
+            print "Printer refused {:s}: {:s}".format(name, reply.error)
+
+            # Nothing was paused
+            if name == "Pause":
+                self.is_paused = False
+
+        # A print is over once its command has been answered
+        if name in ("print_object", "calibration"):
+            self.is_printing = False
+            self.is_paused = False
+
+    def get_status(self):
+        with self.lock:
+            return self.title_status, self.sub_status, self.upload_status
+
+    def notify_status(self):
+        with self.lock:
+            self.status_version += 1
+            self.status_changed.notify_all()
+
+    def status_snapshot(self):
+        with self.lock:
+            snapshot = dict(self.status_details)
+            snapshot.update(version=self.status_version,
+                            title=self.title_status,
+                            sub=self.sub_status,
+                            upload=self.upload_status,
+                            printing=self.is_printing,
+                            paused=self.is_paused)
+            return snapshot
+
+    def wait_status(self, since, timeout):
+        """Blocks until the status is newer than version since, or timeout
+
+        Returns the status snapshot either way.
+        """
+        end_time = time.time() + timeout
+        with self.lock:
+            while self.status_version <= since and self.running:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+                self.status_changed.wait(remaining)
+            return self.status_snapshot()
 
     def shutdown(self):
+        with self.lock:
+            self.is_printing = False
+
+            # The printer answers with SHUTDOWN, which wakes up run()
+            tell_printer = self.running and self.title_status != SHUTDOWN_TITLE
+
+            self.running = False
+            self.notify_status()
+
         self.save_printer_variables()
-        self.is_printing = False
-        self.running = False
 
+        if tell_printer:
+            try:
+                self.send_printer("shutdown", {})
+            except IOError:
+                pass
+
+    def report_upload(self, received, total):
+        with self.lock:
+            if self.upload_status:
+                last_percent = 100 * self.upload_status[0] / max(self.upload_status[1], 1)
+            else:
+                last_percent = -1
+            self.upload_status = (received, total)
+
+            # Only whole percents are worth pushing to the browsers
+            if 100 * received / max(total, 1) != last_percent:
+                self.notify_status()
+
+    def end_upload(self):
+        with self.lock:
+            self.upload_status = None
+            self.notify_status()
+
+    ###########################################################################
+    ##
+    #   Keeps an uploaded zip of slices, once the server has it on disk.  A
+    #   zip that cannot be kept is removed and UploadError raised.
+    #
+    #   @param  command     Form fields, with the path of the zip in datafile
+    ##
+    ###########################################################################
     def upload(self, command):
-        f = open("temp.zip",'w')
-        f.write(command["datafile"][0])
-        f.close()
+        # The server has already streamed the zip to disk
+        upload_path = command["datafile"][0]
+        self.end_upload()
+
+        # Slices are printed straight from the zip, so it is only kept, and
+        # named after the first object in it
+        try:
+            objects = zipfile.ZipFile(upload_path).namelist()
+        except zipfile.BadZipfile:
+            os.remove(upload_path)
+            raise UploadError("The upload is not a zip file")
+
+        name = "upload"
+        for member in objects:
+            if re.match(".+\.slice/", member):
+                name = member.split('/')[0]
+                break
 
-        call(["unzip","-o","temp.zip"])
+        # The zip is kept in the working directory, whatever its members say
+        if name != os.path.basename(name) or name in (os.curdir, os.pardir) or '\\' in name:
+            os.remove(upload_path)
+            raise UploadError("Bad object name in the zip: " + name)
 
-        call(["rm", "temp.zip"])
+        close_archive(name + ZIP_EXTENSION)
+        os.rename(upload_path, name + ZIP_EXTENSION)
+
+        # Builds the index of slices from the central directory
+        open_archive(name + ZIP_EXTENSION)
 
         self.refresh_list()
 
     def load_printer_variables(self):
         try:
-            f = open('printer_variables.txt')
+            f = open(VARIABLES_FILE)
             all_var = f.read()
             f.close()
         except:
@@ -154,11 +363,25 @@ class model(threading.Thread):
             if check_search != None:
                 exec("self.{0}={1}({2})".format(some_var, var_type, check_search.group(1)))
 
+    ###########################################################################
+    ##
+    #   Saves the variables as they are now.  They are read under the model
+    #   lock, then written to a temporary file that replaces the old one, so
+    #   a reader never finds the file half written.
+    ##
+    ###########################################################################
     def save_printer_variables(self):
-        try:
-            f = open('printer_variables.txt','w')
-            for some_var, default_val, var_type in self.saved_variables:
-                f.write("{0}: {1}\r\n".format(some_var, str(eval("self."+some_var))))
-            f.close()
-        except:
-            pass
+        with self.lock:
+            lines = ["{0}: {1}\r\n".format(some_var, str(getattr(self, some_var)))
+                     for some_var, default_val, var_type in self.saved_variables]
+
+        with self.save_lock:
+            try:
+                f = open(VARIABLES_FILE + ".tmp", 'w')
+                try:
+                    f.writelines(lines)
+                finally:
+                    f.close()
+                os.rename(VARIABLES_FILE + ".tmp", VARIABLES_FILE)
+            except (IOError, OSError) as e:
+                print "Could not save {:s}: {:s}".format(VARIABLES_FILE, str(e))
@@ -13,7 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, time, sys, inspect, traceback, re
+import os, time, sys, inspect, traceback, threading, Queue
 
 ###############################################################################
 #
@@ -22,13 +22,37 @@ import os, time, sys, inspect, traceback, re
 ###############################################################################
 SERVER_TEST = False
 
-if SERVER_TEST:
+###############################################################################
+#
+#   Set simulate to True to run prints on a simulated lift and projector with
+#   a virtual clock.  Each print writes its timeline to timeline.csv.
+#
+###############################################################################
+SIMULATE = False
+
+if SIMULATE:
+    from simulator import BED_servo, projector
+    import simulator
+    simulator.install()
+elif SERVER_TEST:
     from servo_test import BED_servo
     from projector_test import projector
 else:
     from servo import BED_servo
+    from stepper import stepper_process
     from projector import projector
 
+import motion
+from slicepack import open_slices
+from motion import cancel_token
+from telemetry import span_log, PEEL_SEGMENTS, TELEMETRY_FILE
+from eta import estimator, plan_print
+from exposure import exposure_scheduler
+from schedule import load_schedule, save_schedule, schedule_path, ADAPTED_NAME
+from peeling import peel_policy, format_counts
+from sliceindex import get_index
+from messages import command_msg, reply_msg, status_msg, SHUTDOWN_TITLE
+
 # CONSTANTS ####################################################################
 
 SERVO_ENABLE    = 40
@@ -45,6 +69,17 @@ Z_DISTANCE_PER_STEP     = 0.439453125 # microns
 LIFT_LENGTH             = 103000    # microns
 OPTIMUM_LIFT_SPEED      = 5280      # microns/s
 
+# Motion profile for the long lift moves (homing, approaching the resin)
+CRUISE_LIFT_SPEED       = 8000      # microns/s
+LIFT_ACCELERATION       = 20000     # microns/s^2
+LIFT_JERK               = 200000    # microns/s^3, None for trapezoidal
+
+# Step pulses come from a process of their own, see stepper.py
+STEPPER_PROCESS         = True
+STEPPER_CPU             = 3         # CPU to pin it to, best kept free with isolcpus=3
+STEPPER_PRIORITY        = 50        # SCHED_FIFO priority once pinned, None for the normal scheduler
+STEPPER_LOCK_MEMORY     = True
+
 # Resin vat maintenance
 RESIN_TOP               = 25400     # microns
 LIFT_PLATE_THICKNESS    = 5000      # microns
@@ -64,17 +99,22 @@ else:
 SLOW_DIP_SPEED          = 20        # microns/s
 SLOW_DIP_DIST           = 1000      # microns
 
+# Peel small layers lighter, see peeling.py
+ADAPTIVE_PEEL           = True
+
 # Exposure controls
 SLICE_DISPLAY_TIME      = 18.0      # seconds
 SLICE_THICKNESS         = 100       # microns
+PREFETCH_DEPTH          = 1         # slices prepared ahead of the exposing one
 
 FIRST_SLICE_TIME_FACTOR = 2.5       # multiplier of slice display time
+FIRST_SLICE_NUM         = 3         # layers exposed FIRST_SLICE_TIME_FACTOR longer
 FIRST_SLICE_THICKNESS   = SLICE_THICKNESS               # microns
 
 SLICE_DIRECTIONS        = [
     #slice              method      display_time_factor
     [0,                 "dip",      FIRST_SLICE_TIME_FACTOR     ],
-    [3,                 "dip",      1.0                         ],
+    [FIRST_SLICE_NUM,   "dip",      1.0                         ],
 ]
 
 
@@ -85,8 +125,34 @@ IS_RUNNING = True
 ABORT_PRINT = False
 SERVER_CONN = None
 
+# Last [title, sub status, details] sent to the server
+STATUS = ["", "", {}]
+
+# Commands that act on a print while it runs, rather than waiting for it
+INTERRUPT_COMMANDS = ("Abort", "Pause", "Unpause", "shutdown")
+
+# Commands that start a print, and take interrupts from when they are queued
+PRINT_COMMANDS = ("print_object", "calibration")
+
+PRINTING = False
+COMMANDS = Queue.Queue()        # Commands for the main loop, from listen_server
+CANCEL = cancel_token()         # Stops the lift and exposures mid-layer
+RESUME = threading.Event()      # Set by Unpause, or Abort, while paused
+SEND_LOCK = threading.Lock()    # Both threads send on the same pipe
+PAUSED_TIME = 0.0               # Seconds the current print has spent paused
+
 DISPLAY = projector()
-LIFT = BED_servo(Z_DISTANCE_PER_STEP)
+if STEPPER_PROCESS and not (SIMULATE or SERVER_TEST):
+    LIFT = stepper_process(Z_DISTANCE_PER_STEP, STEPPER_CPU, STEPPER_PRIORITY, STEPPER_LOCK_MEMORY)
+else:
+    LIFT = BED_servo(Z_DISTANCE_PER_STEP)
+
+# Phase timings of the current print, written to TELEMETRY_FILE
+TELEMETRY = span_log()
+DISPLAY.telemetry = TELEMETRY
+
+# Times each exposure from the display update that shows it
+EXPOSURES = exposure_scheduler(DISPLAY, TELEMETRY)
 
 
 def run(conn):
@@ -99,6 +165,10 @@ def run(conn):
     # Keep the servo running cool
     LIFT.off()
 
+    listener = threading.Thread(target=listen_server)
+    listener.daemon = True
+    listener.start()
+
     module_functions = {}
     items = inspect.getmembers(sys.modules[__name__], inspect.isfunction)
     for item in items:
@@ -108,19 +178,87 @@ def run(conn):
 
     try:
         while IS_RUNNING:
-            if SERVER_CONN.poll():
-                command_list = SERVER_CONN.recv()
-                command = command_list.pop("command").replace('+','_').lower()
-                if command in module_functions:
-                    if len(command_list) > 0:
-                        module_functions[command](command_list)
-                    else:
-                        module_functions[command]()
+            # Sleeps until the listener passes on a command
+            message = COMMANDS.get()
+            command = message.name.replace('+','_').lower()
+            if command in module_functions:
+                if len(message.args) > 0:
+                    module_functions[command](message.args)
+                else:
+                    module_functions[command]()
+                send_server(reply_msg(message.id, True, None))
+            else:
+                send_server(reply_msg(message.id, False, "Unknown command " + message.name))
+            if IS_RUNNING:
                 update_status("Ready","")
-            time.sleep(0.5)
     except:
-        shutdown()
-        SERVER_CONN.send(["SHUTDOWN", None])
+        traceback.print_exception(*sys.exc_info())
+
+    shutdown()
+    send_server(status_msg(SHUTDOWN_TITLE, "", {}))
+
+###############################################################################
+##
+#   Reads commands from the server on a thread of its own, so Abort and Pause
+#   reach a running print straight away.  They stop the lift and the exposure
+#   through CANCEL, everything else is queued for the main loop, or refused
+#   while printing.  Outside a print they are refused, so they never stop a
+#   home or lift move.
+##
+###############################################################################
+def listen_server():
+    while True:
+        try:
+            message = SERVER_CONN.recv()
+        except (EOFError, IOError):
+            message = command_msg(0, "shutdown", {})
+
+        if PRINTING and message.name in INTERRUPT_COMMANDS:
+            interrupt_print(message.name)
+            if message.name != "shutdown":
+                send_server(reply_msg(message.id, True, None))
+                continue
+        elif PRINTING:
+            send_server(reply_msg(message.id, False, "Busy printing"))
+            continue
+        elif message.name in INTERRUPT_COMMANDS and message.name != "shutdown":
+            # Only a print can be interrupted
+            send_server(reply_msg(message.id, False, "Not printing"))
+            continue
+        elif message.name in PRINT_COMMANDS:
+            arm_print()
+
+        COMMANDS.put(message)
+        if message.name == "shutdown":
+            return
+
+###############################################################################
+##
+#   Acts on an interrupt command, from the listener thread.  The main thread
+#   notices CANCEL within a step pulse, or CANCEL_POLL_INTERVAL of an
+#   exposure, and blanks the projector itself.
+##
+###############################################################################
+def interrupt_print(command):
+    global ABORT_PRINT
+    global IS_RUNNING
+
+    if command == "Pause":
+        CANCEL.cancel(command)
+    elif command == "Unpause":
+        if CANCEL.cancelled:
+            RESUME.set()
+    else:
+        # Abort and shutdown both end the print, shutdown then ends the process
+        ABORT_PRINT = True
+        if command == "shutdown":
+            IS_RUNNING = False
+        CANCEL.cancel(command)
+        RESUME.set()
+
+def send_server(message):
+    with SEND_LOCK:
+        SERVER_CONN.send(message)
 
 def lift_move(args):
     update_status("Lift moving %s" % (args['dir']), "%d microns at %d microns/s" % (int(args['lift_amount']),int(args['lift_speed'])))
@@ -130,7 +268,7 @@ def lift_move(args):
     amount = float(args['lift_amount'])
     if args['dir'] == "Up":
         amount = -amount
-    LIFT.move_microns(amount, float(args['lift_speed']))
+    LIFT.move_microns(amount, float(args['lift_speed']), LIFT_ACCELERATION, LIFT_JERK)
 
     LIFT.off()
 
@@ -143,141 +281,318 @@ def focus():
 def home():
     update_status("Home","")
     LIFT.on()
-    LIFT.home(OPTIMUM_LIFT_SPEED)
+    LIFT.home(CRUISE_LIFT_SPEED, LIFT_ACCELERATION, LIFT_JERK)
     LIFT.off()
 
 def reset_zero():
     LIFT.reset_home()
 
 def print_object(args):
-    global ABORT_PRINT
-    num_slices = 0
-
-    ABORT_PRINT = False
+    start_print()
+    TELEMETRY.start()
     update_status("Printing", "Starting " + args['object_path'])
 
     try:
-        # Path not passed correctly
-        if os.path.isdir(args['object_path']):
-            object_path = args['object_path']
-        else:
-            return
-            
+        object_path = args['object_path']
         exposure_time = float(args['exposure_time'])
 
-        # Look for slices
-        for objs in os.listdir(object_path):
-            total_path = object_path+"/"+objs
-
-            slice_match = re.match("(.+?)[0-9]+\.png", total_path)
-            if slice_match:
-                num_slices += 1
-                slice_prefix = slice_match.group(1)
-
-        if not slice_prefix:
+        # Look for slices, also catches the path not passed correctly
+        slices = open_slices(object_path)
+        if not slices:
             print "Missing slices!"
-            exit()
+            return
+
+        num_slices = slices.num_slices
 
-        print "Image path prefix: " + slice_prefix
+        print "Slices: " + object_path
         print "Found {:d} slice images.".format(num_slices)
 
+        # Normally built when the job was uploaded, see model.index_objects
+        index = get_index(object_path)
+        if index.errors():
+            print "\n".join(index.errors())
+            return
+
         LIFT.on()
 
-        slice_stats = expand_slice_directions(num_slices)
-        start_time = time.time()
+        schedule = load_schedule(object_path, SLICE_DIRECTIONS, num_slices)
+        if not os.path.isfile(schedule_path(object_path)):
+            save_schedule(schedule, object_path)
 
-        layer = 0
-        while layer < num_slices and ABORT_PRINT == False:
+        if ADAPTIVE_PEEL:
+            counts = peel_policy(RESIN_SETTLE, FIRST_SLICE_NUM).adapt(schedule, index.stats())
+            print "Adapted peels: " + format_counts(counts)
+            save_schedule(schedule, object_path, ADAPTED_NAME)
 
-            # Update status
-            if (layer > 0):
-                delta = time.time() - start_time
-                time_remain = ((num_slices+0.0)/layer - 1.0)*(delta)
-                time_remain_str = time.strftime('%H:%M:%S', time.gmtime(time_remain))
-                update_status("Printing", "{:s}<br>Layer {:d} of {:d}. {:s} Remaining.".format(object_path, layer, num_slices, time_remain_str))
+        start_time = motion.monotonic()
 
-            method, display_time_factor = slice_stats[layer]
-            display_time = display_time_factor * exposure_time
+        # Measured phases correct the plan as the print goes
+        eta = plan_eta(schedule, exposure_time)
+        TELEMETRY.listeners[:] = [eta.measure]
 
-            slice_image = slice_prefix+"{:04d}.png".format(layer)
+        # Layer being printed, with its monotonic() start and PAUSED_TIME then
+        current = [0, 0.0, 0.0]
 
-            if method == "dip":
+        def start_layer(layer):
+            current[:] = [layer, motion.monotonic(), PAUSED_TIME]
+            TELEMETRY.layer = layer
 
-                DISPLAY.black()
+            # Status and logging run on the log thread, alongside the peel
+            if (layer > 0):
+                TELEMETRY.defer(report_layer, object_path, layer, num_slices, eta)
 
-                LIFT.move_microns(DIP_DISTANCE, DIP_SPEED_DOWN)
-                time.sleep(DIP_WAIT)
-                LIFT.move_microns(-DIP_DISTANCE+SLICE_THICKNESS, DIP_SPEED_UP)
+            DISPLAY.prefetch([slices.layer_path(j) for j in xrange(layer, min(layer+PREFETCH_DEPTH+1, num_slices))])
 
-                time.sleep(RESIN_SETTLE)
+        def finish_layer():
+            layer, layer_start, layer_paused = current
+            TELEMETRY.defer(eta.layer_done, layer, motion.monotonic() - layer_start - (PAUSED_TIME - layer_paused))
 
-                DISPLAY.display(slice_image)
-                time.sleep(display_time)
+        layer = 0
+        while layer < num_slices and ABORT_PRINT == False:
+            start_layer(layer)
 
-            elif method == "cont":
-                DISPLAY.display(slice_image)
-                LIFT.move_microns(SLICE_THICKNESS, SLICE_THICKNESS / display_time)
+            method = schedule[layer].method
+            peel, display_time, thickness = layer_plan(schedule[layer], exposure_time)
 
-            elif method == "bottom":
-                DISPLAY.display(slice_image)
-                time.sleep(display_time)
+            slice_image = slices.layer_path(layer)
 
-            elif method == "slow dip":
-                DISPLAY.black()
+            if method == "dip" or method == "slow dip":
+                if peel_layer(args, peel):
+                    expose(args, slice_image, display_time)
 
-                LIFT.move_microns(SLOW_DIP_DIST, SLOW_DIP_SPEED)
-                time.sleep(DIP_WAIT)
-                LIFT.move_microns(-SLOW_DIP_DIST+SLICE_THICKNESS, SLOW_DIP_SPEED)
+            elif method == "cont":
+                # The lift streams through the whole run of "cont" layers
+                run = [(slice_image, thickness, display_time)]
+                while layer + len(run) < num_slices and schedule[layer + len(run)].method == "cont":
+                    peel, display_time, thickness = layer_plan(schedule[layer + len(run)], exposure_time)
+                    run.append((slices.layer_path(layer + len(run)), thickness, display_time))
+
+                def next_layer(i, first=layer):
+                    finish_layer()
+                    start_layer(first + i)
 
-                time.sleep(RESIN_SETTLE)
+                expose_stream(args, run, next_layer)
+                layer = current[0]
 
-                DISPLAY.display(slice_image)
-                time.sleep(display_time)
+            elif method == "bottom":
+                expose(args, slice_image, display_time)
 
-            poll_server_command(args)
+            finish_layer()
             layer += 1
 
-        print "Print completed in " + time.strftime('%H:%M:%S', time.gmtime(time.time()-start_time))
+        print "Print completed in " + time.strftime('%H:%M:%S', time.gmtime(motion.monotonic()-start_time))
     except:
         traceback.print_exception(*sys.exc_info())
         shutdown()
-        SERVER_CONN.send(["SHUTDOWN", None])
     finally:
         # End must also work for abort case
-        DISPLAY.black()
-        LIFT.home(OPTIMUM_LIFT_SPEED)
-        LIFT.off()
+        end_print()
+
+        TELEMETRY.stop()
+        print TELEMETRY.summary()
+        print EXPOSURES.summary()
+        print LIFT.jitter.summary()
+        print "Phase timings written to " + TELEMETRY_FILE
 
 
 
 
-def poll_server_command(args):
+###############################################################################
+##
+#   Readies the interrupt state for a print.  The listener calls this when it
+#   queues the print, so an Abort or Pause sent before the print starts is
+#   kept for it instead of being refused.
+##
+###############################################################################
+def arm_print():
+    global PRINTING
     global ABORT_PRINT
-    if SERVER_CONN.poll():
-        command_list = SERVER_CONN.recv()
-        if command_list['command']=="Abort":
-            ABORT_PRINT = True
-            return
-        elif command_list['command']=="Pause":
-            DISPLAY.black()
-            update_status("Paused",args['object_path'])
-            while True:
-                time.sleep(0.5)
-                if SERVER_CONN.poll():
-                    command_list = SERVER_CONN.recv()
-                    if command_list['command']=="Abort":
-                        ABORT_PRINT = True
-                        return
-                    elif command_list['command']=="Unpause":
-                        return
+
+    ABORT_PRINT = False
+    CANCEL.clear()
+    RESUME.clear()
+    PRINTING = True
+
+###############################################################################
+##
+#   Clears the records of the last print, as a print starts.  The lift only
+#   heeds CANCEL during a print.
+##
+###############################################################################
+def start_print():
+    global PRINTING
+    global PAUSED_TIME
+
+    PRINTING = True
+    PAUSED_TIME = 0.0
+    LIFT.cancel = CANCEL
+    EXPOSURES.clear()
+    LIFT.jitter.clear()
+
+    if SIMULATE:
+        simulator.CLOCK.clear()
+
+###############################################################################
+##
+#   Blanks the projector and brings the lift home at the end of a print,
+#   aborted or not
+##
+###############################################################################
+def end_print():
+    global PRINTING
+
+    PRINTING = False
+    DISPLAY.black()
+
+    # Homing must not be cut short by the abort that ended the print, or by
+    # one meant for the next print
+    LIFT.cancel = None
+    CANCEL.clear()
+    LIFT.home(CRUISE_LIFT_SPEED, LIFT_ACCELERATION, LIFT_JERK)
+    LIFT.off()
+
+    if SIMULATE:
+        simulator.save_timeline()
+        print simulator.summary()
+
+###############################################################################
+##
+#   Holds a print that was interrupted until it is resumed or aborted
+#
+#   @param  args    Arguments of the print, for the status
+#   @return False when the print was aborted
+##
+###############################################################################
+def wait_while_paused(args):
+    global PAUSED_TIME
+
+    DISPLAY.black()
+
+    # Status updates still queued must not land on top of the pause
+    TELEMETRY.drain()
+
+    if not ABORT_PRINT:
+        resumed_status = list(STATUS)
+        update_status("Paused", args['object_path'])
+        paused_at = motion.monotonic()
+        with TELEMETRY.span("paused"):
+            RESUME.wait()
+        PAUSED_TIME += motion.monotonic() - paused_at
+        if not ABORT_PRINT:
+            update_status(*resumed_status)
+
+    RESUME.clear()
+    if ABORT_PRINT:
+        return False
+
+    CANCEL.clear()
+    return True
+
+###############################################################################
+##
+#   Exposes an image, carrying on with the time left after a pause
+#
+#   @param  args        Arguments of the print, for the status
+#   @param  image       Path of the slice image
+#   @param  duration    Exposure time in seconds
+#   @return False when the print was aborted
+##
+###############################################################################
+def expose(args, image, duration):
+    while True:
+        TELEMETRY.defer(update_phase, "exposing")
+        duration = EXPOSURES.expose(image, duration, CANCEL)
+        if not CANCEL.cancelled:
+            return True
+
+        if not wait_while_paused(args):
+            return False
+
+###############################################################################
+##
+#   Exposes a run of "cont" layers while the lift streams through them.  A
+#   pause stops the lift, and on resuming the layer it stopped in is
+#   finished at its own speed before the rest of the run.
+#
+#   @param  args        Arguments of the print, for the status
+#   @param  layers      List of (image path, thickness, seconds) for each
+#                       layer, see exposure_scheduler.expose_stream
+#   @param  started     Function called with the index in layers of each
+#                       layer after the first, as it starts
+#   @return False when the print was aborted
+##
+###############################################################################
+def expose_stream(args, layers, started):
+    first = 0
+
+    while True:
+        TELEMETRY.defer(update_phase, "exposing")
+        start = LIFT.get_location_microns()
+        finished = EXPOSURES.expose_stream(LIFT, layers, CANCEL, lambda i: started(first + i))
+        if not CANCEL.cancelled:
+            return True
+
+        # What is left of the layer the lift stopped in
+        image, thickness, duration = layers[finished]
+        end = start + sum(layer[1] for layer in layers[:finished + 1])
+        left = end - LIFT.get_location_microns()
+        if left < LIFT.microns_per_step:
+            layers = layers[finished + 1:]
+            first += finished + 1
+        else:
+            layers = [(image, left, duration * left / thickness)] + layers[finished + 1:]
+            first += finished
+
+        if not wait_while_paused(args):
+            return False
+
+        if not layers:
+            return True
+        if left < LIFT.microns_per_step:
+            started(first)
+
+###############################################################################
+##
+#   Peels the part off the vat floor ready for the next layer.  A peel that
+#   was paused is run again from the top, once the lift is back where the
+#   peel started.  The way back goes no faster than the peel itself, as the
+#   lift may be pulling the part out of the resin.
+#
+#   @param  args    Arguments of the print, for the status
+#   @param  peel    Arguments of BED_servo.peel, see layer_plan
+#   @return False when the print was aborted
+##
+###############################################################################
+def peel_layer(args, peel):
+    start = LIFT.get_location_microns()
+
+    while True:
+        DISPLAY.black()
+        TELEMETRY.defer(update_phase, "peel")
+
+        location = LIFT.get_location_microns()
+        if location != start:
+            # Up is toward the home location, at zero
+            if location > start:
+                speed = peel[3]
+            else:
+                speed = peel[2]
+            LIFT.move_to(start, speed, peel[6], peel[7])
+        if not CANCEL.cancelled:
+            peel_start = motion.monotonic()
+            TELEMETRY.record_moves(peel_start, LIFT.peel(*peel), PEEL_SEGMENTS)
+        if not CANCEL.cancelled:
+            return True
+
+        if not wait_while_paused(args):
+            return False
 
 
 
 def calibration(args):
-    global ABORT_PRINT
     num_slices = 0
 
-    ABORT_PRINT = False
+    start_print()
     update_status("Calibrating", "Starting...")
 
     try:
@@ -291,81 +606,132 @@ def calibration(args):
 
         LIFT.on()
 
-        start_time = time.time()
+        start_time = motion.monotonic()
 
         layer = 0
         while layer < num_slices and ABORT_PRINT == False:
 
             # Update status
             if (layer > 0):
-                delta = time.time() - start_time
+                delta = motion.monotonic() - start_time
                 time_remain = ((num_slices+0.0)/layer - 1.0)*(delta)
                 time_remain_str = time.strftime('%H:%M:%S', time.gmtime(time_remain))
-                update_status("Calibrating", "{:s}<br>Layer {:d} of {:d}. {:s} Remaining.".format(object_path, layer, num_slices, time_remain_str))
-
-            LIFT.move_microns(DIP_DISTANCE, DIP_SPEED_DOWN)
-            time.sleep(DIP_WAIT)
-            LIFT.move_microns(-DIP_DISTANCE+SLICE_THICKNESS, DIP_SPEED_UP)
-            time.sleep(RESIN_SETTLE)
+                update_status("Calibrating", "{:s}<br>Layer {:d} of {:d}. {:s} Remaining.".format(object_path, layer, num_slices, time_remain_str),
+                              {"layer": layer, "layers": num_slices, "eta": time_remain})
 
-            DISPLAY.display(slice_prefix+"0000.png")
-
-            if layer < 3:
-                time.sleep(cali_min_time * FIRST_SLICE_TIME_FACTOR)
+            if layer < FIRST_SLICE_NUM:
+                time_factor = FIRST_SLICE_TIME_FACTOR
             else:
-                time.sleep(cali_min_time)
+                time_factor = 1.0
 
-            for j in xrange(1,9):
-                DISPLAY.display(slice_prefix+"{:04d}.png".format(j))
-                if layer < 3:
-                    time.sleep(cali_time_delta * FIRST_SLICE_TIME_FACTOR)
-                else:
-                    time.sleep(cali_time_delta)
+            if peel_layer(args, (DIP_DISTANCE, DIP_DISTANCE-SLICE_THICKNESS, DIP_SPEED_DOWN, DIP_SPEED_UP, DIP_WAIT, RESIN_SETTLE, LIFT_ACCELERATION, LIFT_JERK)):
+                if expose(args, slice_prefix+"0000.png", cali_min_time * time_factor):
+                    for j in xrange(1,9):
+                        if not expose(args, slice_prefix+"{:04d}.png".format(j), cali_time_delta * time_factor):
+                            break
 
             DISPLAY.black()
 
-            poll_server_command(args)
             layer += 1
 
-        print "Completed in " + time.strftime('%H:%M:%S', time.gmtime(time.time()-start_time))
+        print "Completed in " + time.strftime('%H:%M:%S', time.gmtime(motion.monotonic()-start_time))
     except:
         traceback.print_exception(*sys.exc_info())
         shutdown()
-        SERVER_CONN.send(["SHUTDOWN", None])
     finally:
         # End must also work for abort case
-        DISPLAY.black()
-        LIFT.home(OPTIMUM_LIFT_SPEED)
-        LIFT.off()
+        end_print()
 
 
 ###############################################################################
 ##
-#   Expands SLICE_DIRECTIONS to give explicit directions per slice, as
-#   SLICE_DIRECTIONS implies the same parameters are used between slices
+#   Fills in a layer's directions with the defaults
 #
-#   @return tuple with directions for every slice
+#   @param  layer_directive     schedule.directive of the layer
+#   @param  exposure_time       Exposure time of a normal layer in seconds
+#   @return tuple of (peel, display time, thickness).  The peel is the
+#           arguments of BED_servo.peel, or None if the layer has no peel.
 ##
 ###############################################################################
-def expand_slice_directions(num_slices):
-    global SLICE_DIRECTIONS
-
-    step = 0
-    slice_stats = []
+def layer_plan(layer_directive, exposure_time):
+    thickness = layer_directive.thickness or SLICE_THICKNESS
+    display_time = layer_directive.time * exposure_time
+
+    if layer_directive.method == "dip":
+        depth = layer_directive.dip_distance or DIP_DISTANCE
+        speed_down = layer_directive.dip_speed or DIP_SPEED_DOWN
+        speed_up = layer_directive.dip_speed or DIP_SPEED_UP
+    elif layer_directive.method == "slow dip":
+        depth = layer_directive.dip_distance or SLOW_DIP_DIST
+        speed_down = layer_directive.dip_speed or SLOW_DIP_SPEED
+        speed_up = speed_down
+    else:
+        return None, display_time, thickness
+
+    if layer_directive.settle is None:
+        settle = RESIN_SETTLE
+    else:
+        settle = layer_directive.settle
+
+    peel = (depth, depth-thickness, speed_down, speed_up, DIP_WAIT, settle, LIFT_ACCELERATION, LIFT_JERK)
+    return peel, display_time, thickness
 
-    for i in xrange(num_slices):
-        if step < len(SLICE_DIRECTIONS)-1:
-            if i == SLICE_DIRECTIONS[step + 1][0]:
-                step = step + 1
+###############################################################################
+##
+#   Plans the time each layer of a print will take
+#
+#   @param  schedule        schedule.slice_schedule of the print
+#   @param  exposure_time   Exposure time of a normal layer in seconds
+#   @return eta.estimator
+##
+###############################################################################
+def plan_eta(schedule, exposure_time):
+    layers = [layer_plan(schedule[i], exposure_time)[:2] for i in xrange(len(schedule))]
+    return estimator(plan_print(layers, Z_DISTANCE_PER_STEP))
 
-        slice_stats.append(SLICE_DIRECTIONS[step][1:])
 
-    return slice_stats
+###############################################################################
+##
+#   Sends the printer status to the server
+#
+#   @param  title_stat  Headline status
+#   @param  sub_stat    Details as text
+#   @param  details     Dictionary with the layer, layers, eta and phase of
+#                       a print, where they apply
+##
+###############################################################################
+def update_status(title_stat, sub_stat, details=None):
+    STATUS[:] = [title_stat, sub_stat, details or {}]
+    print title_stat, sub_stat
+    send_server(status_msg(*STATUS))
 
+###############################################################################
+##
+#   Sends the progress of a print
+#
+#   @param  object_path     Path of the object printing
+#   @param  layer           Layer about to be printed
+#   @param  num_slices      Number of layers in the print
+#   @param  eta             eta.estimator of the print
+##
+###############################################################################
+def report_layer(object_path, layer, num_slices, eta):
+    with TELEMETRY.span("status"):
+        time_remain = eta.remaining(layer)
+        time_remain_str = time.strftime('%H:%M:%S', time.gmtime(time_remain))
+        update_status("Printing", "{:s}<br>Layer {:d} of {:d}. {:s} Remaining.".format(object_path, layer, num_slices, time_remain_str),
+                      {"layer": layer, "layers": num_slices, "eta": time_remain})
 
-def update_status(title_stat, sub_stat):
-    print title_stat, sub_stat
-    SERVER_CONN.send([title_stat, sub_stat])
+###############################################################################
+##
+#   Updates only the phase of the current layer in the status
+#
+#   @param  phase   What the printer is doing, e.g. "peel" or "exposing"
+##
+###############################################################################
+def update_phase(phase):
+    STATUS[2] = dict(STATUS[2], phase=phase)
+    send_server(status_msg(*STATUS))
 
 def shutdown():
     global IS_RUNNING
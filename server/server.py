@@ -16,28 +16,79 @@
 import time
 import BaseHTTPServer
 import cgi
+import json
+import socket
+import threading
+import Queue
 
 import inspect
 import view
+import upload
 from model import model
 
 HOST_NAME = ''   # Normally a domain name. Blank still allows IP address URL
 PORT_NUMBER = 80 # TCP port
 
-def parse_url_args(args):
-    parsing = {}
-    data = args.split('&')
-    for couple in data:
-        name, value = couple.split('=')
-        parsing[name]=value
-    return parsing
+WORKER_THREADS = 16     # Requests served at once, 0 serves one at a time without keep-alive
+MAX_UPLOADS = 1         # Uploads received at once, others are turned away
+MAX_STATUS_WAITS = 8    # Event streams and long-polls held open at once
+KEEP_ALIVE_TIMEOUT = 5  # Seconds an idle connection holds on to a worker
+EVENT_KEEP_ALIVE = 15   # Seconds between comments on an idle event stream
+LONG_POLL_TIMEOUT = 25  # Seconds a long-poll waits for a status change
+
+UPLOAD_SLOTS = threading.BoundedSemaphore(MAX_UPLOADS)
+STATUS_WAIT_SLOTS = threading.BoundedSemaphore(MAX_STATUS_WAITS)
+
+class PooledHTTPServer(BaseHTTPServer.HTTPServer):
+    """HTTP server that hands requests to a fixed pool of worker threads.
+
+    Unlike SocketServer.ThreadingMixIn the number of threads is bounded, so a
+    burst of browsers cannot starve the printer of memory or CPU.
+    """
+
+    def __init__(self, server_address, handler_class, workers):
+        if workers < 1:
+            raise ValueError("A pooled server needs at least one worker")
+
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, handler_class)
+        self.requests = Queue.Queue()
+
+        for _ in xrange(workers):
+            worker = threading.Thread(target=self.serve_requests)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def serve_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
 
 
 class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
+    # Keep-alive, which needs a Content-Length on every response
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+
+    def send_page(self, page):
+        self.send_response(200)
+        self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
     def do_HEAD(self):
         self.send_response(200)
         self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def do_GET(self):
@@ -48,34 +99,141 @@ class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if self.path == '':
             self.path = 'index'
 
-        if self.path in VIEWS:
-            page = VIEWS[self.path]()
+        self.path, _, query = self.path.partition('?')
+        if self.path in ('events', 'poll'):
+            if not STATUS_WAIT_SLOTS.acquire(False):
+                self.send_error(503, "Too many status listeners")
+                return
+            try:
+                if self.path == 'events':
+                    self.send_events()
+                else:
+                    self.send_poll(upload.parse_url_args(query))
+            except socket.error:
+                # The browser went away
+                self.close_connection = 1
+            finally:
+                STATUS_WAIT_SLOTS.release()
+            return
 
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
-            self.wfile.write(page)
+        if self.path in VIEWS:
+            self.send_page(VIEWS[self.path]())
         else:
             self.send_error(404)
 
 
 
+    def send_events(self):
+        """Stream status changes as Server-Sent Events until the client leaves"""
+        self.send_response(200)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = 1
+
+        version = -1
+        while SYNC_MODEL.running:
+            snapshot = SYNC_MODEL.wait_status(version, EVENT_KEEP_ALIVE)
+            if snapshot['version'] == version:
+                self.wfile.write(": keep-alive\n\n")
+            else:
+                version = snapshot['version']
+                self.wfile.write("id: %d\ndata: %s\n\n" % (version, json.dumps(snapshot)))
+            self.wfile.flush()
+
+    def send_poll(self, args):
+        """Answer once the status is newer than the since argument"""
+        try:
+            since = int(args.get('since', -1))
+        except ValueError:
+            self.send_error(400, "since must be a status version")
+            return
+        page = json.dumps(SYNC_MODEL.wait_status(since, LONG_POLL_TIMEOUT))
+
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
     def do_POST(self):
         ctype, pdict = cgi.parse_header(self.headers['content-type'])
         if ctype == 'multipart/form-data':
-            postvars = cgi.parse_multipart(self.rfile, pdict)
+            if not UPLOAD_SLOTS.acquire(False):
+                self.send_error(503, "Another upload is in progress")
+                return
+            try:
+                length = int(self.headers['content-length'])
+                postvars = upload.parse_multipart(self.rfile, pdict, length, SYNC_MODEL.report_upload)
+            except upload.UploadError as e:
+                SYNC_MODEL.end_upload()
+                self.send_error(400, str(e))
+                return
+            finally:
+                UPLOAD_SLOTS.release()
         elif ctype == 'application/x-www-form-urlencoded':
             length = int(self.headers['content-length'])
-            postvars = parse_url_args(self.rfile.read(length))
+            postvars = upload.parse_url_args(self.rfile.read(length))
         else:
             postvars = {}
 
-        SYNC_MODEL.send_command(postvars)
+        try:
+            SYNC_MODEL.send_command(postvars)
+        except upload.UploadError as e:
+            self.send_error(400, str(e))
+            return
+
+        self.send_page(view.index())
+
+    def do_PUT(self):
+        """Receive a piece of a resumable upload to /upload/<name>.zip
+
+        A PUT with an empty body asks how much has been received.  Any other
+        PUT must carry a Content-Range starting at that offset.  This is for
+        scripted clients; the upload form posts the whole zip in one go.
+        """
+        name = self.path[len('/upload/'):]
+        if not self.path.startswith('/upload/') or not name.endswith('.zip'):
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('content-length', 0))
+        if length == 0:
+            received = upload.received_bytes(name)
+            total = received + 1
+        else:
+            if not UPLOAD_SLOTS.acquire(False):
+                self.send_error(503, "Another upload is in progress")
+                return
+            try:
+                received, total = upload.receive_range(self.rfile, name, self.headers.get('content-range'),
+                                                       length, SYNC_MODEL.report_upload)
+            except upload.UploadError as e:
+                self.send_error(416, str(e))
+                return
+            finally:
+                UPLOAD_SLOTS.release()
+
+        if received < total:
+            # Resume Incomplete, telling the client where to carry on from
+            self.send_response(308)
+            if received > 0:
+                self.send_header("Range", "bytes=0-%d" % (received - 1))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        try:
+            SYNC_MODEL.send_command({"command": ["upload"], "datafile": [upload.partial_path(name)]})
+        except upload.UploadError as e:
+            self.send_error(400, str(e))
+            return
 
         self.send_response(200)
-        self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", "0")
         self.end_headers()
-        self.wfile.write(view.index())
 
 if __name__ == '__main__':
     VIEWS = {}
@@ -91,8 +249,17 @@ if __name__ == '__main__':
     # Initialize the view
     view.load(SYNC_MODEL)
 
-    server_class = BaseHTTPServer.HTTPServer
-    httpd = server_class((HOST_NAME, PORT_NUMBER), MyHandler)
+    if WORKER_THREADS > 0:
+        httpd = PooledHTTPServer((HOST_NAME, PORT_NUMBER), MyHandler, WORKER_THREADS)
+    else:
+        # The only thread must not sit out KEEP_ALIVE_TIMEOUT on an idle
+        # connection, so every response closes its connection
+        MyHandler.protocol_version = "HTTP/1.0"
+        httpd = BaseHTTPServer.HTTPServer((HOST_NAME, PORT_NUMBER), MyHandler)
+
+    # Wake up now and then to notice the model shutting down
+    httpd.timeout = 1.0
+
     print time.asctime(), "Server Starts - %s:%s" % (HOST_NAME, PORT_NUMBER)
     try:
         while SYNC_MODEL.running:
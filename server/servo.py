@@ -17,6 +17,10 @@ import RPi.GPIO as GPIO
 from math import pi
 import time
 
+from motion import monotonic, wait_until, accelerated_profile, hold_profile, stopping_profile, move_report
+from motion import jitter_stats
+from motion import MIN_PULSE_WIDTH, MAX_STEP_RATE
+
 FULL_STEP      = [False, False, False, 1]
 HALF_STEP      = [True,  False, False, 2]
 QUARTER_STEP   = [False, True,  False, 4]
@@ -82,6 +86,13 @@ class BED_servo:
         self.reset()
 
         self.location = 0   # home position
+        self.last_move = None
+
+        # motion.cancel_token that stops moves early, or None
+        self.cancel = None
+
+        # How late every step pulse went out
+        self.jitter = jitter_stats()
 
 
     ###########################################################################
@@ -129,38 +140,204 @@ class BED_servo:
     #   @param  steps   Number of steps to move.  Negative rotates the opposite
     #                   direction.
     #   @param  speed   Rotation rate in steps per second. Defaults to 3200/sec.
+    #   @param  accel   Acceleration limit in steps per second^2.  None moves
+    #                   at a constant rate from the first step.
+    #   @param  jerk    Jerk limit in steps per second^3.  None gives a
+    #                   trapezoidal velocity profile, otherwise an S-curve.
+    #   @return move statistics, see motion.move_report
     ##
     ###########################################################################
-    def move(self, steps=3200, speed=3200):
+    def move(self, steps=3200, speed=3200, accel=None, jerk=None):
 
         delta_location = 1
 
-        # Pulses must be held up for at least a microsecond
-        if (speed > 1000000):
-            speed = 1000000
-
-        time_offset = 0.5/speed
+        if (speed > MAX_STEP_RATE):
+            speed = MAX_STEP_RATE
 
         if (steps < 0):
-            GPIO.output(self.dir_pin, False)
             steps = -steps
             delta_location = -1
-        else:
-            GPIO.output(self.dir_pin, True)
 
-        for _ in xrange(steps):
+        profile = accelerated_profile(steps, speed, accel, jerk)
+        return self.run_segments([["move", profile, delta_location]], accel)["move"]
+
+    ###########################################################################
+    ##
+    #   Runs a peel cycle as one planned sequence: down into the vat, dwell,
+    #   back up to leave one layer of resin, and settle.  The phases share a
+    #   single timeline, so there are no gaps from Python between them.
+    #
+    #   @param  depth       Distance, in microns, to move down
+    #   @param  rise        Distance, in microns, to move back up
+    #   @param  speed_down  Downward lift speed in microns per second
+    #   @param  speed_up    Upward lift speed in microns per second
+    #   @param  dwell       Seconds to wait at the bottom
+    #   @param  settle      Seconds to wait at the top for the resin to settle
+    #   @param  accel       Acceleration limit in microns per second^2
+    #   @param  jerk        Jerk limit in microns per second^3
+    #   @return dictionary of move statistics for the "down", "dwell", "up" and
+    #           "settle" phases
+    ##
+    ###########################################################################
+    def peel(self, depth, rise, speed_down, speed_up, dwell, settle, accel=None, jerk=None):
+        accel, jerk = self.microns_to_steps(accel, jerk)
+
+        down_steps = int(depth / self.microns_per_step)
+        up_steps = int(rise / self.microns_per_step)
+
+        return self.run_segments([
+            ["down",    accelerated_profile(down_steps, speed_down / self.microns_per_step, accel, jerk), 1],
+            ["dwell",   hold_profile(dwell), 0],
+            ["up",      accelerated_profile(up_steps, speed_up / self.microns_per_step, accel, jerk), -1],
+            ["settle",  hold_profile(settle), 0],
+        ], accel)
+
+    ###########################################################################
+    ##
+    #   Pulses the step pin on precomputed tables of step times.  Each pulse
+    #   is scheduled against one monotonic timeline for all the segments, so
+    #   timing errors do not accumulate.  A pulse that comes out later than
+    #   the gap to the next one shifts the rest of the timeline instead of
+    #   bursting to catch up, which would stall the motor.  The location is
+    #   updated once per segment.
+    #
+    #   When self.cancel is set part way, the lift decelerates to a stop at
+    #   stop_accel, within the segment, and the segments left are skipped.
+    #   Without stop_accel it stops at the next pulse.  The wait for a pulse
+    #   checks the cancel too, so a slow move stops within
+    #   CANCEL_POLL_INTERVAL rather than a whole step period.
+    #
+    #   @param  segments    List of [name, profile, delta_location].  The
+    #                       profile is from the motion module, delta_location
+    #                       is +1 or -1 for the direction, or 0 for a hold.
+    #   @param  stop_accel  Deceleration in steps per second^2 on cancel
+    #   @param  tracker     motion.step_tracker told when the steps pulsed
+    #                       across all the segments reach its marks, or None
+    #   @return dictionary of move statistics by segment name, see
+    #           motion.move_report
+    ##
+    ###########################################################################
+    def run_segments(self, segments, stop_accel=None, tracker=None):
+        cancel = self.cancel
+        jitter = self.jitter
+        reports = {}
+
+        # Steps pulsed before the current segment, and the next to report
+        moved = 0
+        next_mark = tracker.first_mark() if tracker else -1
+
+        start = monotonic()
+
+        for name, profile, delta_location in segments:
+            steps = len(profile) - 1
+            done = 0
+            max_late = 0.0
+            begin = monotonic()
+
+            if delta_location != 0:
+                GPIO.output(self.dir_pin, delta_location > 0)
+
+            try:
+                while done < steps:
+                    if cancel and cancel.cancelled:
+                        break
+
+                    late = wait_until(start + profile[done], cancel)
+                    if late < 0:
+                        break
+
+                    jitter.add(late)
+                    if late > max_late:
+                        max_late = late
+                    if late > profile[done + 1] - profile[done]:
+                        start += late
+
+                    self.pulse()
+                    done += 1
 
-            GPIO.output(self.step_pin, True)
-            end_time = time.time()+time_offset
-            while (time.time() < end_time):
-                pass
+                    if moved + done == next_mark:
+                        next_mark = tracker.reached()
 
-            self.location += delta_location
+                if cancel and cancel.cancelled:
+                    if done < steps and done > 1 and stop_accel:
+                        done += self.decelerate(start + profile[done - 1],
+                                                1.0 / (profile[done] - profile[done - 1]),
+                                                stop_accel, steps - done)
+                else:
+                    wait_until(start + profile[steps], cancel)
+            finally:
+                self.location += delta_location * done
+                reports[name] = move_report(steps, done, profile[steps], monotonic() - begin, max_late,
+                                            bool(cancel and cancel.cancelled))
+                if delta_location != 0:
+                    self.last_move = reports[name]
+                moved += done
 
-            GPIO.output(self.step_pin, False)
-            end_time = time.time()+time_offset
-            while (time.time() < end_time):
-                pass
+            if cancel and cancel.cancelled:
+                break
+
+            start += profile[steps]
+
+        return reports
+
+    ###########################################################################
+    ##
+    #   Moves up through stretches of constant speed as one move, with no
+    #   stops between them.  Each stretch ends at its exact step count,
+    #   rounded from the distance covered so far, so rounding never adds up.
+    #
+    #   @param  stretches   List of (distance in microns, speed in microns/s)
+    #   @param  tracker     motion.step_tracker told as the move reaches its
+    #                       marks, or None
+    #   @return dictionary of move statistics by stretch, "stretch 0" and on
+    ##
+    ###########################################################################
+    def stream(self, stretches, tracker=None):
+        segments = []
+        covered = 0.0
+        for distance, speed in stretches:
+            steps = int(round((covered + distance) / self.microns_per_step)) - int(round(covered / self.microns_per_step))
+            covered += distance
+            rate = min(speed / self.microns_per_step, MAX_STEP_RATE)
+            segments.append(["stretch {:d}".format(len(segments)), accelerated_profile(steps, rate), 1])
+
+        # Waiters must not be left hanging, however the move ends
+        try:
+            return self.run_segments(segments, tracker=tracker)
+        finally:
+            if tracker:
+                tracker.finish()
+
+    ###########################################################################
+    ##
+    #   Pulses the step pin once
+    ##
+    ###########################################################################
+    def pulse(self):
+        GPIO.output(self.step_pin, True)
+        pulse_end = monotonic() + MIN_PULSE_WIDTH
+        while monotonic() < pulse_end:
+            pass
+        GPIO.output(self.step_pin, False)
+
+    ###########################################################################
+    ##
+    #   Brings a cancelled move to a standstill
+    #
+    #   @param  last_pulse      monotonic() time of the last pulse of the move
+    #   @param  speed           Step rate of the move there in steps per second
+    #   @param  accel           Deceleration in steps per second^2
+    #   @param  limit           Steps left in the move, never overshot
+    #   @return number of steps pulsed
+    ##
+    ###########################################################################
+    def decelerate(self, last_pulse, speed, accel, limit):
+        profile = stopping_profile(speed, accel)
+        steps = min(len(profile) - 1, limit)
+        for n in xrange(steps):
+            wait_until(last_pulse + profile[n])
+            self.pulse()
+        return steps
 
     ###########################################################################
     ##
@@ -168,10 +345,13 @@ class BED_servo:
     #
     #   @param  distance    Distance, in microns, to move
     #   @param  speed       Lift speed in microns per second
+    #   @param  accel       Acceleration limit in microns per second^2
+    #   @param  jerk        Jerk limit in microns per second^3
     ##
     ###########################################################################
-    def move_microns(self, distance, speed):
-        self.move(int(distance / self.microns_per_step), speed / self.microns_per_step)
+    def move_microns(self, distance, speed, accel=None, jerk=None):
+        return self.move(int(distance / self.microns_per_step), speed / self.microns_per_step,
+                         *self.microns_to_steps(accel, jerk))
 
     ###########################################################################
     ##
@@ -179,21 +359,41 @@ class BED_servo:
     #
     #   @param  location    Location, in microns, to move to
     #   @param  speed       Lift speed in microns per second
+    #   @param  accel       Acceleration limit in microns per second^2
+    #   @param  jerk        Jerk limit in microns per second^3
     ##
     ###########################################################################
-    def move_to(self, location, speed):
-        steps = int(float(location) / self.microns_per_step) - self.location
-        self.move(steps, speed / self.microns_per_step)
+    def move_to(self, location, speed, accel=None, jerk=None):
+        steps = int(round(float(location) / self.microns_per_step)) - self.location
+        return self.move(steps, speed / self.microns_per_step, *self.microns_to_steps(accel, jerk))
 
     ###########################################################################
     ##
     #   Returns the servo to the home location
     #
     #   @param  speed   Lift speed in microns per second
+    #   @param  accel   Acceleration limit in microns per second^2
+    #   @param  jerk    Jerk limit in microns per second^3
+    ##
+    ###########################################################################
+    def home(self, speed, accel=None, jerk=None):
+        return self.move(-self.location, speed / self.microns_per_step, *self.microns_to_steps(accel, jerk))
+
+    ###########################################################################
+    ##
+    #   Converts acceleration and jerk limits from microns to steps
+    #
+    #   @param  accel   Acceleration limit in microns per second^2, or None
+    #   @param  jerk    Jerk limit in microns per second^3, or None
+    #   @return tuple of the limits in steps, keeping None as None
     ##
     ###########################################################################
-    def home(self, speed):
-        self.move(-self.location, speed / self.microns_per_step)
+    def microns_to_steps(self, accel, jerk):
+        if accel:
+            accel = accel / self.microns_per_step
+        if jerk:
+            jerk = jerk / self.microns_per_step
+        return accel, jerk
 
     ###########################################################################
     ##
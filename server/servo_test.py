@@ -16,12 +16,107 @@
 ###############################################################################
 #
 #   A mock class that simulates servo controls. This enables testing of
-#   the webserver without actually running on the RPi
+#   the webserver without actually running on the RPi.  Moves take no time
+#   but the location is kept, and the waits of a peel stop on a cancel like
+#   the real ones.  A streaming move does take its time, so the slices of
+#   "cont" layers stay up as long as on the printer.
 #
 ###############################################################################
+import motion
+from motion import jitter_stats, move_report
+
 class BED_servo:
-    def __init__(self,a): pass
+    def __init__(self, microns_per_step = 0.439453125):
+        self.microns_per_step = microns_per_step
+        self.location = 0   # home position
+        self.last_move = None
+        self.cancel = None
+        self.jitter = jitter_stats()
     def nop(*args, **kw): pass
     def __getattr__(self, name):
         print("Servo.{0}".format(name))
         return self.nop
+
+    def cancelled(self):
+        return bool(self.cancel and self.cancel.cancelled)
+
+    def move(self, steps=3200, speed=3200, accel=None, jerk=None):
+        # A cancelled move does not start, as in BED_servo.run_segments
+        done = 0 if self.cancelled() else steps
+        print("Servo.move {0:d} of {1:d} steps".format(done, steps))
+        self.location += done
+        self.last_move = move_report(abs(steps), abs(done), 0.0, 0.0, 0.0, self.cancelled())
+        return self.last_move
+
+    def hold(self, duration):
+        begin = motion.monotonic()
+        if self.cancel:
+            self.cancel.sleep(duration)
+        else:
+            motion.sleep(duration)
+        return move_report(0, 0, duration, motion.monotonic() - begin, 0.0, self.cancelled())
+
+    # The printer logs the segments of each peel, so they are all reported
+    def peel(self, depth, rise, speed_down, speed_up, dwell, settle, accel=None, jerk=None):
+        reports = {}
+        for name, distance, duration in [("down", depth, 0), ("dwell", 0, dwell), ("up", -rise, 0), ("settle", 0, settle)]:
+            if self.cancelled():
+                break
+            if distance:
+                reports[name] = self.move_microns(distance, 0)
+            else:
+                reports[name] = self.hold(duration)
+        return reports
+
+    # Steps at a constant rate in each stretch, reaching marks on the way
+    def stream(self, stretches, tracker=None):
+        reports = {}
+        mark = tracker.first_mark() if tracker else -1
+        done = 0
+        covered = 0.0
+        begin = motion.monotonic()
+
+        try:
+            for distance, speed in stretches:
+                name = "stretch {:d}".format(len(reports))
+                steps = int(round((covered + distance) / self.microns_per_step)) - int(round(covered / self.microns_per_step))
+                covered += distance
+                period = self.microns_per_step / speed
+
+                while mark != -1 and mark <= done + steps and not self.cancelled():
+                    motion.wait_until(begin + (mark - done) * period, self.cancel)
+                    if not self.cancelled():
+                        mark = tracker.reached()
+                if not self.cancelled():
+                    motion.wait_until(begin + steps * period, self.cancel)
+
+                moved = min(int((motion.monotonic() - begin) / period), steps)
+                if not self.cancelled():
+                    moved = steps
+                self.location += moved
+                done += moved
+                reports[name] = move_report(steps, moved, steps * period, motion.monotonic() - begin, 0.0, self.cancelled())
+                print("Servo.stream {0:d} of {1:d} steps".format(moved, steps))
+
+                begin += steps * period
+                if self.cancelled():
+                    break
+        finally:
+            if tracker:
+                tracker.finish()
+        return reports
+
+    def move_microns(self, distance, speed, accel=None, jerk=None):
+        return self.move(int(distance / self.microns_per_step))
+
+    def move_to(self, location, speed, accel=None, jerk=None):
+        return self.move(int(round(float(location) / self.microns_per_step)) - self.location)
+
+    def home(self, speed, accel=None, jerk=None):
+        return self.move(-self.location)
+
+    def get_location_microns(self):
+        return self.location * self.microns_per_step
+
+    def reset_home(self):
+        self.location = 0
@@ -0,0 +1,269 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+##
+#   The index of a job's slices: the size, bounding box, lit area, largest
+#   island and content hash of every layer, plus anything wrong with them.
+#
+#   Every slice is decoded once, across a process pool, when the job is
+#   uploaded or found, and the index is kept next to the job as JSON (see
+#   slicepack.sidecar_path).  After that the printer, the ETA plan and the
+#   web pages read the index instead of opening images.
+##
+###############################################################################
+
+import os, sys, json, tempfile
+from collections import namedtuple
+from multiprocessing import Pool
+from slicepack import open_slices, open_image, sidecar_path, content_hash
+from peeling import measure_image, layer_stats
+
+usageStr = """
+Usage:      python sliceindex.py object_path
+
+    object_path Slice directory, slice archive, or "zip#folder" path
+
+"""
+
+INDEX_NAME          = "index"
+INDEX_VERSION       = 1
+
+# Layers handed to a worker at a time
+INDEX_CHUNK         = 8
+
+###############################################################################
+##
+#   What is known about one layer
+#
+#   size        (width, height) of the image
+#   bbox        (x0, y0, x1, y1) of the lit pixels, None for a blank layer
+#   area        Lit pixels
+#   island      Lit pixels in the largest connected island
+#   hash        SHA-1 of the decoded grayscale pixels, see
+#               slicepack.content_hash
+#   error       Why the layer cannot be printed, None if it can
+##
+###############################################################################
+layer_entry = namedtuple('layer_entry', 'size bbox area island hash error')
+
+
+###############################################################################
+##
+#   Decodes and measures one layer.  Runs in the pool's workers.
+#
+#   @param  image_path  Path of the layer, see slicepack.open_image
+#   @return layer_entry
+##
+###############################################################################
+def index_layer(image_path):
+    try:
+        image = open_image(image_path).convert('L')
+    except Exception as e:
+        return layer_entry(None, None, 0, 0, None, "{:s}: {:s}".format(image_path, str(e)))
+
+    stats = measure_image(image)
+    return layer_entry(image.size, image.getbbox(), stats.area, stats.island, content_hash(image), None)
+
+
+###############################################################################
+##
+#   Returns what the index of a job was built from, so a changed job can be
+#   told apart from the one indexed
+#
+#   @param  slices  Opened slices, see slicepack.open_slices
+#   @return [number of layers, newest modification time, 0 if none of the
+#           layer files are there]
+##
+###############################################################################
+def source_stamp(slices):
+    archive = getattr(slices, 'archive', slices)
+    if os.path.isdir(slices.path):
+        paths = [slices.layer_path(layer) for layer in xrange(slices.num_slices)]
+        mtimes = [os.path.getmtime(path) for path in paths if os.path.isfile(path)]
+        mtime = max(mtimes) if mtimes else 0
+    else:
+        mtime = os.path.getmtime(archive.path)
+    return [slices.num_slices, mtime]
+
+
+class slice_index:
+    ###########################################################################
+    ##
+    #   @param  stamp   What the index was built from, see source_stamp
+    #   @param  layers  List of layer_entry, one per layer
+    ##
+    ###########################################################################
+    def __init__(self, stamp, layers):
+        self.stamp = stamp
+        self.layers = layers
+        self.size = None
+
+        # Every layer must match the first one that could be read
+        for layer, entry in enumerate(layers):
+            if entry.error is not None:
+                continue
+            if self.size is None:
+                self.size = entry.size
+            elif entry.size != self.size:
+                self.layers[layer] = entry._replace(error="Layer {:d} is {:d}x{:d}, expected {:d}x{:d}".format(
+                    layer, entry.size[0], entry.size[1], self.size[0], self.size[1]))
+
+    def __len__(self):
+        return len(self.layers)
+
+    def errors(self):
+        return [entry.error for entry in self.layers if entry.error]
+
+    ###########################################################################
+    ##
+    #   Returns the size of every layer, for peeling.peel_policy
+    ##
+    ###########################################################################
+    def stats(self):
+        return [layer_stats(entry.area, entry.island) for entry in self.layers]
+
+    ###########################################################################
+    ##
+    #   Describes the job in a few words, for the web pages
+    ##
+    ###########################################################################
+    def summary(self):
+        errors = self.errors()
+        if errors:
+            return "{:d} layers, {:d} invalid".format(len(self), len(errors))
+        return "{:d} layers".format(len(self))
+
+    def to_dict(self):
+        return {"version": INDEX_VERSION,
+                "stamp": self.stamp,
+                "layers": [entry._asdict() for entry in self.layers]}
+
+    ###########################################################################
+    ##
+    #   Writes the index.  The printer and the server's indexer may build
+    #   the same index at once, so each writes a file of its own and renames
+    #   it into place, and a reader never sees half an index.
+    ##
+    ###########################################################################
+    def save(self, path):
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", dir=os.path.dirname(path) or ".")
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(self.to_dict(), f, separators=(',', ':'))
+            finally:
+                f.close()
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+
+###############################################################################
+##
+#   Where a job keeps its index
+##
+###############################################################################
+def index_path(object_path):
+    return sidecar_path(object_path, INDEX_NAME)
+
+
+###############################################################################
+##
+#   Decodes every layer of a job across a process pool and saves the index
+#
+#   @param  object_path     Slice directory, archive, or "zip#folder" path
+#   @param  processes       Worker processes, None for one per CPU
+#   @return slice_index, or None if there are no slices
+##
+###############################################################################
+def build_index(object_path, processes=None):
+    slices = open_slices(object_path)
+    if not slices:
+        return None
+
+    paths = [slices.layer_path(layer) for layer in xrange(slices.num_slices)]
+
+    pool = Pool(processes)
+    try:
+        layers = pool.map(index_layer, paths, INDEX_CHUNK)
+    finally:
+        pool.close()
+        pool.join()
+
+    index = slice_index(source_stamp(slices), layers)
+    index.save(index_path(object_path))
+    return index
+
+
+###############################################################################
+##
+#   Loads the index of a job, if it is still up to date
+#
+#   @param  object_path     Slice directory, archive, or "zip#folder" path
+#   @return slice_index, or None if there is no index or the job changed
+##
+###############################################################################
+def load_index(object_path):
+    path = index_path(object_path)
+    slices = open_slices(object_path)
+    if not slices or not os.path.isfile(path):
+        return None
+
+    try:
+        f = open(path)
+        try:
+            metadata = json.load(f)
+        finally:
+            f.close()
+    except ValueError:
+        return None
+
+    if metadata.get("version") != INDEX_VERSION or metadata.get("stamp") != source_stamp(slices):
+        return None
+
+    layers = []
+    for entry in metadata["layers"]:
+        layers.append(layer_entry(tuple(entry["size"]) if entry["size"] else None,
+                                  tuple(entry["bbox"]) if entry["bbox"] else None,
+                                  entry["area"], entry["island"], entry["hash"], entry["error"]))
+
+    return slice_index(metadata["stamp"], layers)
+
+
+###############################################################################
+##
+#   Loads the index of a job, building it first if it is missing or out of
+#   date
+##
+###############################################################################
+def get_index(object_path, processes=None):
+    return load_index(object_path) or build_index(object_path, processes)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(usageStr)
+        exit()
+
+    index = build_index(sys.argv[1])
+    if index is None:
+        print "Missing slices in " + sys.argv[1]
+        exit()
+
+    print "Indexed {:s}: {:s}".format(sys.argv[1], index.summary())
+    for error in index.errors():
+        print error
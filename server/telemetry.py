@@ -0,0 +1,334 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+##
+#   Records how long each phase of a print takes, as spans in a CSV log, and
+#   converts the log to a Chrome trace (chrome://tracing or Perfetto).
+#
+#   Usage:  python telemetry.py telemetry.csv trace.json
+##
+###############################################################################
+
+import sys, time, csv, json, threading, traceback
+from Queue import Queue
+
+import motion
+
+TELEMETRY_FILE  = "telemetry.csv"
+
+FIELDS          = ["name", "layer", "thread", "start", "duration", "planned", "detail"]
+
+# Segment names of BED_servo.peel, in the order they run
+PEEL_SEGMENTS   = ["down", "dwell", "up", "settle"]
+
+# Spans of the print's own thread waiting on work done elsewhere
+WAIT_SPANS      = ["prefetch wait"]
+
+
+###############################################################################
+##
+#   Times the code in a with block and records it as a span
+##
+###############################################################################
+class span:
+    def __init__(self, log, name, planned, detail):
+        self.log = log
+        self.name = name
+        self.planned = planned
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = motion.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.log.record(self.name, self.start, motion.monotonic() - self.start, self.planned, self.detail)
+        return False
+
+
+###############################################################################
+##
+#   Log of the spans of one print.  Spans are only kept between start() and
+#   stop(), so instrumented code costs next to nothing the rest of the time.
+#   Any thread may record.
+#
+#   While logging, writing the spans and the other bookkeeping handed to
+#   defer() run on a "log" thread, so the print's own thread goes straight
+#   from one lift move or exposure to the next.
+##
+###############################################################################
+class span_log:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = None
+        self.writer = None
+        self.layer = -1
+
+        # Per span name: [count, seconds, seconds over the planned duration]
+        self.totals = {}
+
+        # Functions also given the arguments of every record() while logging
+        self.listeners = []
+
+        # Work handed off by defer(), and the thread that runs it
+        self.deferred = Queue()
+        self.worker = None
+
+        # Thread that started the log, seconds of spans recorded on other
+        # threads by name, and seconds of work on the log thread
+        self.print_thread = None
+        self.overlapped = {}
+        self.deferred_time = 0.0
+
+    ###########################################################################
+    ##
+    #   Starts logging to a new file
+    #
+    #   @param  path    CSV file for the spans
+    ##
+    ###########################################################################
+    def start(self, path=TELEMETRY_FILE):
+        self.stop()
+        with self.lock:
+            self.file = open(path, 'wb')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(FIELDS)
+            self.layer = -1
+            self.totals = {}
+            self.print_thread = threading.current_thread()
+            self.overlapped = {}
+            self.deferred_time = 0.0
+
+        self.worker = threading.Thread(target=self.run_deferred, name="log")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self):
+        worker = self.worker
+        if worker is not None:
+            self.worker = None
+            self.deferred.put(None)
+            worker.join()
+
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = None
+            self.writer = None
+
+    ###########################################################################
+    ##
+    #   Runs a function on the log thread, after everything handed off before
+    #   it.  Without a log running, the function runs straight away.
+    ##
+    ###########################################################################
+    def defer(self, function, *args):
+        if self.worker is None:
+            function(*args)
+        else:
+            self.deferred.put((function, args))
+
+    ###########################################################################
+    ##
+    #   Waits until everything handed to defer() so far has run
+    ##
+    ###########################################################################
+    def drain(self):
+        if self.worker is not None:
+            self.deferred.join()
+
+    def run_deferred(self):
+        while True:
+            work = self.deferred.get()
+            try:
+                if work is None:
+                    return
+
+                # Wall time, as the simulator's clock only moves in waits
+                start = time.time()
+                function, args = work
+                function(*args)
+                self.deferred_time += time.time() - start
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.deferred.task_done()
+
+    ###########################################################################
+    ##
+    #   Records a span against the current layer
+    #
+    #   @param  name        Phase, e.g. "exposure" or "image load"
+    #   @param  start       monotonic() time the phase started
+    #   @param  duration    Seconds the phase took
+    #   @param  planned     Seconds the phase should have taken, or None
+    #   @param  detail      Anything else worth knowing, e.g. the image path
+    ##
+    ###########################################################################
+    def record(self, name, start, duration, planned=None, detail=""):
+        if self.writer is None:
+            return
+
+        self.defer(self.write, name, self.layer, threading.current_thread(), start, duration, planned, detail)
+
+    def write(self, name, layer, thread, start, duration, planned, detail):
+        with self.lock:
+            if self.writer is None:
+                return
+
+            if planned is None:
+                planned_text = ""
+                overrun = 0.0
+            else:
+                planned_text = "{:.6f}".format(planned)
+                overrun = max(duration - planned, 0.0)
+
+            self.writer.writerow([name, layer, thread.name,
+                                  "{:.6f}".format(start), "{:.6f}".format(duration), planned_text, detail])
+
+            total = self.totals.setdefault(name, [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += duration
+            total[2] += overrun
+
+            # The log thread's own spans are in deferred_time
+            if thread is not self.print_thread and thread.name != "log":
+                self.overlapped[name] = self.overlapped.get(name, 0.0) + duration
+
+        for listener in self.listeners:
+            listener(name, start, duration, planned, detail)
+
+    def span(self, name, planned=None, detail=""):
+        return span(self, name, planned, detail)
+
+    ###########################################################################
+    ##
+    #   Records the segments of a lift move, one after the other
+    #
+    #   @param  start       monotonic() time the move started
+    #   @param  reports     Dictionary of move reports by segment name, from
+    #                       BED_servo.run_segments
+    #   @param  names       Segment names in the order they ran
+    ##
+    ###########################################################################
+    def record_moves(self, start, reports, names):
+        for name in names:
+            if name in reports:
+                report = reports[name]
+                self.record("lift " + name, start, report['elapsed'], report['planned'])
+                start += report['elapsed']
+
+    ###########################################################################
+    ##
+    #   Sums up the spans by phase, then how much work ran alongside the
+    #   print's own thread against how long that thread waited for it
+    #
+    #   @return string with a line per phase
+    ##
+    ###########################################################################
+    def summary(self):
+        with self.lock:
+            lines = []
+            for name in sorted(self.totals, key=lambda n: -self.totals[n][1]):
+                count, seconds, overrun = self.totals[name]
+                lines.append("{:<12s} {:6d} spans {:10.2f}s  {:8.3f}s over plan".format(name, count, seconds, overrun))
+
+            overlapped = dict(self.overlapped)
+            overlapped["logging and status"] = self.deferred_time
+            hidden = sum(overlapped.values())
+            waited = sum(self.totals.get(name, [0, 0.0])[1] for name in WAIT_SPANS)
+
+            lines.append("Overlapped  {:.2f}s ({:s}), waited on {:.2f}s, {:.1f}% hidden".format(
+                hidden, ", ".join("{:s} {:.2f}s".format(name, overlapped[name]) for name in sorted(overlapped)),
+                waited, 100.0 * hidden / max(hidden + waited, 1e-9)))
+            return "\n".join(lines)
+
+
+###############################################################################
+##
+#   Reads a span log
+#
+#   @param  path    CSV file written by span_log
+#   @return list of dictionaries with the FIELDS of each span
+##
+###############################################################################
+def load_spans(path):
+    f = open(path, 'rb')
+    try:
+        return list(csv.DictReader(f))
+    finally:
+        f.close()
+
+
+###############################################################################
+##
+#   Converts spans to the Chrome trace event format, one track per thread
+#
+#   @param  spans   List of span dictionaries, from load_spans
+#   @return dictionary ready for json.dump
+##
+###############################################################################
+def chrome_trace(spans):
+    threads = {}
+    events = []
+
+    for s in spans:
+        if s['thread'] not in threads:
+            threads[s['thread']] = len(threads) + 1
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": threads[s['thread']],
+                           "args": {"name": s['thread']}})
+
+        args = {"layer": int(s['layer'])}
+        if s['planned']:
+            args["planned_ms"] = float(s['planned']) * 1000.0
+        if s['detail']:
+            args["detail"] = s['detail']
+
+        events.append({"name": s['name'],
+                       "cat": "print",
+                       "ph": "X",
+                       "pid": 1,
+                       "tid": threads[s['thread']],
+                       "ts": float(s['start']) * 1000000.0,
+                       "dur": float(s['duration']) * 1000000.0,
+                       "args": args})
+
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+###############################################################################
+##
+#   Writes a span log as a Chrome trace
+#
+#   @param  csv_path    CSV file written by span_log
+#   @param  json_path   Trace file to write
+##
+###############################################################################
+def export_chrome_trace(csv_path, json_path):
+    f = open(json_path, 'w')
+    try:
+        json.dump(chrome_trace(load_spans(csv_path)), f)
+    finally:
+        f.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print "Usage:      python telemetry.py telemetry.csv trace.json"
+        exit()
+
+    export_chrome_trace(sys.argv[1], sys.argv[2])
+    print "Wrote " + sys.argv[2]
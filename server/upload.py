@@ -0,0 +1,248 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, re, cgi, urlparse
+
+# Uploads are moved through memory this many bytes at a time
+UPLOAD_CHUNK        = 65536
+
+# Form fields that are not files are kept in memory, up to this size
+MAX_FIELD_SIZE      = 65536
+
+# Where file fields of a form, and resumable uploads, are written
+UPLOAD_TEMPLATE     = "{:s}.upload"
+
+
+class UploadError(Exception):
+    pass
+
+
+###############################################################################
+##
+#   Decodes a query string or a urlencoded form body.  Names of objects in
+#   an uploaded zip hold a "#", which the browser sends as %23.
+#
+#   @param  args    e.g. "command=print_object&object_path=a.zip%23a.slice"
+#   @return dictionary of field name to value, the last one of a repeated
+#           field
+##
+###############################################################################
+def parse_url_args(args):
+    return dict(urlparse.parse_qsl(args, keep_blank_values=True))
+
+
+###############################################################################
+##
+#   Reads a request body of known length in fixed size chunks, reporting the
+#   progress as it goes
+##
+###############################################################################
+class body_reader:
+    def __init__(self, rfile, length, progress=None):
+        self.rfile = rfile
+        self.length = length
+        self.remaining = length
+        self.progress = progress
+        self.buffer = ""
+
+    ###########################################################################
+    ##
+    #   Appends the next chunk of the body to the buffer
+    #
+    #   @return False when the body is used up
+    ##
+    ###########################################################################
+    def fill(self):
+        if self.remaining <= 0:
+            return False
+
+        data = self.rfile.read(min(UPLOAD_CHUNK, self.remaining))
+        if not data:
+            raise UploadError("Connection closed with {:d} bytes left".format(self.remaining))
+
+        self.remaining -= len(data)
+        self.buffer += data
+        if self.progress:
+            self.progress(self.length - self.remaining, self.length)
+        return True
+
+    ###########################################################################
+    ##
+    #   Reads up to and past a delimiter
+    #
+    #   @param  delimiter   String to look for
+    #   @param  sink        Function given the data before the delimiter, in
+    #                       pieces, or None to throw it away
+    ##
+    ###########################################################################
+    def read_until(self, delimiter, sink=None):
+        while True:
+            found = self.buffer.find(delimiter)
+            if found >= 0:
+                if sink:
+                    sink(self.buffer[:found])
+                self.buffer = self.buffer[found + len(delimiter):]
+                return
+
+            # Keep enough of the tail to hold a delimiter split across chunks
+            keep = len(delimiter) - 1
+            if len(self.buffer) > keep:
+                if sink:
+                    sink(self.buffer[:len(self.buffer) - keep])
+                self.buffer = self.buffer[len(self.buffer) - keep:]
+
+            if not self.fill():
+                raise UploadError("Missing " + repr(delimiter))
+
+    ###########################################################################
+    ##
+    #   Takes a given number of bytes off the front of the buffer
+    ##
+    ###########################################################################
+    def take(self, count):
+        while len(self.buffer) < count:
+            if not self.fill():
+                raise UploadError("Body ended early")
+        data = self.buffer[:count]
+        self.buffer = self.buffer[count:]
+        return data
+
+
+###############################################################################
+##
+#   Parses a multipart/form-data body as it arrives.  File fields are written
+#   to disk one chunk at a time, so memory use does not depend on the size of
+#   the upload.
+#
+#   @param  rfile       Request body stream
+#   @param  pdict       Content-Type parameters, from cgi.parse_header
+#   @param  length      Content-Length of the body
+#   @param  progress    Function given (bytes received, bytes total), or None
+#   @return dictionary of field name to a list of values, like
+#           cgi.parse_multipart.  File fields hold the path they were saved to.
+##
+###############################################################################
+def parse_multipart(rfile, pdict, length, progress=None):
+    reader = body_reader(rfile, length, progress)
+    boundary = "--" + pdict['boundary']
+    fields = {}
+
+    reader.read_until(boundary)
+
+    while reader.take(2) != "--":
+        headers = {}
+        header_block = []
+        reader.read_until("\r\n\r\n", header_block.append)
+        for line in "".join(header_block).split("\r\n"):
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+        disposition, params = cgi.parse_header(headers.get('content-disposition', ''))
+        name = params.get('name', '')
+
+        if 'filename' in params:
+            path = UPLOAD_TEMPLATE.format(re.sub("[^A-Za-z0-9_]", "_", name))
+            f = open(path, 'wb')
+            try:
+                reader.read_until("\r\n" + boundary, f.write)
+            finally:
+                f.close()
+            fields.setdefault(name, []).append(path)
+        else:
+            value = []
+            def keep_field(data):
+                if sum(map(len, value)) + len(data) > MAX_FIELD_SIZE:
+                    raise UploadError("Field " + name + " is too large")
+                value.append(data)
+            reader.read_until("\r\n" + boundary, keep_field)
+            fields.setdefault(name, []).append("".join(value))
+
+    # Anything after the closing boundary is ignored
+    while reader.remaining > 0:
+        reader.buffer = ""
+        reader.fill()
+
+    return fields
+
+
+###############################################################################
+##
+#   Returns where a resumable upload is written
+#
+#   @param  name    Name of the upload, e.g. object.zip
+#   @return path of the partial upload
+##
+###############################################################################
+def partial_path(name):
+    return UPLOAD_TEMPLATE.format(os.path.basename(name))
+
+
+###############################################################################
+##
+#   Returns how much of a resumable upload has been received
+#
+#   @param  name    Name of the upload
+#   @return number of bytes on disk
+##
+###############################################################################
+def received_bytes(name):
+    path = partial_path(name)
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return 0
+
+
+###############################################################################
+##
+#   Receives one piece of a resumable upload.  The piece must start exactly
+#   where the bytes on disk end, so an interrupted upload is resumed by asking
+#   for received_bytes() and sending the rest from there.
+#
+#   @param  rfile           Request body stream
+#   @param  name            Name of the upload
+#   @param  content_range   Content-Range header, "bytes first-last/total"
+#   @param  length          Content-Length of the body
+#   @param  progress        Function given (bytes received, bytes total)
+#   @return tuple of (bytes on disk, total bytes)
+##
+###############################################################################
+def receive_range(rfile, name, content_range, length, progress=None):
+    range_match = re.match("bytes (\d+)-(\d+)/(\d+)$", content_range or "")
+    if not range_match:
+        raise UploadError("Bad Content-Range: " + str(content_range))
+
+    first, last, total = [int(x) for x in range_match.groups()]
+    if last - first + 1 != length or last >= total:
+        raise UploadError("Content-Range does not match the body")
+
+    offset = received_bytes(name)
+    if first != offset:
+        raise UploadError("Upload resumes at byte {:d}, not {:d}".format(offset, first))
+
+    def report(done, body_length):
+        if progress:
+            progress(offset + done, total)
+
+    reader = body_reader(rfile, length, report)
+    f = open(partial_path(name), 'ab')
+    try:
+        while reader.fill():
+            f.write(reader.buffer)
+            reader.buffer = ""
+    finally:
+        f.close()
+
+    return received_bytes(name), total
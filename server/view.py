@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import cgi
 import time
 from string import Template
 
@@ -62,7 +63,12 @@ def index():
 
         temp_object_path_options = ""
         for p in SYNC_MODEL.object_paths:
-            temp_object_path_options += "<option>" + p + "</option>"
+            index = SYNC_MODEL.object_indexes.get(p)
+            if index:
+                text = "{0} ({1})".format(p, index.summary())
+            else:
+                text = p
+            temp_object_path_options += '<option value="{0}">{1}</option>'.format(cgi.escape(p, True), cgi.escape(text))
 
         page = page_temp.safe_substitute(lift_amount=SYNC_MODEL.lift_amount,
                                          lift_speed=SYNC_MODEL.lift_speed,
@@ -74,9 +80,17 @@ def index():
     return page
 
 def status():
+    title_status, sub_status, upload_progress = SYNC_MODEL.get_status()
+
+    upload_status = ""
+    if upload_progress:
+        received, total = upload_progress
+        upload_status = "Uploading: {:.0f}% of {:.1f} MB<br>".format(100.0 * received / max(total, 1), total / 1048576.0)
+
     page_temp = STATUS_TEMPLATE
-    page = page_temp.safe_substitute(title_status=SYNC_MODEL.title_status,
-                                     sub_status=SYNC_MODEL.sub_status,
+    page = page_temp.safe_substitute(title_status=title_status,
+                                     sub_status=sub_status,
+                                     upload_status=upload_status,
                                      curtime=time.strftime("%H:%M:%S"))
 
     return page
@@ -0,0 +1,405 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+##
+#   Simulated lift and projector on a virtual clock.  Waits take no real
+#   time, so a whole print runs in seconds, and every move and frame is
+#   recorded on a timeline that can be checked or saved as CSV.
+#
+#   BED_servo and projector here stand in for the classes of the same name
+#   in servo.py and projector.py.  Call install() first so the waits in the
+#   motion module run on the virtual clock too.
+##
+###############################################################################
+
+import csv
+import threading
+import time
+from collections import namedtuple
+from math import pi
+
+import motion
+from motion import accelerated_profile, hold_profile, move_report, jitter_stats, MAX_STEP_RATE
+
+# Fastest the step pin can be toggled from Python on the Pi.  Faster moves
+# are stretched out, as they would be on the printer.
+SIM_STEP_RATE_LIMIT     = 40000     # steps/s
+
+# Frames are shown at the next refresh of the projector
+FRAME_RATE              = 60        # frames/s
+
+TIMELINE_FILE           = "timeline.csv"
+
+# Real seconds a streaming move waits at a mark for its frame
+FRAME_HANDOFF_TIMEOUT   = 1.0
+
+###############################################################################
+##
+#   One entry on the timeline
+#
+#   time        Virtual time, in seconds, the event started
+#   source      "lift" or "projector"
+#   name        Segment name for the lift, e.g. "down" or "settle", or
+#               "frame" for the projector
+#   duration    Seconds the event lasted
+#   detail      Lift location in microns after the move, or what the
+#               projector showed
+##
+###############################################################################
+event = namedtuple('event', 'time source name duration detail')
+
+
+class virtual_clock:
+    def __init__(self):
+        self.time = 0.0
+        self.timeline = []
+
+        # Virtual time the last frame went up, see wait_for_frame
+        self.frame_shown = threading.Condition()
+        self.frame_at = None
+
+    def now(self):
+        return self.time
+
+    ###########################################################################
+    ##
+    #   Stands in for motion.wait_until.  The clock jumps to the deadline.
+    ##
+    ###########################################################################
+    def wait_until(self, deadline, cancel=None):
+        if cancel and cancel.cancelled:
+            return self.time - deadline
+        if deadline > self.time:
+            self.time = deadline
+        return self.time - deadline
+
+    def sleep(self, duration):
+        self.wait_until(self.time + duration)
+
+    def show_frame(self):
+        with self.frame_shown:
+            self.frame_at = self.time
+            self.frame_shown.notify_all()
+
+    ###########################################################################
+    ##
+    #   Holds a streaming move at a mark until the printer, on its own
+    #   thread, has put up a frame for it.  Otherwise the move could run the
+    #   clock on before the frame is stamped.
+    #
+    #   @param  at      Virtual time the mark was reached
+    #   @param  cancel  cancel_token that stops the wait, or None
+    ##
+    ###########################################################################
+    def wait_for_frame(self, at, cancel=None):
+        give_up = time.time() + FRAME_HANDOFF_TIMEOUT
+        with self.frame_shown:
+            while self.frame_at is None or self.frame_at < at:
+                remaining = give_up - time.time()
+                if remaining <= 0 or (cancel and cancel.cancelled):
+                    return
+                self.frame_shown.wait(min(remaining, motion.CANCEL_POLL_INTERVAL))
+
+    def record(self, start, source, name, detail):
+        self.timeline.append(event(start, source, name, self.time - start, detail))
+
+    ###########################################################################
+    ##
+    #   Returns the timeline in order of time
+    #
+    #   @param  source  Only the events of this source, or None for all
+    ##
+    ###########################################################################
+    def events(self, source=None):
+        return sorted((e for e in self.timeline if source is None or e.source == source),
+                      key=lambda e: e.time)
+
+    def clear(self):
+        del self.timeline[:]
+
+CLOCK = virtual_clock()
+
+
+###############################################################################
+##
+#   Runs the waits of the motion module on the virtual clock
+##
+###############################################################################
+def install():
+    motion.use_clock(CLOCK.now, CLOCK.wait_until)
+
+
+###############################################################################
+##
+#   Writes the timeline as CSV
+#
+#   @param  path    File to write
+##
+###############################################################################
+def save_timeline(path=TIMELINE_FILE):
+    f = open(path, 'wb')
+    try:
+        writer = csv.writer(f)
+        writer.writerow(event._fields)
+        for e in CLOCK.events():
+            writer.writerow(["{:.6f}".format(e.time), e.source, e.name, "{:.6f}".format(e.duration), e.detail])
+    finally:
+        f.close()
+
+
+###############################################################################
+##
+#   Sums up the timeline
+#
+#   @return string with the total time, exposure time and lift travel
+##
+###############################################################################
+def summary():
+    frames = [e for e in CLOCK.events("projector") if e.name == "frame"]
+    lit = [e for e in frames if e.detail != "black"]
+    moves = [e for e in CLOCK.events("lift") if e.name not in ("dwell", "settle")]
+
+    return "Simulated {:s} in {:.3f}s: {:d} frames, {:.1f}s exposed, {:d} lift moves taking {:.1f}s".format(
+        TIMELINE_FILE, CLOCK.time, len(lit), sum(e.duration for e in lit),
+        len(moves), sum(e.duration for e in moves))
+
+
+###############################################################################
+##
+#   Time a pulse table really takes when no two pulses can be closer than
+#   the step rate limit allows
+#
+#   @param  profile     Pulse table from the motion module
+#   @return seconds
+##
+###############################################################################
+def limited_duration(profile):
+    min_period = 1.0 / SIM_STEP_RATE_LIMIT
+    duration = profile[-1]
+
+    for i in xrange(len(profile) - 1):
+        gap = profile[i + 1] - profile[i]
+        if gap < min_period:
+            duration += min_period - gap
+
+    return duration
+
+
+class BED_servo:
+    def __init__(self, microns_per_step = 0.439453125, **pins):
+        self.steps_per_revolution = 16 * 200
+        self.microns_per_step = microns_per_step
+
+        self.location = 0   # home position
+        self.last_move = None
+        self.cancel = None
+
+        # No pulses are timed on the virtual clock, so this stays empty
+        self.jitter = jitter_stats()
+
+        # The driver is awake after BED_servo's initialization
+        self.powered = True
+
+    def shutdown(self):
+        self.off()
+
+    def reset(self):
+        CLOCK.sleep(0.25)
+
+    def on(self):
+        self.powered = True
+        CLOCK.sleep(0.002)
+
+    def off(self):
+        self.powered = False
+
+    def move(self, steps=3200, speed=3200, accel=None, jerk=None):
+        delta_location = 1
+
+        if (speed > MAX_STEP_RATE):
+            speed = MAX_STEP_RATE
+
+        if (steps < 0):
+            steps = -steps
+            delta_location = -1
+
+        profile = accelerated_profile(steps, speed, accel, jerk)
+        return self.run_segments([["move", profile, delta_location]], accel)["move"]
+
+    def peel(self, depth, rise, speed_down, speed_up, dwell, settle, accel=None, jerk=None):
+        accel, jerk = self.microns_to_steps(accel, jerk)
+
+        down_steps = int(depth / self.microns_per_step)
+        up_steps = int(rise / self.microns_per_step)
+
+        return self.run_segments([
+            ["down",    accelerated_profile(down_steps, speed_down / self.microns_per_step, accel, jerk), 1],
+            ["dwell",   hold_profile(dwell), 0],
+            ["up",      accelerated_profile(up_steps, speed_up / self.microns_per_step, accel, jerk), -1],
+            ["settle",  hold_profile(settle), 0],
+        ], accel)
+
+    ###########################################################################
+    ##
+    #   Runs the segments on the virtual clock.  A cancel only takes effect
+    #   between segments, as no virtual time passes while one is planned.
+    ##
+    ###########################################################################
+    def run_segments(self, segments, stop_accel=None):
+        reports = {}
+
+        for name, profile, delta_location in segments:
+            if self.cancel and self.cancel.cancelled:
+                break
+
+            steps = len(profile) - 1
+            planned = profile[steps]
+            begin = CLOCK.time
+
+            if delta_location != 0 and steps > 0 and not self.powered:
+                raise RuntimeError("Lift moved with the driver asleep")
+
+            CLOCK.sleep(limited_duration(profile))
+            self.location += delta_location * steps
+
+            elapsed = CLOCK.time - begin
+            CLOCK.record(begin, "lift", name, "{:.1f}".format(self.get_location_microns()))
+            reports[name] = move_report(steps, steps, planned, elapsed, elapsed - planned)
+            if delta_location != 0:
+                self.last_move = reports[name]
+
+        return reports
+
+    ###########################################################################
+    ##
+    #   Stands in for BED_servo.stream.  Each mark is reached at the virtual
+    #   time of its step, and the move waits there for the printer's frame.
+    #   As in run_segments, a cancel only stops it between stretches.
+    ##
+    ###########################################################################
+    def stream(self, stretches, tracker=None):
+        reports = {}
+        mark = tracker.first_mark() if tracker else -1
+        done = 0
+        covered = 0.0
+        begin = CLOCK.time
+
+        try:
+            for distance, speed in stretches:
+                if self.cancel and self.cancel.cancelled:
+                    break
+
+                name = "stretch {:d}".format(len(reports))
+                steps = int(round((covered + distance) / self.microns_per_step)) - int(round(covered / self.microns_per_step))
+                covered += distance
+                profile = accelerated_profile(steps, min(speed / self.microns_per_step, MAX_STEP_RATE))
+                planned = profile[steps]
+                duration = limited_duration(profile)
+
+                if steps > 0 and not self.powered:
+                    raise RuntimeError("Lift moved with the driver asleep")
+
+                while mark != -1 and mark <= done + steps:
+                    at = begin + profile[mark - done] * duration / planned
+                    CLOCK.wait_until(at)
+                    mark = tracker.reached(at)
+                    CLOCK.wait_for_frame(at, self.cancel)
+
+                CLOCK.wait_until(begin + duration)
+                self.location += steps
+                done += steps
+
+                CLOCK.record(begin, "lift", name, "{:.1f}".format(self.get_location_microns()))
+                reports[name] = move_report(steps, steps, planned, duration, duration - planned)
+                self.last_move = reports[name]
+                begin += duration
+        finally:
+            if tracker:
+                tracker.finish()
+
+        return reports
+
+    def move_microns(self, distance, speed, accel=None, jerk=None):
+        return self.move(int(distance / self.microns_per_step), speed / self.microns_per_step,
+                         *self.microns_to_steps(accel, jerk))
+
+    def move_to(self, location, speed, accel=None, jerk=None):
+        steps = int(round(float(location) / self.microns_per_step)) - self.location
+        return self.move(steps, speed / self.microns_per_step, *self.microns_to_steps(accel, jerk))
+
+    def home(self, speed, accel=None, jerk=None):
+        return self.move(-self.location, speed / self.microns_per_step, *self.microns_to_steps(accel, jerk))
+
+    def microns_to_steps(self, accel, jerk):
+        if accel:
+            accel = accel / self.microns_per_step
+        if jerk:
+            jerk = jerk / self.microns_per_step
+        return accel, jerk
+
+    def get_location_microns(self):
+        return self.location * self.microns_per_step
+
+    def get_angle(self):
+        return ((self.location % self.steps_per_revolution) * pi) / self.steps_per_revolution
+
+    def reset_home(self):
+        self.location = 0
+
+
+class projector:
+    def __init__(self):
+        self.shown = "black"
+        self.shown_at = 0.0
+
+    ###########################################################################
+    ##
+    #   Waits for the next refresh and records the frame it replaces
+    #
+    #   @param  shown   What the new frame shows
+    #   @return virtual time the frame went up
+    ##
+    ###########################################################################
+    def flip(self, shown):
+        frame = int(CLOCK.time * FRAME_RATE) + 1
+        CLOCK.wait_until(float(frame) / FRAME_RATE)
+
+        CLOCK.record(self.shown_at, "projector", "frame", self.shown)
+        self.shown = shown
+        self.shown_at = CLOCK.time
+        CLOCK.show_frame()
+        return CLOCK.time
+
+    # Like the projector, a black screen is left as it is
+    def black(self):
+        if self.shown == "black":
+            return CLOCK.time
+        return self.flip("black")
+
+    def value(self, gray_value):
+        return self.flip("value {:d}".format(gray_value))
+
+    def display(self, image_path):
+        return self.flip(image_path)
+
+    def image(self, image_path):
+        return self.flip(image_path)
+
+    def prefetch(self, image_paths):
+        pass
+
+    def shutdown(self):
+        self.flip("off")
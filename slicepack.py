@@ -0,0 +1,532 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, sys, re, mmap, struct, threading, zipfile, posixpath, hashlib, tempfile
+from StringIO import StringIO
+from PIL import Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+usageStr = """
+Usage:      python slicepack.py object_dir archive.pds
+
+    object_dir  Directory path with slice images
+    archive.pds Slice archive to write
+
+"""
+
+###############################################################################
+#
+#   Slice archive layout, all little endian:
+#
+#       header          magic, version, width, height, layer count
+#       index           one entry per layer
+#       layer data      the bounding box of each layer, row by row, either
+#                       raw or as (count, value) byte pairs
+#
+#   Layers are named "<archive path>#NNNN" wherever an image path is used.
+#
+#   Slices can also be read straight out of an uploaded zip.  The objects in
+#   a zip are named "<zip path>#<folder>" and their layers
+#   "<zip path>#<folder>/<prefix>NNNN.png".
+#
+###############################################################################
+ARCHIVE_EXTENSION   = ".pds"
+ZIP_EXTENSION       = ".zip"
+ARCHIVE_MAGIC       = "PDSL"
+ARCHIVE_VERSION     = 1
+
+HEADER              = struct.Struct("<4sHHHI")
+#                       offset, length, x0, y0, x1, y1, lit pixel area, encoding
+INDEX_ENTRY         = struct.Struct("<QIHHHHIB")
+
+ENCODING_EMPTY      = 0
+ENCODING_RAW        = 1
+ENCODING_RLE        = 2
+
+SLICE_REGEX         = "(.+?)[0-9]+\.png"
+
+# Open archives and zips, by path, shared by everything that reads layers
+ARCHIVES = {}
+ARCHIVES_LOCK = threading.RLock()  # Held while ARCHIVES is looked up or changed
+
+
+###############################################################################
+##
+#   Run-length encodes 8-bit pixel data as (count, value) byte pairs
+#
+#   @param  data    String of pixel bytes
+#   @return string of encoded bytes
+##
+###############################################################################
+def rle_encode(data):
+    if numpy is not None:
+        flat = numpy.frombuffer(data, dtype=numpy.uint8)
+        if len(flat) == 0:
+            return ""
+        starts = numpy.concatenate(([0], numpy.flatnonzero(flat[1:] != flat[:-1]) + 1))
+        lengths = numpy.diff(numpy.concatenate((starts, [len(flat)])))
+
+        # Runs longer than a byte count are split into 255 long pieces
+        pieces = (lengths + 254) // 255
+        counts = numpy.repeat(numpy.uint8(255), pieces.sum())
+        counts[numpy.cumsum(pieces) - 1] = lengths - 255 * (pieces - 1)
+
+        encoded = numpy.empty(2 * len(counts), dtype=numpy.uint8)
+        encoded[0::2] = counts
+        encoded[1::2] = numpy.repeat(flat[starts], pieces)
+        return encoded.tostring()
+
+    encoded = bytearray()
+    i = 0
+    while i < len(data):
+        value = data[i]
+        run = 1
+        while run < 255 and i + run < len(data) and data[i + run] == value:
+            run += 1
+        encoded.append(run)
+        encoded.append(ord(value))
+        i += run
+    return str(encoded)
+
+
+###############################################################################
+##
+#   Expands (count, value) byte pairs back into pixel data
+#
+#   @param  data    Buffer of encoded bytes
+#   @return string of pixel bytes
+##
+###############################################################################
+def rle_decode(data):
+    if numpy is not None:
+        encoded = numpy.frombuffer(data, dtype=numpy.uint8)
+        return numpy.repeat(encoded[1::2], encoded[0::2]).tostring()
+
+    encoded = bytearray(data)
+    return "".join(chr(encoded[i + 1]) * encoded[i] for i in xrange(0, len(encoded), 2))
+
+
+###############################################################################
+##
+#   A packed slice archive, read through mmap.  Layer data is handed out as
+#   buffers into the map, so nothing is copied until it is decoded.
+##
+###############################################################################
+class slice_archive:
+    def __init__(self, archive_path):
+        self.path = archive_path
+        self.file = open(archive_path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.width, self.height, self.num_slices = HEADER.unpack_from(self.map, 0)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            self.close()
+            raise ValueError(archive_path + " is not a slice archive")
+
+        self.size = (self.width, self.height)
+        self.index = [INDEX_ENTRY.unpack_from(self.map, HEADER.size + i * INDEX_ENTRY.size)
+                      for i in xrange(self.num_slices)]
+
+    ###########################################################################
+    ##
+    #   Returns the name of a layer, usable anywhere an image path is
+    #
+    #   @param  layer   Layer number
+    ##
+    ###########################################################################
+    def layer_path(self, layer):
+        return "{:s}#{:04d}".format(self.path, layer)
+
+    ###########################################################################
+    ##
+    #   Returns the bounding box of the lit pixels of a layer
+    #
+    #   @param  layer   Layer number
+    #   @return (x0, y0, x1, y1), or None for a blank layer
+    ##
+    ###########################################################################
+    def layer_bbox(self, layer):
+        offset, length, x0, y0, x1, y1, area, encoding = self.index[layer]
+        if encoding == ENCODING_EMPTY:
+            return None
+        return (x0, y0, x1, y1)
+
+    ###########################################################################
+    ##
+    #   Returns the number of lit pixels in a layer
+    #
+    #   @param  layer   Layer number
+    ##
+    ###########################################################################
+    def layer_area(self, layer):
+        return self.index[layer][6]
+
+    ###########################################################################
+    ##
+    #   Returns the stored data of a layer without copying it
+    #
+    #   @param  layer   Layer number
+    #   @return tuple of (encoding, buffer into the archive)
+    ##
+    ###########################################################################
+    def layer_data(self, layer):
+        offset, length, x0, y0, x1, y1, area, encoding = self.index[layer]
+        return encoding, buffer(self.map, offset, length)
+
+    ###########################################################################
+    ##
+    #   Decodes a layer into a full size grayscale image
+    #
+    #   @param  layer   Layer number
+    #   @return PIL image in 'L' mode
+    ##
+    ###########################################################################
+    def layer_image(self, layer):
+        image = Image.new('L', self.size, 0)
+
+        encoding, data = self.layer_data(layer)
+        if encoding == ENCODING_EMPTY:
+            return image
+
+        if encoding == ENCODING_RLE:
+            data = rle_decode(data)
+
+        x0, y0, x1, y1 = self.layer_bbox(layer)
+        crop = Image.frombuffer('L', (x1 - x0, y1 - y0), data, 'raw', 'L', 0, 1)
+        image.paste(crop, (x0, y0))
+        return image
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+###############################################################################
+##
+#   A directory of slice images named <prefix>NNNN.png
+##
+###############################################################################
+class slice_directory:
+    def __init__(self, object_path):
+        self.path = object_path
+        self.prefix = None
+        self.num_slices = 0
+
+        for objs in os.listdir(object_path):
+            total_path = object_path+"/"+objs
+
+            slice_match = re.match(SLICE_REGEX, total_path)
+            if slice_match:
+                self.num_slices += 1
+                self.prefix = slice_match.group(1)
+
+    def layer_path(self, layer):
+        return self.prefix+"{:04d}.png".format(layer)
+
+
+###############################################################################
+##
+#   A zip of slice images, read in place.  The central directory is parsed
+#   once when the zip is opened and becomes the index of slices by folder.
+##
+###############################################################################
+class slice_zip:
+    def __init__(self, zip_path):
+        self.path = zip_path
+        self.zip = zipfile.ZipFile(zip_path)
+
+        # ZipFile shares one file handle between reads
+        self.lock = threading.Lock()
+
+        # folder -> [slice prefix, number of slices]
+        self.folders = {}
+        for name in self.zip.namelist():
+            slice_match = re.match(SLICE_REGEX, name)
+            if slice_match:
+                folder = self.folders.setdefault(posixpath.dirname(name), [None, 0])
+                folder[0] = slice_match.group(1)
+                folder[1] += 1
+
+    ###########################################################################
+    ##
+    #   Returns the names of the objects in the zip, usable as object paths
+    ##
+    ###########################################################################
+    def object_paths(self):
+        return [self.path + '#' + folder for folder in sorted(self.folders)]
+
+    ###########################################################################
+    ##
+    #   Decompresses one member of the zip as an image
+    #
+    #   @param  member  Name of the image in the zip
+    #   @return PIL image
+    ##
+    ###########################################################################
+    def member_image(self, member):
+        with self.lock:
+            data = self.zip.read(member)
+        return Image.open(StringIO(data))
+
+    def close(self):
+        self.zip.close()
+
+
+###############################################################################
+##
+#   One folder of slice images in a zip
+##
+###############################################################################
+class zip_slices:
+    def __init__(self, archive, folder):
+        self.path = archive.path + '#' + folder
+        self.archive = archive
+        self.prefix, self.num_slices = archive.folders[folder]
+
+    def layer_path(self, layer):
+        return "{:s}#{:s}{:04d}.png".format(self.archive.path, self.prefix, layer)
+
+
+###############################################################################
+##
+#   Opens the slices of an object: a directory of images, an archive, or a
+#   folder in a zip
+#
+#   @param  object_path     Path to a slice directory, a slice archive, or
+#                           "<zip path>#<folder>"
+#   @return slice_directory, slice_archive or zip_slices, or None if there
+#           are no slices
+##
+###############################################################################
+def open_slices(object_path):
+    if os.path.isdir(object_path):
+        slices = slice_directory(object_path)
+        if not slices.prefix:
+            return None
+        return slices
+
+    if object_path.endswith(ARCHIVE_EXTENSION) and os.path.isfile(object_path):
+        return open_archive(object_path)
+
+    zip_path, sep, folder = object_path.partition('#')
+    if sep and zip_path.endswith(ZIP_EXTENSION) and os.path.isfile(zip_path):
+        archive = open_archive(zip_path)
+        if folder in archive.folders:
+            return zip_slices(archive, folder)
+
+    return None
+
+
+###############################################################################
+##
+#   Opens an archive or zip, reusing it if it is already open
+#
+#   @param  archive_path    Path to a slice archive or zip
+#   @return slice_archive or slice_zip
+##
+###############################################################################
+def open_archive(archive_path):
+    mtime = os.path.getmtime(archive_path)
+
+    with ARCHIVES_LOCK:
+        # Reopen archives that were replaced on disk, e.g. by a new upload
+        if archive_path in ARCHIVES and ARCHIVES[archive_path].mtime != mtime:
+            close_archive(archive_path)
+
+        if archive_path not in ARCHIVES:
+            if archive_path.endswith(ZIP_EXTENSION):
+                archive = slice_zip(archive_path)
+            else:
+                archive = slice_archive(archive_path)
+            archive.mtime = mtime
+            ARCHIVES[archive_path] = archive
+
+        return ARCHIVES[archive_path]
+
+
+###############################################################################
+##
+#   Closes an archive or zip if it is open, before it is moved or replaced
+#
+#   @param  archive_path    Path to a slice archive or zip
+##
+###############################################################################
+def close_archive(archive_path):
+    with ARCHIVES_LOCK:
+        archive = ARCHIVES.pop(archive_path, None)
+    if archive:
+        archive.close()
+
+
+###############################################################################
+##
+#   Where a job keeps a file of its own, like its schedule or its index: in
+#   the slice directory, or next to an archive or zip
+#
+#   @param  object_path     Slice directory, archive, or "zip#folder" path
+#   @param  name            Kind of file, e.g. "schedule"
+#   @return path of the JSON file
+##
+###############################################################################
+def sidecar_path(object_path, name):
+    if os.path.isdir(object_path):
+        return os.path.join(object_path, name + ".json")
+    return object_path.replace('#', '.') + "." + name + ".json"
+
+
+###############################################################################
+##
+#   Opens an image by path, where the path may also name an archive layer
+#
+#   @param  image_path  Path to an image, "<archive path>#NNNN", or
+#                       "<zip path>#<member>"
+#   @return PIL image
+##
+###############################################################################
+def open_image(image_path):
+    archive_path, sep, layer = image_path.partition('#')
+    if sep and archive_path.endswith(ARCHIVE_EXTENSION):
+        return open_archive(archive_path).layer_image(int(layer))
+    if sep and archive_path.endswith(ZIP_EXTENSION):
+        return open_archive(archive_path).member_image(layer)
+
+    return Image.open(image_path)
+
+
+###############################################################################
+##
+#   Returns when the file behind an image path last changed
+#
+#   @param  image_path  Path to an image, archive layer or zip member
+#   @return modification time in seconds
+##
+###############################################################################
+def source_mtime(image_path):
+    return os.path.getmtime(image_path.partition('#')[0])
+
+
+###############################################################################
+##
+#   Returns the pixel data of an image as a string
+#
+#   @param  image   PIL image
+##
+###############################################################################
+def image_bytes(image):
+    # Older PILs only have tostring
+    if hasattr(image, 'tobytes'):
+        return image.tobytes()
+    return image.tostring()
+
+
+###############################################################################
+##
+#   Identifies an image by its pixels, whatever file it came from
+#
+#   @param  image   PIL image
+#   @return SHA-1 hex digest of the pixel data
+##
+###############################################################################
+def content_hash(image):
+    return hashlib.sha1(image_bytes(image)).hexdigest()
+
+
+###############################################################################
+##
+#   Packs a directory of slice images into an archive.  The archive is
+#   written under a temporary name and renamed into place when it is
+#   complete, so a failed pack leaves nothing behind.
+#
+#   @param  object_path     Directory path with slice images
+#   @param  archive_path    Slice archive to write
+#   @return number of layers packed
+##
+###############################################################################
+def pack_directory(object_path, archive_path):
+    slices = slice_directory(object_path)
+    if not slices.prefix:
+        raise ValueError("Missing slices in " + object_path)
+
+    size = Image.open(slices.layer_path(0)).size
+
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(archive_path) + ".",
+                                     dir=os.path.dirname(archive_path) or ".")
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            write_archive(f, slices, size)
+        finally:
+            f.close()
+        os.rename(temp_path, archive_path)
+    except:
+        os.remove(temp_path)
+        raise
+
+    return slices.num_slices
+
+
+###############################################################################
+##
+#   Writes the header, index and layers of an archive
+#
+#   @param  f       File to write to
+#   @param  slices  slice_directory to pack
+#   @param  size    (width, height) every layer must have
+##
+###############################################################################
+def write_archive(f, slices, size):
+    f.write(HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, size[0], size[1], slices.num_slices))
+    f.write("\0" * (INDEX_ENTRY.size * slices.num_slices))
+
+    index = []
+    for layer in xrange(slices.num_slices):
+        image = Image.open(slices.layer_path(layer)).convert('L')
+        if image.size != size:
+            raise ValueError("{:s} is {:d}x{:d}, expected {:d}x{:d}".format(
+                slices.layer_path(layer), image.size[0], image.size[1], size[0], size[1]))
+
+        bbox = image.getbbox()
+        if bbox is None:
+            index.append((f.tell(), 0, 0, 0, 0, 0, 0, ENCODING_EMPTY))
+            continue
+
+        crop = image.crop(bbox)
+        area = crop.point(lambda value: value and 255).histogram()[255]
+
+        data = image_bytes(crop)
+        encoding = ENCODING_RAW
+        encoded = rle_encode(data)
+        if len(encoded) < len(data):
+            data = encoded
+            encoding = ENCODING_RLE
+
+        index.append((f.tell(), len(data)) + bbox + (area, encoding))
+        f.write(data)
+
+    f.seek(HEADER.size)
+    for entry in index:
+        f.write(INDEX_ENTRY.pack(*entry))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or not os.path.isdir(sys.argv[1]):
+        print(usageStr)
+        exit()
+
+    print "Packed {:d} layers into {:s}".format(pack_directory(sys.argv[1], sys.argv[2]), sys.argv[2])
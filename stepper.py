@@ -0,0 +1,391 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+##
+#   Runs the lift's step pulses in a process of their own.
+#
+#   In the printer process the pulse loop shares the interpreter with image
+#   decoding, the pipe to the server and the status updates, and any of
+#   them, or a garbage collection, can hold a pulse back.  stepper_process
+#   starts a child that owns the GPIO pins and a BED_servo and does nothing
+#   but run the moves it is sent.  The child can be pinned to a core kept
+#   free of other work (isolcpus= on the kernel command line), run at
+#   SCHED_FIFO priority, and lock its memory so it never waits on a page
+#   fault.  Its garbage is only collected between moves.
+#
+#   stepper_process has the methods of BED_servo and stands in for it.  Each
+#   call is sent down a pipe as a command and waits for its reply, so moves
+#   still run one at a time and in order.
+##
+###############################################################################
+
+import os, gc, traceback
+import ctypes, ctypes.util
+from multiprocessing import Process, Pipe, RawValue
+from math import pi
+
+from servo import BED_servo
+from motion import monotonic, jitter_stats, CANCEL_POLL_INTERVAL
+
+# From <sched.h> and <sys/mman.h>
+SCHED_FIFO          = 1
+MCL_CURRENT         = 1
+MCL_FUTURE          = 2
+
+# Size of the kernel's cpu_set_t
+CPU_SETSIZE         = 1024
+
+# Seconds to wait for the child to stop at shutdown
+STEPPER_JOIN_TIMEOUT = 5.0
+
+
+class sched_param(ctypes.Structure):
+    _fields_ = [('sched_priority', ctypes.c_int)]
+
+
+###############################################################################
+##
+#   Calls a C library function of the calling process
+#
+#   @param  name    Name of the function
+#   @return nothing, raises OSError when the function fails
+##
+###############################################################################
+def _libc_call(name, *args):
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if getattr(libc, name)(*args) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+###############################################################################
+##
+#   Keeps the calling process on one CPU
+#
+#   @param  cpu     Number of the CPU, from 0
+##
+###############################################################################
+def pin_to_cpu(cpu):
+    word_bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // word_bits))()
+    mask[cpu // word_bits] = 1 << (cpu % word_bits)
+    _libc_call('sched_setaffinity', 0, ctypes.sizeof(mask), ctypes.byref(mask))
+
+
+###############################################################################
+##
+#   Runs the calling process ahead of every normal process on its CPU
+#
+#   @param  priority    SCHED_FIFO priority, 1 to 99
+##
+###############################################################################
+def set_fifo_priority(priority):
+    _libc_call('sched_setscheduler', 0, SCHED_FIFO, ctypes.byref(sched_param(priority)))
+
+
+###############################################################################
+##
+#   Keeps every page of the calling process, now and later, in memory
+##
+###############################################################################
+def lock_memory():
+    _libc_call('mlockall', MCL_CURRENT | MCL_FUTURE)
+
+
+###############################################################################
+##
+#   Applies what it can of the real-time settings to the calling process.
+#   They need root, or the matching capabilities, so a setting that fails
+#   is noted and the rest still applied.
+#
+#   SCHED_FIFO is only taken once the process is pinned.  The pulse wait
+#   spins for the last SPIN_THRESHOLD, which is all of it at high step
+#   rates, and a spinning real-time process would starve the projector and
+#   the web server of whatever CPU it ran on.
+#
+#   @param  cpu         CPU to pin to, or None
+#   @param  priority    SCHED_FIFO priority, or None
+#   @param  lock        True to lock the process's memory
+#   @return list of notes on what was done, for the console
+##
+###############################################################################
+def realtime_setup(cpu, priority, lock):
+    notes = []
+
+    def apply_setting(note, setting, *args):
+        try:
+            setting(*args)
+        except (OSError, AttributeError) as e:
+            notes.append("not " + note + ": " + str(e))
+            return False
+        notes.append(note)
+        return True
+
+    pinned = cpu is not None and apply_setting("pinned to CPU {:d}".format(cpu), pin_to_cpu, cpu)
+
+    if priority is not None:
+        if pinned:
+            apply_setting("SCHED_FIFO priority {:d}".format(priority), set_fifo_priority, priority)
+        else:
+            notes.append("not SCHED_FIFO: only taken on a pinned CPU")
+
+    if lock:
+        apply_setting("memory locked", lock_memory)
+
+    return notes
+
+
+###############################################################################
+##
+#   Reads the cancel flag the parent sets, in place of a motion.cancel_token
+##
+###############################################################################
+class shared_cancel(object):
+    def __init__(self, flag):
+        self.flag = flag
+
+    @property
+    def cancelled(self):
+        return self.flag.value != 0
+
+
+###############################################################################
+##
+#   Stands in for a motion.step_tracker in the child.  Each mark reached is
+#   sent to the parent with its time, and the parent's tracker told there.
+##
+###############################################################################
+class remote_tracker:
+    def __init__(self, conn, marks):
+        self.conn = conn
+        self.marks = marks
+        self.count = 0
+
+    def first_mark(self):
+        if self.marks:
+            return self.marks[0]
+        return -1
+
+    def reached(self):
+        self.conn.send(("mark", monotonic()))
+        self.count += 1
+        if self.count < len(self.marks):
+            return self.marks[self.count]
+        return -1
+
+    def finish(self):
+        pass
+
+
+###############################################################################
+##
+#   Body of the stepper process
+#
+#   @param  conn                Child end of the command pipe
+#   @param  cancel_flag         RawValue the parent sets to cancel a move
+#   @param  microns_per_step    See BED_servo
+#   @param  cpu                 CPU to pin to, or None
+#   @param  priority            SCHED_FIFO priority, or None
+#   @param  lock                True to lock the process's memory
+##
+###############################################################################
+def stepper_main(conn, cancel_flag, microns_per_step, cpu, priority, lock):
+    try:
+        notes = realtime_setup(cpu, priority, lock)
+        servo = BED_servo(microns_per_step)
+        servo.cancel = shared_cancel(cancel_flag)
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+        return
+
+    conn.send(("ready", notes, servo.microns_per_step, servo.steps_per_revolution))
+
+    # Garbage is collected between moves instead
+    gc.disable()
+
+    try:
+        while True:
+            command = conn.recv()
+            if command[0] == "quit":
+                break
+
+            name, args, kwargs, marks = command[1:]
+            if marks is not None:
+                kwargs = dict(kwargs, tracker=remote_tracker(conn, marks))
+
+            servo.jitter.clear()
+            try:
+                reply = ("done", getattr(servo, name)(*args, **kwargs))
+            except Exception:
+                reply = ("error", traceback.format_exc())
+            conn.send(reply + (servo.location, servo.last_move, servo.jitter))
+
+            gc.collect()
+    except (EOFError, IOError):
+        # The printer process is gone
+        pass
+    finally:
+        servo.shutdown()
+
+
+class stepper_process:
+    ###########################################################################
+    ##
+    #   Starts the stepper process
+    #
+    #   @param  microns_per_step    See BED_servo
+    #   @param  cpu                 CPU to pin the process to, or None
+    #   @param  priority            SCHED_FIFO priority, 1 to 99, or None
+    #                               for the normal scheduler
+    #   @param  lock                True to lock the process's memory
+    ##
+    ###########################################################################
+    def __init__(self, microns_per_step = 0.439453125, cpu=None, priority=None, lock=False):
+        self.conn, child_conn = Pipe()
+        self.cancel_flag = RawValue('b', 0)
+
+        self.process = Process(target=stepper_main, name="stepper",
+                               args=(child_conn, self.cancel_flag, microns_per_step, cpu, priority, lock))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        # Only the process that started the child may join it
+        self.owner = os.getpid()
+        self.running = True
+
+        try:
+            reply = self.conn.recv()
+        except EOFError:
+            reply = ("error", "exited with code {0}".format(self.process.exitcode))
+        if reply[0] == "error":
+            raise RuntimeError("Stepper process failed to start:\n" + reply[1])
+
+        notes, self.microns_per_step, self.steps_per_revolution = reply[1:]
+        for note in notes:
+            print "Stepper process " + note
+
+        self.location = 0   # home position
+        self.last_move = None
+
+        # motion.cancel_token that stops moves early, or None
+        self.cancel = None
+
+        # How late every step pulse went out, gathered from the child
+        self.jitter = jitter_stats()
+
+    ###########################################################################
+    ##
+    #   Runs a BED_servo method in the child and waits for it.  While it
+    #   runs, a cancel of self.cancel is passed on and the marks the move
+    #   reaches are passed to the tracker.
+    #
+    #   @param  name        Name of the BED_servo method
+    #   @param  args        Positional arguments of the method
+    #   @param  tracker     motion.step_tracker of the move, or None
+    #   @return what the method returned
+    ##
+    ###########################################################################
+    def run(self, name, args, tracker=None):
+        cancel = self.cancel
+        self.cancel_flag.value = int(bool(cancel and cancel.cancelled))
+
+        self.conn.send(("call", name, args, {}, tracker.marks if tracker else None))
+
+        try:
+            while True:
+                while not self.conn.poll(CANCEL_POLL_INTERVAL):
+                    if cancel and cancel.cancelled:
+                        self.cancel_flag.value = 1
+
+                reply = self.conn.recv()
+                if reply[0] != "mark":
+                    break
+                tracker.reached(reply[1])
+        finally:
+            if tracker:
+                tracker.finish()
+
+        kind, result, self.location, self.last_move, jitter = reply
+        self.jitter.merge(jitter)
+        if kind == "error":
+            raise RuntimeError("Stepper process: " + result)
+        return result
+
+    ###########################################################################
+    ##
+    #   Stops the child, which turns the servo off and cleans up the GPIO
+    ##
+    ###########################################################################
+    def shutdown(self):
+        if not self.running:
+            return
+        self.running = False
+
+        try:
+            self.conn.send(("quit",))
+        except (IOError, OSError):
+            # Already stopped from another process
+            pass
+
+        if os.getpid() == self.owner:
+            self.process.join(STEPPER_JOIN_TIMEOUT)
+
+    def reset(self):
+        return self.run("reset", ())
+
+    def on(self):
+        return self.run("on", ())
+
+    def off(self):
+        return self.run("off", ())
+
+    def move(self, steps=3200, speed=3200, accel=None, jerk=None):
+        return self.run("move", (steps, speed, accel, jerk))
+
+    def peel(self, depth, rise, speed_down, speed_up, dwell, settle, accel=None, jerk=None):
+        return self.run("peel", (depth, rise, speed_down, speed_up, dwell, settle, accel, jerk))
+
+    def run_segments(self, segments, stop_accel=None, tracker=None):
+        return self.run("run_segments", (segments, stop_accel), tracker)
+
+    def stream(self, stretches, tracker=None):
+        return self.run("stream", (stretches,), tracker)
+
+    def move_microns(self, distance, speed, accel=None, jerk=None):
+        return self.run("move_microns", (distance, speed, accel, jerk))
+
+    def move_to(self, location, speed, accel=None, jerk=None):
+        return self.run("move_to", (location, speed, accel, jerk))
+
+    def home(self, speed, accel=None, jerk=None):
+        return self.run("home", (speed, accel, jerk))
+
+    def reset_home(self):
+        return self.run("reset_home", ())
+
+    def microns_to_steps(self, accel, jerk):
+        if accel:
+            accel = accel / self.microns_per_step
+        if jerk:
+            jerk = jerk / self.microns_per_step
+        return accel, jerk
+
+    def get_location_microns(self):
+        return self.location * self.microns_per_step
+
+    def get_angle(self):
+        return ((self.location % self.steps_per_revolution) * pi) / self.steps_per_revolution
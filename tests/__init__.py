@@ -0,0 +1,107 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+###############################################################################
+##
+#   Tests of the printer's modules.  From the top of the repository, with
+#   Python 2:
+#
+#       python -m unittest discover -s tests -t .
+#
+#   The modules shared by pidish and the server are tested from the top
+#   directory, the server's own modules from server/.  None of the tests
+#   need the RPi's GPIO, pygame or a projector: the servo runs on a
+#   stub_gpio, even on the Pi.
+##
+###############################################################################
+
+import os, sys, imp, types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "server")]
+
+
+###############################################################################
+##
+#   Stands in for RPi.GPIO, counting the times each pin is set high
+##
+###############################################################################
+class stub_gpio(types.ModuleType):
+    BOARD = 10
+    OUT = 0
+
+    def __init__(self):
+        types.ModuleType.__init__(self, "RPi.GPIO")
+        self.levels = {}
+        self.rises = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction):
+        pass
+
+    def output(self, pin, level):
+        if level and not self.levels.get(pin):
+            self.rises[pin] = self.rises.get(pin, 0) + 1
+        self.levels[pin] = level
+
+    def cleanup(self):
+        self.levels.clear()
+
+
+###############################################################################
+##
+#   Imports servo.py with its pins on a new stub_gpio
+#
+#   @return the stub_gpio
+##
+###############################################################################
+def stub_servo_gpio():
+    gpio = stub_gpio()
+    try:
+        import RPi.GPIO
+    except ImportError:
+        rpi = types.ModuleType("RPi")
+        rpi.GPIO = gpio
+        sys.modules["RPi"] = rpi
+        sys.modules["RPi.GPIO"] = gpio
+
+    import servo
+    servo.GPIO = gpio
+    return gpio
+
+
+###############################################################################
+##
+#   Loads a fresh server/printer.py with SERVER_TEST set, as on a PC without
+#   the RPi, so it runs on the mock servo and projector
+#
+#   @return the printer module, also left in sys.modules for the model
+##
+###############################################################################
+def load_test_printer():
+    path = os.path.join(ROOT, "server", "printer.py")
+    f = open(path)
+    try:
+        source = f.read().replace("SERVER_TEST = False", "SERVER_TEST = True", 1)
+    finally:
+        f.close()
+
+    printer = imp.new_module("printer")
+    printer.__file__ = path
+    sys.modules["printer"] = printer
+    exec compile(source, path, "exec") in printer.__dict__
+    return printer
@@ -0,0 +1,97 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import eta
+from eta import peel_phases, plan_print, estimator, format_duration
+from motion import accelerated_profile
+
+MICRONS_PER_STEP = 0.5
+
+# depth, rise, speed down, speed up, dwell, settle: 1 s down, 2 s up
+PEEL = (1000, 900, 1000, 450, 0.5, 3.0)
+
+
+class plan_test(unittest.TestCase):
+    def test_peel_phases(self):
+        self.assertEqual(peel_phases(MICRONS_PER_STEP, *PEEL),
+                         [("lift down", 1.0), ("lift dwell", 0.5), ("lift up", 2.0), ("lift settle", 3.0)])
+
+    def test_accelerated_peel(self):
+        phases = dict(peel_phases(MICRONS_PER_STEP, *(PEEL + (2000, None))))
+
+        # Accelerations are given in microns, the profiles run in steps
+        self.assertEqual(phases["lift down"], accelerated_profile(2000, 2000, 4000)[-1])
+        self.assertGreater(phases["lift down"], 1.0)
+
+    def test_plan_print(self):
+        plan = plan_print([(None, 8.0), (PEEL, 1.0)], MICRONS_PER_STEP)
+
+        self.assertEqual(plan[0], [("exposure", 8.0)])
+        self.assertEqual([phase for phase, seconds in plan[1]],
+                         ["lift down", "lift dwell", "lift up", "lift settle", "exposure"])
+
+    def test_format_duration(self):
+        self.assertEqual(format_duration(0), "00:00:00")
+        self.assertEqual(format_duration(3725.6), "01:02:06")
+
+
+class estimator_test(unittest.TestCase):
+    def setUp(self):
+        # 7.5 s per layer: 6.5 s of peel and 1 s of exposure
+        self.estimate = estimator(plan_print([(PEEL, 1.0)] * 4, MICRONS_PER_STEP))
+
+    def test_planned(self):
+        self.assertEqual(self.estimate.planned_layer(0), 7.5)
+        self.assertEqual(self.estimate.remaining(0), 30.0)
+        self.assertEqual(self.estimate.remaining(3), 7.5)
+        self.assertEqual(self.estimate.remaining(4), 0)
+
+    def test_measured_phases_correct_the_plan(self):
+        # Exposures running at twice their planned time
+        self.estimate.measure("exposure", 0.0, 2.0, 1.0)
+        self.assertEqual(self.estimate.remaining(3), 8.5)
+
+        # Later measurements move the correction a step at a time
+        self.estimate.measure("exposure", 0.0, 1.0, 1.0)
+        self.assertAlmostEqual(self.estimate.ratios["exposure"], 2.0 + eta.EWMA_WEIGHT * (1.0 - 2.0))
+
+        # Phases without a plan are ignored
+        self.estimate.measure("command poll", 0.0, 5.0)
+        self.assertNotIn("command poll", self.estimate.ratios)
+
+    def test_time_between_phases(self):
+        self.estimate.layer_done(0, 9.5)
+        self.assertAlmostEqual(self.estimate.overhead, eta.EWMA_WEIGHT * 2.0)
+
+        # Layers that finish early do not make the overhead negative
+        self.estimate.layer_done(1, 1.0)
+        self.assertGreaterEqual(self.estimate.overhead, 0.0)
+
+    def test_summary(self):
+        lines = self.estimate.summary().split("\n")
+
+        # Longest phases first
+        self.assertEqual(lines[:3], ["4 layers, 00:00:30 planned",
+                                     "lift settle  00:00:12",
+                                     "lift up      00:00:08"])
+        self.assertEqual(sorted(lines[3:5]), ["exposure     00:00:04", "lift down    00:00:04"])
+        self.assertEqual(lines[5:], ["lift dwell   00:00:02"])
+
+
+if __name__ == '__main__':
+    unittest.main()
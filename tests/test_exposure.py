@@ -0,0 +1,176 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import motion
+import simulator
+from exposure import exposure_scheduler
+from motion import cancel_token
+
+DURATION = 0.05
+
+# Allowed error of a timed exposure, in seconds
+TOLERANCE = 0.02
+
+
+###############################################################################
+##
+#   Stands in for the projector, giving the time each frame was handed over
+##
+###############################################################################
+class stub_display:
+    def __init__(self, stamps=True):
+        self.stamps = stamps
+        self.shown = []
+
+    def show(self, what):
+        self.shown.append((what, motion.monotonic()))
+        if self.stamps:
+            return motion.monotonic()
+        return None
+
+    def display(self, image_path):
+        return self.show(image_path)
+
+    def black(self):
+        return self.show("black")
+
+
+class stub_telemetry:
+    def __init__(self):
+        self.records = []
+
+    def record(self, name, start, duration, planned=None, detail=""):
+        self.records.append((name, start, duration, planned, detail))
+
+
+class expose_test(unittest.TestCase):
+    def setUp(self):
+        self.display = stub_display()
+        self.telemetry = stub_telemetry()
+        self.exposures = exposure_scheduler(self.display, self.telemetry)
+
+    def test_exposure_runs_from_the_update_to_the_blank(self):
+        self.assertEqual(self.exposures.expose("1.png", DURATION), 0.0)
+
+        self.assertEqual([what for what, at in self.display.shown], ["1.png", "black"])
+        lit = self.display.shown[1][1] - self.display.shown[0][1]
+        self.assertAlmostEqual(lit, DURATION, delta=TOLERANCE)
+
+        name, start, duration, planned, detail = self.telemetry.records[0]
+        self.assertEqual((name, planned, detail), ("exposure", DURATION, "1.png"))
+        self.assertEqual(len(self.exposures.errors), 1)
+        self.assertAlmostEqual(self.exposures.errors[0], duration - DURATION)
+
+    def test_blank_is_asked_for_half_a_frame_early(self):
+        exposures = exposure_scheduler(self.display, self.telemetry, frame_rate=10)
+        exposures.expose("1.png", 0.2)
+
+        lit = self.display.shown[1][1] - self.display.shown[0][1]
+        self.assertAlmostEqual(lit, 0.15, delta=TOLERANCE)
+
+    def test_display_without_stamps_is_timed_from_the_call(self):
+        exposures = exposure_scheduler(stub_display(stamps=False), self.telemetry)
+        exposures.expose("1.png", DURATION)
+
+        self.assertAlmostEqual(exposures.errors[0], 0.0, delta=TOLERANCE)
+
+    def test_unblanked_image_is_left_up(self):
+        ran = []
+        self.exposures.expose("1.png", DURATION, during=lambda: ran.append(motion.monotonic()), blank=False)
+
+        self.assertEqual([what for what, at in self.display.shown], ["1.png"])
+        self.assertEqual(len(ran), 1)
+        self.assertGreaterEqual(ran[0], self.display.shown[0][1])
+
+    def test_cancel_returns_what_is_left(self):
+        cancel = cancel_token()
+        cancel.cancel("paused")
+
+        left = self.exposures.expose("1.png", 1.0, cancel)
+
+        self.assertAlmostEqual(left, 1.0, delta=TOLERANCE)
+        self.assertEqual([what for what, at in self.display.shown], ["1.png"])
+        self.assertEqual(self.exposures.errors, [])
+        self.assertEqual(len(self.telemetry.records), 1)
+
+    def test_summary(self):
+        self.assertEqual(self.exposures.summary(), "No exposures finished")
+
+        self.exposures.errors.extend([0.001, -0.003])
+        self.assertEqual(self.exposures.summary(),
+                         "2 exposures, -1.0 ms from the requested time on average, -3.0 ms at worst")
+
+
+###############################################################################
+##
+#   Streams runs of layers on the simulated lift and projector, on the
+#   virtual clock
+##
+###############################################################################
+class expose_stream_test(unittest.TestCase):
+    def setUp(self):
+        self.clock = motion.monotonic, motion.wait_until
+        simulator.install()
+        simulator.CLOCK.clear()
+
+        self.lift = simulator.BED_servo()
+        self.display = simulator.projector()
+        self.telemetry = stub_telemetry()
+        self.exposures = exposure_scheduler(self.display, self.telemetry)
+
+    def tearDown(self):
+        motion.use_clock(*self.clock)
+
+    def test_each_slice_goes_up_at_its_step(self):
+        layers = [("0.png", 100, 1.0), ("1.png", 100, 2.0), ("2.png", 50, 0.5)]
+        started = []
+
+        self.assertEqual(3, self.exposures.expose_stream(self.lift, layers, started=started.append))
+
+        self.assertEqual([1, 2], started)
+        self.assertAlmostEqual(250, self.lift.get_location_microns(), delta=self.lift.microns_per_step)
+        self.assertEqual(["stretch 0", "stretch 1", "stretch 2"],
+                         [e.name for e in simulator.CLOCK.events("lift")])
+
+        # Slices go up at the refresh after their step
+        for error in self.exposures.errors:
+            self.assertLessEqual(abs(error), 1.001 / simulator.FRAME_RATE)
+        self.assertEqual(["0.png", "1.png", "2.png"], [detail for name, start, duration, planned, detail in self.telemetry.records])
+        self.assertEqual("2.png", self.display.shown)
+
+    def test_layers_thinner_than_a_step_are_refused(self):
+        layers = [("0.png", 100, 1.0), ("1.png", 0.1, 1.0), ("2.png", 100, 1.0)]
+
+        self.assertRaises(ValueError, self.exposures.expose_stream, self.lift, layers)
+        self.assertEqual([], simulator.CLOCK.events())
+
+    def test_cancel_stops_the_run(self):
+        cancel = cancel_token()
+        self.lift.cancel = cancel
+        layers = [("0.png", 100, 1.0), ("1.png", 100, 1.0), ("2.png", 100, 1.0)]
+
+        self.assertEqual(1, self.exposures.expose_stream(self.lift, layers, cancel, lambda i: cancel.cancel("paused")))
+
+        # The simulated lift only stops between stretches
+        self.assertAlmostEqual(100, self.lift.get_location_microns(), delta=self.lift.microns_per_step)
+        self.assertEqual(1, len(self.exposures.errors))
+        self.assertEqual(2, len(self.telemetry.records))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, sys, shutil, tempfile, threading, unittest
+from StringIO import StringIO
+
+from tests import load_test_printer
+
+
+###############################################################################
+##
+#   Runs a model, with its printer process on the mock servo and projector,
+#   in a folder of its own
+##
+###############################################################################
+class model_test(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+
+        self.output = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO()
+
+        # The model runs whichever printer module it was imported with
+        load_test_printer()
+        import model
+        reload(model)
+        self.model = model.model()
+        self.model.start()
+
+        # Later status changes are then the test's own
+        snapshot = self.model.wait_status(0, 5)
+        self.assertEqual("Ready", snapshot["title"])
+
+    def tearDown(self):
+        self.model.shutdown()
+        self.model.join(5)
+        sys.stdout, sys.stderr = self.output
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+
+class saved_variables_test(model_test):
+    def read_variables(self):
+        f = open("printer_variables.txt")
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_saves_command_variables(self):
+        self.model.send_command({"command": "refresh_list", "exposure_time": "9.5"})
+        self.assertIn("exposure_time: 9.5\r\n", self.read_variables())
+
+    def test_concurrent_saves_keep_the_file_whole(self):
+        def save(speed):
+            for _ in xrange(50):
+                with self.model.lock:
+                    self.model.lift_speed = speed
+                self.model.save_printer_variables()
+
+        threads = [threading.Thread(target=save, args=(speed,)) for speed in (1000, 2000, 3000)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        lines = self.read_variables().split("\r\n")
+        self.assertEqual(len(self.model.saved_variables) + 1, len(lines))
+        self.assertIn(lines[0], ("lift_speed: 1000", "lift_speed: 2000", "lift_speed: 3000"))
+        self.assertFalse(os.path.exists("printer_variables.txt.tmp"))
+
+
+class upload_status_test(model_test):
+    def test_reports_whole_percents(self):
+        version = self.model.status_snapshot()["version"]
+        self.model.report_upload(10, 1000)
+        self.model.report_upload(11, 1000)
+        snapshot = self.model.status_snapshot()
+        self.assertEqual((11, 1000), snapshot["upload"])
+        self.assertEqual(version + 1, snapshot["version"])
+
+    def test_end_upload_wakes_waiters(self):
+        self.model.report_upload(10, 100)
+        version = self.model.status_snapshot()["version"]
+
+        threading.Timer(0.1, self.model.end_upload).start()
+        snapshot = self.model.wait_status(version, 5)
+        self.assertIsNone(snapshot["upload"])
+        self.assertGreater(snapshot["version"], version)
+
+
+class printer_reply_test(model_test):
+    def wait_replied(self):
+        # Replies are handled under the lock, and status is notified after
+        with self.model.lock:
+            while self.model.pending_commands:
+                self.model.status_changed.wait(5)
+            return self.model.status_snapshot()
+
+    def test_reply_clears_the_pending_command(self):
+        # The reply waits for the lock
+        with self.model.lock:
+            command_id = self.model.send_printer("home", {})
+            self.assertEqual({command_id: "home"}, self.model.pending_commands)
+
+        self.wait_replied()
+        self.assertEqual({}, self.model.pending_commands)
+
+    def test_replies_match_their_commands(self):
+        first = self.model.send_printer("home", {})
+        second = self.model.send_printer("bogus", {})
+        self.assertNotEqual(first, second)
+
+        self.wait_replied()
+        self.assertIn("Printer refused bogus: Unknown command bogus", sys.stdout.getvalue())
+        self.assertNotIn("Printer refused home", sys.stdout.getvalue())
+
+    def test_refused_pause_leaves_nothing_paused(self):
+        self.model.send_command({"command": "Pause"})
+
+        snapshot = self.wait_replied()
+        self.assertFalse(snapshot["paused"])
+        self.assertIn("Printer refused Pause: Not printing", sys.stdout.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
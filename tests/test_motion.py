@@ -0,0 +1,157 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading, unittest
+
+import motion
+from motion import accelerated_profile, constant_rate_profile, hold_profile, stopping_profile, \
+    wait_until, cancel_token, step_tracker, jitter_stats
+
+# Allowed error of a timed wait, in seconds
+TOLERANCE = 0.01
+
+
+class profile_test(unittest.TestCase):
+    def check_profile(self, profile, steps, speed):
+        self.assertEqual(len(profile), steps + 1)
+        self.assertEqual(profile[0], 0.0)
+
+        periods = [b - a for a, b in zip(profile, profile[1:])]
+        self.assertGreater(min(periods), 0.0)
+        self.assertGreaterEqual(min(periods), 1.0 / speed - 1e-9)
+
+        # Slows down to a stop the way it sped up
+        total = profile[-1]
+        for n in xrange(steps + 1):
+            self.assertAlmostEqual(profile[n] + profile[steps - n], total)
+
+    def test_constant_rate(self):
+        self.assertEqual(list(constant_rate_profile(4, 2)), [0.0, 0.5, 1.0, 1.5, 2.0])
+        self.assertEqual(accelerated_profile(4, 2), constant_rate_profile(4, 2))
+
+    def test_hold(self):
+        self.assertEqual(list(hold_profile(1.5)), [1.5])
+
+    def test_fastest_rate_keeps_the_pin_high_and_low(self):
+        profile = constant_rate_profile(10, motion.MAX_STEP_RATE)
+        for a, b in zip(profile, profile[1:]):
+            self.assertGreaterEqual(b - a, 2 * motion.MIN_PULSE_WIDTH - 1e-12)
+
+    def test_trapezoid(self):
+        profile = accelerated_profile(3200, 1600, 3200)
+        self.check_profile(profile, 3200, 1600)
+
+        # Cruises at full speed between the ramps
+        self.assertAlmostEqual(profile[1601] - profile[1600], 1.0 / 1600)
+        self.assertAlmostEqual(profile[-1], 3200.0 / 1600 + 1600.0 / 3200, places=3)
+
+    def test_short_move_peaks_below_speed(self):
+        profile = accelerated_profile(100, 1600, 3200)
+        self.check_profile(profile, 100, 1600)
+
+        # Speeds up for half the move and slows down for the other half
+        self.assertAlmostEqual(profile[-1], 2 * (100.0 / 3200) ** 0.5, places=2)
+        self.assertGreater(profile[51] - profile[50], 1.0 / 1600)
+
+    def test_s_curve(self):
+        trapezoid = accelerated_profile(3200, 1600, 3200)
+        profile = accelerated_profile(3200, 1600, 3200, 16000)
+        self.check_profile(profile, 3200, 1600)
+
+        # Limiting the jerk makes the ramps longer
+        self.assertGreater(profile[-1], trapezoid[-1])
+        self.assertGreater(profile[1] - profile[0], trapezoid[1] - trapezoid[0])
+
+    def test_stopping(self):
+        profile = stopping_profile(100, 1000)
+        self.assertEqual(len(profile), 6)
+        self.assertAlmostEqual(profile[-1], 0.1)
+
+        # Pulses spread out as the lift slows, and it is at rest by the end
+        pulses = [0.0] + list(profile[:-1])
+        periods = [b - a for a, b in zip(pulses, pulses[1:])]
+        self.assertEqual(periods, sorted(periods))
+        self.assertGreaterEqual(profile[-1], profile[-2])
+
+
+class wait_test(unittest.TestCase):
+    def test_wait_until(self):
+        deadline = motion.monotonic() + 0.05
+        late = wait_until(deadline)
+        self.assertGreaterEqual(late, 0.0)
+        self.assertLess(late, TOLERANCE)
+        self.assertGreaterEqual(motion.monotonic(), deadline)
+
+    def test_past_deadline(self):
+        self.assertGreater(wait_until(motion.monotonic() - 1.0), 0.9)
+
+    def test_cancelled_wait_ends_early(self):
+        cancel = cancel_token()
+        threading.Timer(0.05, cancel.cancel, ("stopped",)).start()
+
+        start = motion.monotonic()
+        late = wait_until(start + 1.0, cancel)
+
+        self.assertLess(late, 0.0)
+        self.assertAlmostEqual(motion.monotonic() - start, 0.05, delta=motion.CANCEL_POLL_INTERVAL + TOLERANCE)
+        self.assertEqual(cancel.reason, "stopped")
+
+    def test_cancel_token_sleep(self):
+        cancel = cancel_token()
+        self.assertEqual(cancel.sleep(0.01), 0.0)
+
+        cancel.cancel()
+        self.assertAlmostEqual(cancel.sleep(1.0), 1.0, delta=TOLERANCE)
+
+        cancel.clear()
+        self.assertFalse(cancel.cancelled)
+        self.assertIsNone(cancel.reason)
+
+
+class step_tracker_test(unittest.TestCase):
+    def test_marks(self):
+        tracker = step_tracker([10, 20])
+        self.assertEqual(tracker.first_mark(), 10)
+        self.assertEqual(tracker.reached(1.0), 20)
+
+        threading.Timer(0.02, tracker.finish).start()
+        self.assertEqual(tracker.wait(0), 1.0)
+        self.assertIsNone(tracker.wait(1))
+
+    def test_no_marks(self):
+        self.assertEqual(step_tracker([]).first_mark(), -1)
+
+
+class jitter_stats_test(unittest.TestCase):
+    def test_stats(self):
+        stats = jitter_stats()
+        self.assertEqual(stats.summary(), "No step pulses timed")
+
+        for late in [0.000005] * 98 + [0.0002, 0.002]:
+            stats.add(late)
+
+        other = jitter_stats()
+        other.add(0.003)
+        stats.merge(other)
+
+        self.assertEqual((stats.count, stats.late, stats.worst), (101, 2, 0.003))
+        self.assertEqual(stats.percentile(0.5), 0.00001)
+        self.assertEqual(stats.percentile(0.99), 0.005)
+        self.assertEqual(stats.percentile(1.0), 0.005)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from PIL import Image
+
+import peeling
+from peeling import peel_policy, layer_stats, measure_image
+from schedule import slice_schedule
+
+SETTLE = 8.0
+
+# The server's directions: three burn-in layers, then full dips
+DIRECTIONS = [[0, "dip", 2.5], [3, "dip", 1.0]]
+
+TINY = layer_stats(100, 100)
+SMALL = layer_stats(10000, 5000)
+LARGE = layer_stats(300000, 200000)
+
+
+class choose_test(unittest.TestCase):
+    def setUp(self):
+        self.policy = peel_policy(SETTLE)
+
+    def test_tiny_layers_move_continuously(self):
+        self.assertEqual(self.policy.choose(TINY), {"method": "cont"})
+
+    def test_small_islands_get_a_short_dip(self):
+        fields = self.policy.choose(SMALL)
+        self.assertEqual(fields["method"], "dip")
+        self.assertEqual(fields["dip_distance"], peeling.SHORT_DIP_DISTANCE)
+        self.assertEqual(fields["dip_speed"], peeling.SHORT_DIP_SPEED)
+        self.assertAlmostEqual(fields["settle"], SETTLE * peeling.MIN_SETTLE_FRACTION)
+
+    def test_large_layers_keep_the_full_dip(self):
+        self.assertEqual(self.policy.choose(LARGE), {"settle": SETTLE})
+
+    def test_many_small_islands_are_not_continuous(self):
+        # Small islands, but too much area in all to pull through the resin
+        fields = self.policy.choose(layer_stats(peeling.CONT_MAX_AREA + 1, 10))
+        self.assertNotEqual(fields.get("method"), "cont")
+
+
+class adapt_test(unittest.TestCase):
+    def test_first_layers_are_kept(self):
+        schedule = slice_schedule(DIRECTIONS, 6)
+        counts = peel_policy(SETTLE, 3).adapt(schedule, [TINY] * 6)
+
+        for layer in xrange(3):
+            self.assertEqual(schedule[layer].method, "dip")
+            self.assertEqual(schedule[layer].time, 2.5)
+            self.assertNotIn(layer, schedule.overrides)
+        for layer in xrange(3, 6):
+            self.assertEqual(schedule[layer].method, "cont")
+        self.assertEqual(counts, {"cont": 3})
+
+    def test_job_overrides_and_other_methods_are_kept(self):
+        schedule = slice_schedule([[0, "dip", 1.0], [2, "slow dip", 1.0]], 4, {"1": {"dip_speed": 50}})
+        counts = peel_policy(SETTLE).adapt(schedule, [TINY] * 4)
+
+        self.assertEqual(schedule[0].method, "cont")
+        self.assertEqual(schedule[1].method, "dip")
+        self.assertEqual(schedule[1].dip_speed, 50)
+        self.assertEqual(schedule[2].method, "slow dip")
+        self.assertEqual(counts, {"cont": 1})
+
+    def test_counts(self):
+        schedule = slice_schedule(DIRECTIONS, 6)
+        counts = peel_policy(SETTLE, 3).adapt(schedule, [TINY, TINY, TINY, TINY, SMALL, LARGE])
+        self.assertEqual(counts, {"cont": 1, "short dip": 1, "dip": 1})
+        self.assertEqual(peeling.format_counts(counts), "1 cont, 1 dip, 1 short dip")
+
+
+class measure_image_test(unittest.TestCase):
+    def test_islands(self):
+        image = Image.new('L', (20, 20), 0)
+        image.paste(255, (0, 0, 4, 4))      # 16 pixels
+        image.paste(255, (4, 4, 7, 7))      # 9 pixels, touching the first at a corner
+        image.paste(255, (14, 14, 18, 18))  # 16 pixels, apart
+
+        stats = measure_image(image)
+        self.assertEqual(stats.area, 41)
+        if peeling.numpy is not None:
+            self.assertEqual(stats.island, 25)
+
+    def test_blank(self):
+        self.assertEqual(measure_image(Image.new('L', (8, 8), 0)), layer_stats(0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, sys, shutil, tempfile, threading, unittest
+from StringIO import StringIO
+
+from PIL import Image
+
+from tests import load_test_printer
+from schedule import slice_schedule, load_schedule, schedule_path, ADAPTED_NAME
+from telemetry import load_spans
+from messages import command_msg, reply_msg
+
+EXPOSURE_TIME = 0.05
+
+
+###############################################################################
+##
+#   Stands in for the printer's end of the pipe to the model
+##
+###############################################################################
+class stub_conn:
+    def __init__(self, received=()):
+        self.sent = []
+        self.received = list(received)
+
+    def send(self, message):
+        self.sent.append(message)
+
+    # The model hangs up once the messages run out
+    def recv(self):
+        if not self.received:
+            raise EOFError()
+        return self.received.pop(0)
+
+
+###############################################################################
+##
+#   Runs prints through server/printer.py in SERVER_TEST mode, in a folder of
+#   their own, with the printer's console output kept out of the test run
+##
+###############################################################################
+class server_test_print(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+
+        self.output = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO()
+
+        self.printer = load_test_printer()
+        self.printer.SERVER_CONN = stub_conn()
+        self.printer.ADAPTIVE_PEEL = False
+
+        self.job = os.path.join(self.folder, "part.slice")
+        os.mkdir(self.job)
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.output
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def print_layers(self, directions, num_slices):
+        for layer in xrange(num_slices):
+            image = Image.new('L', (16, 16), 0)
+            image.paste(255, (2, 2, 6, 6))
+            image.save(os.path.join(self.job, "part{:04d}.png".format(layer)))
+        slice_schedule(directions, num_slices).save(schedule_path(self.job))
+
+        self.printer.print_object({"object_path": self.job, "exposure_time": str(EXPOSURE_TIME)})
+
+        # A print that fails shuts the printer down
+        self.assertTrue(self.printer.IS_RUNNING, sys.stdout.getvalue())
+        return [(s['name'], int(s['layer'])) for s in load_spans("telemetry.csv")]
+
+
+class print_object_test(server_test_print):
+    def test_dip_layer(self):
+        spans = self.print_layers([[0, "dip", 1.0]], 1)
+
+        for name in ("lift down", "lift dwell", "lift up", "lift settle", "exposure"):
+            self.assertIn((name, 0), spans)
+
+        # Only a print is stopped by CANCEL
+        self.assertIsNone(self.printer.LIFT.cancel)
+
+    def stream_calls(self, pause_after=None):
+        lift = self.printer.LIFT
+        calls = []
+        stream = lift.stream
+        def record_stream(stretches, tracker=None):
+            if pause_after and not calls:
+                threading.Timer(pause_after, self.printer.interrupt_print, ("Pause",)).start()
+                threading.Timer(pause_after + 0.1, self.printer.interrupt_print, ("Unpause",)).start()
+            calls.append(stretches)
+            return stream(stretches, tracker)
+        lift.stream = record_stream
+        return calls
+
+    def test_schedule_is_saved_with_the_job(self):
+        self.printer.ADAPTIVE_PEEL = True
+        self.print_layers([[0, "dip", 1.0]], 4)
+        os.remove(schedule_path(self.job))
+
+        self.printer.print_object({"object_path": self.job, "exposure_time": str(EXPOSURE_TIME)})
+
+        directions = self.printer.SLICE_DIRECTIONS
+        self.assertEqual(load_schedule(self.job, [], 4).to_dict()["directions"], [list(d) for d in directions])
+        adapted = load_schedule(self.job, [], 4, ADAPTED_NAME)
+        self.assertEqual(range(self.printer.FIRST_SLICE_NUM, 4), sorted(adapted.overrides))
+
+    def test_cont_layers_stream_as_one_move(self):
+        calls = self.stream_calls()
+
+        spans = self.print_layers([[0, "cont", 1.0]], 3)
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([self.printer.SLICE_THICKNESS] * 3, [distance for distance, speed in calls[0]])
+        for layer in xrange(3):
+            self.assertIn(("exposure", layer), spans)
+        self.assertEqual(1, spans.count(("exposure", 2)))
+
+    ###########################################################################
+    ##
+    #   A pause in the middle of a run of "cont" layers stops the lift.  Once
+    #   unpaused the rest of that layer is streamed with the layers after it.
+    ##
+    ###########################################################################
+    def test_pause_during_cont_layers(self):
+        lift = self.printer.LIFT
+        calls = self.stream_calls(pause_after=1.5 * EXPOSURE_TIME)
+        travel = []
+        home = lift.home
+        lift.home = lambda *args: travel.append(lift.get_location_microns()) or home(*args)
+
+        spans = self.print_layers([[0, "cont", 1.0]], 3)
+
+        self.assertEqual(2, len(calls))
+        self.assertEqual(2, len(calls[1]))
+        self.assertLess(calls[1][0][0], self.printer.SLICE_THICKNESS)
+        self.assertAlmostEqual(3 * self.printer.SLICE_THICKNESS, travel[-1], delta=lift.microns_per_step)
+        self.assertEqual(2, spans.count(("exposure", 1)))
+        self.assertIn(("exposure", 2), spans)
+
+    ###########################################################################
+    ##
+    #   A pause during the dwell leaves the lift at the bottom of the peel.
+    #   Once unpaused it goes back to where the peel started and peels again.
+    ##
+    ###########################################################################
+    def test_pause_during_peel(self):
+        lift = self.printer.LIFT
+        hold = lift.hold
+        paused = []
+        def pause_in_dwell(duration):
+            if not paused:
+                paused.append(True)
+                threading.Timer(0.05, self.printer.interrupt_print, ("Pause",)).start()
+                threading.Timer(0.2, self.printer.interrupt_print, ("Unpause",)).start()
+            return hold(duration)
+        lift.hold = pause_in_dwell
+
+        spans = self.print_layers([[0, "dip", 1.0]], 1)
+
+        titles = [message.title for message in self.printer.SERVER_CONN.sent if hasattr(message, 'title')]
+        self.assertIn("Paused", titles)
+        self.assertEqual(spans.count(("lift down", 0)), 2)
+        self.assertEqual(spans.count(("exposure", 0)), 1)
+        self.assertIn("Servo.move {:d} of".format(-int(self.printer.DIP_DISTANCE / self.printer.LIFT.microns_per_step)),
+                      sys.stdout.getvalue())
+
+
+###############################################################################
+##
+#   Passes commands through the printer's listener, as the model sends them
+##
+###############################################################################
+class listen_server_test(server_test_print):
+    def listen(self, *messages):
+        self.printer.SERVER_CONN = stub_conn(messages)
+        self.printer.listen_server()
+
+        queued = []
+        while not self.printer.COMMANDS.empty():
+            queued.append(self.printer.COMMANDS.get().name)
+        return self.printer.SERVER_CONN.sent, queued
+
+    def test_interrupts_are_refused_outside_a_print(self):
+        sent, queued = self.listen(command_msg(1, "Abort", {}), command_msg(2, "Pause", {}))
+
+        self.assertEqual([reply_msg(1, False, "Not printing"), reply_msg(2, False, "Not printing")], sent)
+        self.assertEqual(["shutdown"], queued)
+        self.assertFalse(self.printer.CANCEL.cancelled)
+
+    def test_abort_for_a_queued_print_leaves_a_home_alone(self):
+        lift = self.printer.LIFT
+        lift.location = 1000
+
+        sent, queued = self.listen(command_msg(1, "home", {}), command_msg(2, "print_object", {}),
+                                   command_msg(3, "Abort", {}))
+        self.assertEqual([reply_msg(3, True, None)], sent)
+        self.assertEqual(["home", "print_object", "shutdown"], queued)
+        self.assertTrue(self.printer.CANCEL.cancelled)
+
+        # The main loop then runs the home ahead of the aborted print
+        self.printer.home()
+        self.assertEqual(0, lift.location)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, shutil, tempfile, unittest
+
+from PIL import Image, ImageChops
+
+from tests import ROOT
+
+# Nothing is shown; the screen is a surface in memory
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+try:
+    import pygame
+    import projector
+except ImportError:
+    pygame = None
+
+SIZE = 64, 48
+
+
+@unittest.skipIf(pygame is None or projector.numpy is None, "needs pygame and numpy")
+class vignette_test(unittest.TestCase):
+    def setUp(self):
+        self.vignette = Image.open(os.path.join(ROOT, "vignette.png")).convert('L')
+        projector.GAIN_MAPS.clear()
+
+    def test_matches_pil_multiply(self):
+        slice_image = Image.new('L', self.vignette.size, 200)
+        slice_image.paste(255, (100, 100, 400, 300))
+
+        corrected = projector.apply_vignette(slice_image, self.vignette)
+        expected = projector.numpy.asarray(ImageChops.multiply(slice_image, self.vignette), dtype=projector.numpy.int16)
+
+        self.assertLessEqual(abs(corrected.astype(projector.numpy.int16) - expected).max(), 1)
+
+    def test_gain_map_scaled_once_per_size(self):
+        gain = projector.vignette_gain_map(self.vignette, SIZE)
+
+        self.assertEqual((SIZE[1], SIZE[0]), gain.shape)
+        self.assertIs(gain, projector.vignette_gain_map(self.vignette, SIZE))
+        self.assertEqual([SIZE], projector.GAIN_MAPS.keys())
+        self.assertLessEqual(gain.max(), 256)
+
+
+@unittest.skipIf(pygame is None, "needs pygame")
+class frame_cache_test(unittest.TestCase):
+    def setUp(self):
+        # 16x16 8-bit frames take 256 bytes each
+        self.cache = projector.frame_cache(budget=3 * 256)
+
+    def frame(self):
+        return projector.frame(pygame.Surface((16, 16), 0, 8), None)
+
+    def put(self, name):
+        prepared = self.frame()
+        self.cache.put(name, 1.0, True, "hash " + name, prepared)
+        return prepared
+
+    def test_oldest_dropped_over_budget(self):
+        for name in "abcd":
+            self.put(name)
+
+        self.assertEqual(3 * 256, self.cache.used)
+        self.assertEqual(None, self.cache.get("a", 1.0, True))
+        self.assertNotEqual(None, self.cache.get("d", 1.0, True))
+
+    def test_displayed_frames_kept(self):
+        self.put("a")
+        self.put("b")
+        self.put("c")
+        self.cache.get("a", 1.0, True)
+        self.put("d")
+
+        self.assertNotEqual(None, self.cache.get("a", 1.0, True))
+        self.assertEqual(None, self.cache.get("b", 1.0, True))
+
+    def test_same_pixels_share_a_frame(self):
+        prepared = self.put("a")
+
+        self.assertEqual(None, self.cache.get("b", 1.0, True))
+        self.assertIs(prepared, self.cache.get("b", 1.0, True, "hash a"))
+        self.assertIs(prepared, self.cache.get("b", 1.0, True))
+        self.assertEqual(1, len(self.cache.frames))
+
+    def test_changed_file_missed(self):
+        self.put("a")
+
+        self.assertEqual(None, self.cache.get("a", 2.0, True))
+        self.assertEqual(None, self.cache.get("a", 1.0, False))
+
+    def test_frame_over_budget_not_kept(self):
+        self.cache.put("a", 1.0, True, "hash a", projector.frame(pygame.Surface((64, 64), 0, 8), None))
+
+        self.assertEqual(0, self.cache.used)
+        self.assertEqual(None, self.cache.get("a", 1.0, True))
+        self.assertEqual(1, self.cache.misses)
+
+
+class small_screen:
+    current_w, current_h = SIZE
+
+
+@unittest.skipIf(pygame is None, "needs pygame")
+class projector_test(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(ROOT)
+
+        self.info, self.update = pygame.display.Info, pygame.display.update
+        self.updates = []
+        pygame.display.Info = lambda: small_screen
+
+        self.projector = projector.projector()
+        pygame.display.update = self.record_update
+
+    def tearDown(self):
+        self.projector.shutdown()
+        pygame.display.Info, pygame.display.update = self.info, self.update
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def record_update(self, rects):
+        self.updates.append(rects)
+        self.update(rects)
+
+    def slice_image(self, name, box=None):
+        image = Image.new('L', SIZE)
+        if box:
+            image.paste(255, box)
+        path = os.path.join(self.folder, name)
+        image.save(path)
+        return path
+
+    def lit(self, point):
+        return self.projector.screen.get_at(point)[:3] != projector.BLACK
+
+
+class blit_test(projector_test):
+    def test_only_the_lit_part_is_drawn(self):
+        self.projector.display(self.slice_image("a.png", (10, 5, 20, 15)))
+
+        self.assertEqual(pygame.Rect(10, 5, 10, 10), self.projector.lit_rect)
+        self.assertEqual([[pygame.Rect(10, 5, 10, 10)]], self.updates)
+        self.assertTrue(self.lit((12, 7)))
+        self.assertFalse(self.lit((5, 5)))
+
+    def test_last_slice_cleared(self):
+        self.projector.display(self.slice_image("a.png", (10, 5, 20, 15)))
+        self.projector.display(self.slice_image("b.png", (30, 20, 40, 30)))
+
+        self.assertEqual([pygame.Rect(10, 5, 10, 10), pygame.Rect(30, 20, 10, 10)], self.updates[-1])
+        self.assertFalse(self.lit((12, 7)))
+        self.assertTrue(self.lit((32, 22)))
+
+    def test_blank_slice_has_nothing_to_draw(self):
+        blank = self.slice_image("blank.png")
+
+        self.assertEqual(None, self.projector.prepare(blank).rect)
+        self.projector.display(blank)
+        self.assertEqual(None, self.projector.lit_rect)
+        self.assertEqual([[]], self.updates)
+
+    def test_black_clears_the_lit_part(self):
+        self.projector.display(self.slice_image("a.png", (10, 5, 20, 15)))
+        self.projector.black()
+
+        self.assertEqual(None, self.projector.lit_rect)
+        self.assertEqual(pygame.Rect(10, 5, 10, 10), self.updates[-1])
+        self.assertFalse(self.lit((12, 7)))
+
+        # Nothing is lit, so there is nothing to clear
+        self.projector.black()
+        self.assertEqual(2, len(self.updates))
+
+
+class prefetch_test(projector_test):
+    def settle(self):
+        with self.projector.prepared_cond:
+            while self.projector.in_flight:
+                self.projector.prepared_cond.wait()
+
+    def test_display_takes_the_prefetched_frame(self):
+        path = self.slice_image("a.png", (10, 5, 20, 15))
+        self.projector.prefetch([path])
+        self.projector.display(path)
+
+        self.assertEqual((0, 1), (self.projector.frames.hits, self.projector.frames.misses))
+        self.assertEqual({}, self.projector.prepared)
+        self.assertTrue(self.lit((12, 7)))
+
+    def test_slices_no_longer_listed_are_dropped(self):
+        a = self.slice_image("a.png", (10, 5, 20, 15))
+        b = self.slice_image("b.png", (30, 20, 40, 30))
+        self.projector.prefetch([a, b])
+        self.settle()
+        self.projector.prefetch([b])
+
+        self.assertEqual([b], self.projector.prepared.keys())
+        self.assertEqual(None, self.projector.take_prepared(a))
+
+    def test_failures_are_left_for_display(self):
+        missing = os.path.join(self.folder, "missing.png")
+        self.projector.prefetch([missing])
+
+        self.assertEqual(None, self.projector.take_prepared(missing))
+        self.assertRaises(EnvironmentError, self.projector.display, missing)
+
+
+if __name__ == '__main__':
+    unittest.main()
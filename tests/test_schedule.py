@@ -0,0 +1,109 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, sys, json, shutil, tempfile, unittest
+from StringIO import StringIO
+
+from schedule import slice_schedule, load_schedule, save_schedule, schedule_path, directive, ADAPTED_NAME
+
+DIRECTIONS = [[0, "bottom", 8], [3, "dip", 1.0], [10, "cont", 1.0]]
+
+
+class slice_schedule_test(unittest.TestCase):
+    def test_ranges(self):
+        schedule = slice_schedule(DIRECTIONS, 12)
+
+        self.assertEqual(len(schedule), 12)
+        self.assertEqual(schedule[0], directive("bottom", 8, None, None, None, None))
+        self.assertEqual(schedule[2].method, "bottom")
+        self.assertEqual(schedule[3].method, "dip")
+        self.assertEqual(schedule[9].method, "dip")
+        self.assertEqual(schedule[11].method, "cont")
+        self.assertRaises(IndexError, lambda: schedule[12])
+        self.assertRaises(IndexError, lambda: schedule[-1])
+
+    def test_directions_must_start_at_zero_in_order(self):
+        self.assertRaises(ValueError, slice_schedule, [[1, "dip", 1.0]], 5)
+        self.assertRaises(ValueError, slice_schedule, [[0, "dip", 1.0], [4, "dip", 1.0], [2, "cont", 1.0]], 5)
+        self.assertRaises(ValueError, slice_schedule, [], 5)
+
+    def test_overrides(self):
+        schedule = slice_schedule(DIRECTIONS, 12, {"5": {"method": "slow dip", "dip_speed": 100}})
+        schedule.set_override(5, settle=2.0)
+
+        self.assertEqual(schedule[5], directive("slow dip", 1.0, None, None, 100, 2.0))
+        self.assertEqual(schedule[4], directive("dip", 1.0, None, None, None, None))
+        self.assertRaises(ValueError, schedule.set_override, 6, speed=3)
+
+
+class load_schedule_test(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(suffix=".slice")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_defaults_without_a_file(self):
+        schedule = load_schedule(self.folder, DIRECTIONS, 12)
+        self.assertEqual(schedule.to_dict()["directions"], DIRECTIONS)
+        self.assertEqual(schedule.overrides, {})
+
+    def test_save_and_load(self):
+        schedule = slice_schedule([[0, "dip", 2.5], [3, "dip", 1.0]], 12)
+        schedule.set_override(7, time=1.5, thickness=50)
+        schedule.save(schedule_path(self.folder))
+        self.assertEqual(schedule_path(self.folder), os.path.join(self.folder, "schedule.json"))
+
+        loaded = load_schedule(self.folder, DIRECTIONS, 12)
+        self.assertEqual(loaded.to_dict(), schedule.to_dict())
+        self.assertEqual(loaded[7], directive("dip", 1.5, 50, None, None, None))
+
+    def test_overrides_only(self):
+        with open(schedule_path(self.folder), 'w') as f:
+            json.dump({"overrides": {"11": {"method": "slow dip"}}}, f)
+
+        loaded = load_schedule(self.folder, DIRECTIONS, 12)
+        self.assertEqual(loaded[11].method, "slow dip")
+        self.assertEqual(loaded[3].method, "dip")
+
+    def test_adapted_schedule_is_kept_apart(self):
+        schedule = slice_schedule(DIRECTIONS, 12)
+        schedule.set_override(4, dip_distance=500)
+        save_schedule(schedule, self.folder, ADAPTED_NAME)
+
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, "adapted_schedule.json")))
+        self.assertFalse(os.path.exists(schedule_path(self.folder)))
+        self.assertEqual(load_schedule(self.folder, DIRECTIONS, 12, ADAPTED_NAME)[4].dip_distance, 500)
+        self.assertEqual(load_schedule(self.folder, DIRECTIONS, 12)[4].dip_distance, None)
+
+    def test_failed_save_is_reported(self):
+        output = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            save_schedule(slice_schedule(DIRECTIONS, 12), os.path.join(self.folder, "missing", "part.pds"))
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = output
+
+        self.assertIn("Could not save the schedule", printed)
+
+    def test_sidecar_next_to_an_archive(self):
+        self.assertEqual(schedule_path("jobs/part.pds"), "jobs/part.pds.schedule.json")
+        self.assertEqual(schedule_path("jobs/parts.zip#a.slice"), "jobs/parts.zip.a.slice.schedule.json")
+
+
+if __name__ == '__main__':
+    unittest.main()
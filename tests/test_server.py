@@ -0,0 +1,151 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import httplib, json, os, threading, unittest, zipfile
+from StringIO import StringIO
+
+from tests import ROOT
+from tests.test_model import model_test
+
+
+###############################################################################
+##
+#   Serves the model of each test on a port of its own
+##
+###############################################################################
+class server_test(model_test):
+    def setUp(self):
+        super(server_test, self).setUp()
+
+        import server
+        reload(server)
+        server.SYNC_MODEL = self.model
+        server.LONG_POLL_TIMEOUT = 5
+
+        self.httpd = server.PooledHTTPServer(("127.0.0.1", 0), server.MyHandler, 2)
+        self.httpd.timeout = 0.1
+        self.serving = threading.Thread(target=self.httpd.serve_forever, args=(0.1,))
+        self.serving.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.serving.join()
+        self.httpd.server_close()
+        super(server_test, self).tearDown()
+
+    def connect(self):
+        return httplib.HTTPConnection("127.0.0.1", self.httpd.server_address[1], timeout=10)
+
+    def get(self, path):
+        connection = self.connect()
+        connection.request("GET", path)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+
+class poll_test(server_test):
+    def test_answers_at_once_when_behind(self):
+        status, page = self.get("/poll?since=-1")
+        self.assertEqual(200, status)
+        self.assertEqual("Ready", json.loads(page)["title"])
+
+    def test_waits_for_a_newer_status(self):
+        version = self.model.status_snapshot()["version"]
+        threading.Timer(0.2, self.model.report_upload, (5, 10)).start()
+
+        status, page = self.get("/poll?since=%d" % version)
+        self.assertEqual(200, status)
+        snapshot = json.loads(page)
+        self.assertEqual(version + 1, snapshot["version"])
+        self.assertEqual([5, 10], snapshot["upload"])
+
+    def test_rejects_a_bad_version(self):
+        status, page = self.get("/poll?since=abc")
+        self.assertEqual(400, status)
+
+
+class events_test(server_test):
+    def test_streams_status_changes(self):
+        connection = self.connect()
+        connection.request("GET", "/events")
+        response = connection.getresponse()
+        self.assertEqual(200, response.status)
+        self.assertEqual("text/event-stream", response.getheader("content-type"))
+
+        first = self.model.status_snapshot()["version"]
+        self.assertEqual("id: %d\n" % first, response.fp.readline())
+        self.assertEqual("Ready", json.loads(response.fp.readline()[len("data: "):])["title"])
+        self.assertEqual("\n", response.fp.readline())
+
+        self.model.report_upload(1, 2)
+        self.assertEqual("id: %d\n" % (first + 1), response.fp.readline())
+        self.assertEqual([1, 2], json.loads(response.fp.readline()[len("data: "):])["upload"])
+        connection.close()
+
+
+class upload_test(server_test):
+    def post_upload(self, data):
+        body = ("--frontier\r\nContent-Disposition: form-data; name=\"command\"\r\n\r\nupload\r\n"
+                "--frontier\r\nContent-Disposition: form-data; name=\"datafile\"; filename=\"part.zip\"\r\n\r\n" +
+                data + "\r\n--frontier--\r\n")
+        connection = self.connect()
+        connection.request("POST", "/", body, {"Content-Type": "multipart/form-data; boundary=frontier"})
+        return connection.getresponse().status
+
+    def zip_of(self, *members):
+        data = StringIO()
+        archive = zipfile.ZipFile(data, 'w')
+        for member in members:
+            archive.writestr(member, "slice")
+        archive.close()
+        return data.getvalue()
+
+    def test_zip_is_kept_as_its_object(self):
+        # The pages are read from the server's folder
+        import view
+        os.chdir(os.path.join(ROOT, "server"))
+        try:
+            view.load(self.model)
+        finally:
+            os.chdir(self.folder)
+
+        self.assertEqual(200, self.post_upload(self.zip_of("part.slice/part0000.png")))
+        self.assertTrue(os.path.isfile("part.slice.zip"))
+
+    def test_zip_names_outside_the_folder_are_refused(self):
+        for member in ("../part.slice/part0000.png", "a\\..\\part.slice/part0000.png"):
+            self.assertEqual(400, self.post_upload(self.zip_of(member)))
+        self.assertEqual(["printer_variables.txt"], os.listdir("."))
+
+    def test_upload_that_is_not_a_zip_is_refused(self):
+        self.assertEqual(400, self.post_upload("not a zip"))
+        self.assertEqual(["printer_variables.txt"], os.listdir("."))
+
+    def test_failed_upload_clears_its_status(self):
+        self.model.report_upload(1, 2)
+        version = self.model.status_snapshot()["version"]
+
+        body = "--frontier\r\nContent-Disposition: form-data; name=\"datafile\"; filename=\"part.zip\"\r\n\r\nno end"
+        connection = self.connect()
+        connection.request("POST", "/", body, {"Content-Type": "multipart/form-data; boundary=frontier"})
+        self.assertEqual(400, connection.getresponse().status)
+
+        snapshot = self.model.wait_status(version, 5)
+        self.assertIsNone(snapshot["upload"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import unittest
+
+import motion
+from tests import stub_servo_gpio
+
+GPIO = stub_servo_gpio()
+from servo import BED_servo
+
+# Allowed time between the phases of a peel, in seconds
+GAP = 0.002
+
+
+class servo_test(unittest.TestCase):
+    def setUp(self):
+        GPIO.rises.clear()
+        self.servo = BED_servo()
+        self.step = lambda distance: int(distance / self.servo.microns_per_step)
+
+    def pulses(self):
+        return GPIO.rises.get(self.servo.step_pin, 0)
+
+
+class peel_test(servo_test):
+    def test_peel_runs_without_gaps(self):
+        begin = motion.monotonic()
+        reports = self.servo.peel(100, 50, 1000, 1000, 0.05, 0.05)
+        elapsed = motion.monotonic() - begin
+
+        self.assertEqual(["down", "dwell", "settle", "up"], sorted(reports))
+        self.assertEqual(self.step(100), reports["down"]["done"])
+        self.assertEqual(self.step(50), reports["up"]["done"])
+        self.assertEqual(self.step(100) + self.step(50), self.pulses())
+        self.assertEqual(self.step(100) - self.step(50), self.servo.location)
+
+        # One phase starts as the last ends
+        self.assertAlmostEqual(sum(report["elapsed"] for report in reports.values()), elapsed, delta=GAP)
+        self.assertGreaterEqual(elapsed, sum(report["planned"] for report in reports.values()))
+
+    def test_move_reports_its_steps(self):
+        report = self.servo.move(-40, 2000)
+
+        self.assertEqual((40, 40, False), (report["steps"], report["done"], report["cancelled"]))
+        self.assertEqual(-40, self.servo.location)
+        self.assertEqual(report, self.servo.last_move)
+
+
+class stream_test(servo_test):
+    def test_stretches_add_up_to_the_distance(self):
+        # 100 microns is 227.6 steps, so the stretches round to 228 and 227
+        reports = self.servo.stream([(100, 2000), (100, 2000), (100, 2000)])
+
+        self.assertEqual(["stretch 0", "stretch 1", "stretch 2"], sorted(reports))
+        self.assertEqual([228, 227, 228], [reports["stretch {:d}".format(n)]["done"] for n in range(3)])
+        self.assertEqual(int(round(300 / self.servo.microns_per_step)), self.servo.location)
+        self.assertEqual(self.servo.location, self.pulses())
+
+    def test_tracker_hears_each_mark(self):
+        marks = [1, 228, 400, 455]
+        tracker = motion.step_tracker(marks)
+        waited = []
+
+        def follow():
+            for index in range(len(marks) + 1):
+                waited.append(tracker.wait(index))
+
+        follower = threading.Thread(target=follow)
+        follower.start()
+        self.servo.stream([(100, 2000), (100, 2000)], tracker)
+        follower.join(1.0)
+
+        self.assertTrue(tracker.finished)
+        self.assertEqual(len(marks), len(tracker.reached_at))
+        self.assertEqual(tracker.reached_at + [None], waited)
+        self.assertEqual(sorted(tracker.reached_at), tracker.reached_at)
+
+        # 172 steps at 4551 steps/s from mark 228 to mark 400
+        self.assertAlmostEqual(172 / 4551.0, tracker.reached_at[2] - tracker.reached_at[1], delta=GAP)
+
+    def test_tracker_is_finished_by_a_cancel(self):
+        cancel = motion.cancel_token()
+        cancel.cancel("Abort")
+        self.servo.cancel = cancel
+        tracker = motion.step_tracker([10])
+
+        self.servo.stream([(100, 2000)], tracker)
+
+        self.assertTrue(tracker.finished)
+        self.assertEqual(None, tracker.wait(0))
+
+
+class cancel_test(servo_test):
+    def test_cancel_decelerates_to_a_stop(self):
+        cancel = motion.cancel_token()
+        self.servo.cancel = cancel
+        at_cancel = []
+
+        def stop():
+            at_cancel.append(self.pulses())
+            cancel.cancel("Abort")
+
+        # Cancelled at full speed, part way through the move
+        timer = threading.Timer(0.5, stop)
+        timer.start()
+        report = self.servo.move(1000, 1000, 4000)
+        timer.join()
+
+        self.assertTrue(report["cancelled"])
+        self.assertLess(report["done"], report["steps"])
+        self.assertEqual(report["done"], self.servo.location)
+        self.assertEqual(report["done"], self.pulses())
+
+        # Stopping from 1000 steps/s at 4000 steps/s^2 takes about 125 steps
+        self.assertGreater(report["done"] - at_cancel[0], 50)
+        self.assertLess(report["done"] - at_cancel[0], 200)
+
+    def test_cancel_skips_the_segments_left(self):
+        cancel = motion.cancel_token()
+        cancel.cancel("Abort")
+        self.servo.cancel = cancel
+
+        reports = self.servo.peel(100, 50, 1000, 1000, 0.05, 0.05)
+
+        self.assertEqual(["down"], reports.keys())
+        self.assertEqual(0, reports["down"]["done"])
+        self.assertEqual(0, self.pulses())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, csv, shutil, tempfile, unittest
+
+import motion
+import simulator
+from motion import accelerated_profile, cancel_token
+from simulator import CLOCK
+
+
+class simulator_test(unittest.TestCase):
+    def setUp(self):
+        self.clock = motion.monotonic, motion.wait_until
+        simulator.install()
+        CLOCK.clear()
+        self.start = CLOCK.time
+
+    def tearDown(self):
+        motion.use_clock(*self.clock)
+
+
+class virtual_clock_test(simulator_test):
+    def test_waits_jump_the_clock(self):
+        self.assertEqual(0.0, motion.wait_until(self.start + 5.0))
+        self.assertEqual(self.start + 5.0, motion.monotonic())
+
+        # A deadline already gone is late, and the clock stays put
+        self.assertEqual(1.0, motion.wait_until(self.start + 4.0))
+        self.assertEqual(self.start + 5.0, CLOCK.time)
+
+    def test_cancelled_wait_takes_no_time(self):
+        cancel = cancel_token()
+        cancel.cancel("Abort")
+
+        self.assertEqual(2.0, cancel.sleep(2.0))
+        self.assertEqual(self.start, CLOCK.time)
+
+    def test_step_rate_limit_stretches_fast_moves(self):
+        slow = accelerated_profile(100, 1000)
+        fast = accelerated_profile(100, 2 * simulator.SIM_STEP_RATE_LIMIT)
+
+        self.assertEqual(slow[-1], simulator.limited_duration(slow))
+        self.assertAlmostEqual(100.0 / simulator.SIM_STEP_RATE_LIMIT, simulator.limited_duration(fast))
+
+
+class servo_test(simulator_test):
+    def setUp(self):
+        simulator_test.setUp(self)
+        self.lift = simulator.BED_servo()
+
+    def test_peel_phases_follow_one_another(self):
+        reports = self.lift.peel(1000, 500, 2000, 2000, 0.5, 0.25)
+        events = CLOCK.events("lift")
+
+        self.assertEqual(["down", "dwell", "up", "settle"], [e.name for e in events])
+        for before, after in zip(events, events[1:]):
+            self.assertAlmostEqual(before.time + before.duration, after.time)
+        self.assertEqual([reports[e.name]["elapsed"] for e in events], [e.duration for e in events])
+        self.assertAlmostEqual(0.5, reports["dwell"]["elapsed"])
+        self.assertAlmostEqual(500, self.lift.get_location_microns(), delta=self.lift.microns_per_step)
+
+    def test_cancel_stops_between_phases(self):
+        self.lift.cancel = cancel_token()
+        self.lift.cancel.cancel("Pause")
+
+        self.assertEqual({}, self.lift.peel(1000, 500, 2000, 2000, 0.5, 0.25))
+        self.assertEqual(self.start, CLOCK.time)
+
+    def test_moves_need_the_driver_awake(self):
+        self.lift.off()
+        self.assertRaises(RuntimeError, self.lift.move, 100, 1000)
+
+        self.lift.on()
+        self.assertEqual(100, self.lift.move(100, 1000)["done"])
+
+
+class projector_test(simulator_test):
+    def setUp(self):
+        simulator_test.setUp(self)
+        self.display = simulator.projector()
+
+    def test_frames_go_up_at_a_refresh(self):
+        CLOCK.sleep(0.001)
+        shown_at = self.display.display("0.png")
+
+        self.assertAlmostEqual(shown_at * simulator.FRAME_RATE, round(shown_at * simulator.FRAME_RATE))
+        self.assertGreater(shown_at, self.start)
+        self.assertEqual("0.png", self.display.shown)
+
+    def test_black_is_left_alone(self):
+        self.display.black()
+        self.assertEqual([], CLOCK.events())
+
+        self.display.display("0.png")
+        CLOCK.sleep(1.0)
+        self.display.black()
+
+        self.assertEqual(["black", "0.png"], [e.detail for e in CLOCK.events("projector")])
+        self.assertAlmostEqual(1.0, CLOCK.events("projector")[1].duration, delta=1.001 / simulator.FRAME_RATE)
+
+
+class timeline_test(simulator_test):
+    def setUp(self):
+        simulator_test.setUp(self)
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        simulator_test.tearDown(self)
+
+    def test_summary_and_csv(self):
+        lift = simulator.BED_servo()
+        display = simulator.projector()
+
+        display.display("0.png")
+        CLOCK.sleep(2.0)
+        display.black()
+        lift.peel(1000, 500, 2000, 2000, 0.5, 0.25)
+
+        self.assertIn(": 1 frames, 2.0s exposed, 2 lift moves", simulator.summary())
+
+        path = os.path.join(self.folder, "timeline.csv")
+        simulator.save_timeline(path)
+        f = open(path, 'rb')
+        try:
+            rows = list(csv.reader(f))
+        finally:
+            f.close()
+
+        self.assertEqual(list(simulator.event._fields), rows[0])
+        self.assertEqual(len(CLOCK.events()), len(rows) - 1)
+        self.assertEqual(sorted(float(row[0]) for row in rows[1:]), [float(row[0]) for row in rows[1:]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, shutil, tempfile, unittest
+
+from PIL import Image
+
+import sliceindex
+from slicepack import open_slices
+
+
+class sliceindex_test(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(suffix=".slice")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_layer(self, layer, size=(16, 16), lit=(2, 2, 6, 6)):
+        image = Image.new('L', size, 0)
+        image.paste(255, lit)
+        image.save(os.path.join(self.folder, "part{:04d}.png".format(layer)))
+
+    def test_build_and_load(self):
+        for layer in xrange(3):
+            self.write_layer(layer)
+
+        index = sliceindex.build_index(self.folder, 1)
+        self.assertEqual(index.errors(), [])
+        self.assertEqual(index.layers[0].bbox, (2, 2, 6, 6))
+        self.assertEqual(index.stats()[0].area, 16)
+
+        # Only the index is left behind, no temporary files
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         ["index.json", "part0000.png", "part0001.png", "part0002.png"])
+
+        loaded = sliceindex.load_index(self.folder)
+        self.assertEqual(loaded.layers, index.layers)
+
+    def test_mismatched_layer(self):
+        self.write_layer(0)
+        self.write_layer(1, size=(8, 8))
+
+        errors = sliceindex.build_index(self.folder, 1).errors()
+        self.assertEqual(len(errors), 1)
+        self.assertIn("Layer 1 is 8x8", errors[0])
+
+    def test_changed_job_is_out_of_date(self):
+        self.write_layer(0)
+        sliceindex.build_index(self.folder, 1)
+
+        self.write_layer(1)
+        self.assertIsNone(sliceindex.load_index(self.folder))
+
+    def test_stamp_without_layer_files(self):
+        # Numbered from 1, so the layers looked for are not there
+        self.write_layer(1)
+        self.assertEqual(sliceindex.source_stamp(open_slices(self.folder)), [1, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
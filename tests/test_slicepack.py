@@ -0,0 +1,147 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, shutil, tempfile, zipfile, unittest
+
+from PIL import Image, ImageChops
+
+import slicepack
+from slicepack import open_slices, open_image, pack_directory, rle_encode, rle_decode, \
+    slice_archive, slice_directory, zip_slices
+
+
+class rle_test(unittest.TestCase):
+    def setUp(self):
+        self.numpy = slicepack.numpy
+
+    def tearDown(self):
+        slicepack.numpy = self.numpy
+
+    def round_trip(self):
+        for data in ["", "\0", "ab", "\0" * 1000 + "\xff" * 3 + "\x80", "".join(chr(i % 7) for i in xrange(600))]:
+            encoded = rle_encode(data)
+            self.assertEqual(len(encoded) % 2, 0)
+            self.assertEqual(rle_decode(encoded), data)
+
+    def test_round_trip(self):
+        self.round_trip()
+
+    def test_round_trip_without_numpy(self):
+        slicepack.numpy = None
+        self.round_trip()
+
+    def test_long_runs_are_split(self):
+        self.assertEqual(rle_encode("\x07" * 600), "\xff\x07\xff\x07\x5a\x07")
+
+
+class slices_test(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.folder = os.path.join(self.temp, "part.slice")
+        os.mkdir(self.folder)
+        self.archive_path = os.path.join(self.temp, "part.pds")
+
+    def tearDown(self):
+        slicepack.close_archive(self.archive_path)
+        shutil.rmtree(self.temp)
+
+    def write_layer(self, layer, size=(16, 16), lit=(2, 2, 6, 6), value=255):
+        image = Image.new('L', size, 0)
+        if lit:
+            image.paste(value, lit)
+        image.save(os.path.join(self.folder, "part{:04d}.png".format(layer)))
+        return image
+
+    def test_pack_and_read(self):
+        images = [self.write_layer(0),
+                  self.write_layer(1, lit=None),
+                  self.write_layer(2, lit=(0, 5, 16, 11), value=128)]
+
+        self.assertEqual(pack_directory(self.folder, self.archive_path), 3)
+        self.assertEqual(sorted(os.listdir(self.temp)), ["part.pds", "part.slice"])
+
+        slices = open_slices(self.archive_path)
+        self.assertIsInstance(slices, slice_archive)
+        self.assertEqual((slices.num_slices, slices.size), (3, (16, 16)))
+        self.assertEqual(slices.layer_bbox(0), (2, 2, 6, 6))
+        self.assertEqual(slices.layer_area(0), 16)
+        self.assertIsNone(slices.layer_bbox(1))
+        self.assertEqual(slices.layer_area(2), 96)
+
+        for layer, image in enumerate(images):
+            decoded = open_image(slices.layer_path(layer))
+            self.assertIsNone(ImageChops.difference(decoded, image).getbbox())
+
+    def test_failed_pack_leaves_nothing(self):
+        self.write_layer(0)
+        self.write_layer(1, size=(8, 8))
+
+        with open(self.archive_path, 'wb') as f:
+            f.write("old")
+
+        self.assertRaises(ValueError, pack_directory, self.folder, self.archive_path)
+        self.assertEqual(sorted(os.listdir(self.temp)), ["part.pds", "part.slice"])
+        with open(self.archive_path, 'rb') as f:
+            self.assertEqual(f.read(), "old")
+
+    def test_replaced_archive_is_reopened(self):
+        self.write_layer(0)
+        pack_directory(self.folder, self.archive_path)
+        first = open_slices(self.archive_path)
+        self.assertIs(open_slices(self.archive_path), first)
+
+        self.write_layer(1)
+        pack_directory(self.folder, self.archive_path)
+        os.utime(self.archive_path, (0, first.mtime + 1))
+
+        second = open_slices(self.archive_path)
+        self.assertIsNot(second, first)
+        self.assertEqual(second.num_slices, 2)
+
+    def test_open_directory(self):
+        self.assertIsNone(open_slices(self.folder))
+
+        self.write_layer(0)
+        self.write_layer(1)
+        slices = open_slices(self.folder)
+        self.assertIsInstance(slices, slice_directory)
+        self.assertEqual(slices.num_slices, 2)
+        self.assertEqual(slices.layer_path(1), os.path.join(self.folder, "part0001.png"))
+
+    def test_open_zip(self):
+        image = self.write_layer(0)
+        self.write_layer(1)
+
+        zip_path = os.path.join(self.temp, "parts.zip")
+        self.archive_path = zip_path
+        z = zipfile.ZipFile(zip_path, 'w')
+        for name in sorted(os.listdir(self.folder)):
+            z.write(os.path.join(self.folder, name), "part.slice/" + name)
+        z.close()
+
+        self.assertIsNone(open_slices(zip_path + "#missing"))
+
+        slices = open_slices(zip_path + "#part.slice")
+        self.assertIsInstance(slices, zip_slices)
+        self.assertEqual(slices.num_slices, 2)
+        self.assertEqual(slices.archive.object_paths(), [zip_path + "#part.slice"])
+
+        decoded = open_image(slices.layer_path(0))
+        self.assertIsNone(ImageChops.difference(decoded, image).getbbox())
+
+
+if __name__ == '__main__':
+    unittest.main()
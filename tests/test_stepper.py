@@ -0,0 +1,116 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from multiprocessing import Process, Pipe
+
+from tests import stub_servo_gpio
+
+stub_servo_gpio()
+import stepper
+
+
+def failing(*args):
+    raise OSError(1, "Operation not permitted")
+
+
+def passing(*args):
+    pass
+
+
+def allowed_cpus():
+    f = open("/proc/self/status")
+    try:
+        for line in f:
+            if line.startswith("Cpus_allowed_list:"):
+                return line.split(":")[1].strip()
+    finally:
+        f.close()
+
+
+def pinned_child(conn):
+    conn.send((stepper.realtime_setup(0, None, False), allowed_cpus()))
+    conn.close()
+
+
+class realtime_setup_test(unittest.TestCase):
+    def setUp(self):
+        self.saved = stepper.pin_to_cpu, stepper.set_fifo_priority, stepper.lock_memory
+
+    def tearDown(self):
+        stepper.pin_to_cpu, stepper.set_fifo_priority, stepper.lock_memory = self.saved
+
+    def patch(self, pin, fifo, lock):
+        stepper.pin_to_cpu, stepper.set_fifo_priority, stepper.lock_memory = pin, fifo, lock
+
+    def test_notes_every_setting_taken(self):
+        self.patch(passing, passing, passing)
+
+        self.assertEqual(["pinned to CPU 3", "SCHED_FIFO priority 50", "memory locked"],
+                         stepper.realtime_setup(3, 50, True))
+
+    def test_fifo_needs_a_pinned_cpu(self):
+        self.patch(failing, passing, passing)
+
+        notes = stepper.realtime_setup(3, 50, False)
+
+        self.assertEqual(2, len(notes))
+        self.assertTrue(notes[0].startswith("not pinned to CPU 3: "))
+        self.assertEqual("not SCHED_FIFO: only taken on a pinned CPU", notes[1])
+
+        self.assertEqual(["not SCHED_FIFO: only taken on a pinned CPU"], stepper.realtime_setup(None, 50, False))
+
+    def test_failures_are_noted_not_raised(self):
+        self.patch(passing, failing, failing)
+
+        notes = stepper.realtime_setup(1, 50, True)
+
+        self.assertEqual("pinned to CPU 1", notes[0])
+        self.assertTrue(notes[1].startswith("not SCHED_FIFO priority 50: "))
+        self.assertTrue(notes[2].startswith("not memory locked: "))
+
+    def test_nothing_asked_nothing_done(self):
+        self.patch(failing, failing, failing)
+
+        self.assertEqual([], stepper.realtime_setup(None, None, False))
+
+    def test_pins_the_calling_process(self):
+        parent, child = Pipe()
+        process = Process(target=pinned_child, args=(child,))
+        process.start()
+        notes, cpus = parent.recv()
+        process.join()
+
+        self.assertEqual(["pinned to CPU 0"], notes)
+        self.assertEqual("0", cpus)
+
+
+class remote_tracker_test(unittest.TestCase):
+    def test_sends_each_mark(self):
+        parent, child = Pipe()
+        tracker = stepper.remote_tracker(child, [5, 9])
+
+        self.assertEqual(5, tracker.first_mark())
+        self.assertEqual(9, tracker.reached())
+        self.assertEqual(-1, tracker.reached())
+
+        for n in range(2):
+            kind, at = parent.recv()
+            self.assertEqual("mark", kind)
+        self.assertFalse(parent.poll())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, json, shutil, tempfile, threading, time, unittest
+
+import telemetry
+from motion import move_report
+from telemetry import span_log, load_spans, chrome_trace, export_chrome_trace
+
+
+class telemetry_test(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.folder, "telemetry.csv")
+        self.log = span_log()
+        self.log.start(self.csv_path)
+
+    def tearDown(self):
+        self.log.stop()
+        shutil.rmtree(self.folder)
+
+    def spans(self):
+        self.log.stop()
+        return load_spans(self.csv_path)
+
+
+class record_moves_test(telemetry_test):
+    def test_phases_follow_one_another(self):
+        reports = {"down": move_report(100, 100, 0.5, 0.52, 0.001, False),
+                   "dwell": move_report(0, 0, 0.25, 0.25, 0.0, False),
+                   "up": move_report(50, 50, 0.25, 0.3, 0.002, False)}
+
+        self.log.layer = 4
+        self.log.record_moves(10.0, reports, telemetry.PEEL_SEGMENTS)
+        spans = self.spans()
+
+        self.assertEqual(["lift down", "lift dwell", "lift up"], [s['name'] for s in spans])
+        self.assertEqual([10.0, 10.52, 10.77], [round(float(s['start']), 6) for s in spans])
+        self.assertEqual([0.5, 0.25, 0.25], [float(s['planned']) for s in spans])
+        self.assertEqual(["4"] * 3, [s['layer'] for s in spans])
+
+    def test_nothing_recorded_when_stopped(self):
+        self.log.stop()
+        self.log.record_moves(0.0, {"up": move_report(1, 1, 0.1, 0.1, 0.0, False)}, ["up"])
+
+        self.assertEqual([], load_spans(self.csv_path))
+
+
+class deferred_test(telemetry_test):
+    def test_deferred_work_runs_on_the_log_thread(self):
+        ran = []
+        self.log.defer(lambda: ran.append(threading.current_thread().name))
+        self.log.drain()
+
+        self.assertEqual(["log"], ran)
+
+    def test_drain_waits_for_slow_work(self):
+        ran = []
+        self.log.defer(lambda: (time.sleep(0.05), ran.append(True)))
+        self.assertEqual([], ran)
+
+        self.log.drain()
+        self.assertEqual([True], ran)
+        self.assertGreaterEqual(self.log.deferred_time, 0.05)
+
+    def test_runs_inline_when_stopped(self):
+        self.log.stop()
+        ran = []
+        self.log.defer(lambda: ran.append(threading.current_thread().name))
+
+        self.assertEqual([threading.current_thread().name], ran)
+
+    def test_summary_counts_work_off_the_print_thread(self):
+        worker = threading.Thread(target=self.log.record, args=("image load", 0.0, 0.4), name="prefetch")
+        worker.start()
+        worker.join()
+        self.log.record("image load", 1.0, 0.1)
+        self.log.record("prefetch wait", 1.5, 0.1)
+        self.log.drain()
+
+        summary = self.log.summary()
+        self.assertEqual(0.4, self.log.overlapped["image load"])
+        self.assertEqual([1, 0.1], self.log.totals["prefetch wait"][:2])
+        self.assertIn("image load 0.40s", summary)
+        self.assertIn("waited on 0.10s", summary)
+
+
+class chrome_trace_test(telemetry_test):
+    def test_export(self):
+        self.log.layer = 2
+        self.log.record("exposure", 1.5, 2.0, 2.0, "0002.png")
+        self.log.record("image load", 1.0, 0.25)
+        json_path = os.path.join(self.folder, "trace.json")
+        self.log.stop()
+
+        export_chrome_trace(self.csv_path, json_path)
+        f = open(json_path)
+        try:
+            trace = json.load(f)
+        finally:
+            f.close()
+
+        events = trace["traceEvents"]
+        self.assertEqual("ms", trace["displayTimeUnit"])
+        self.assertEqual({"name": "thread_name", "ph": "M", "pid": 1, "tid": 1, "args": {"name": "MainThread"}},
+                         events[0])
+
+        exposure = events[1]
+        self.assertEqual(("exposure", "X", 1), (exposure["name"], exposure["ph"], exposure["tid"]))
+        self.assertAlmostEqual(1500000.0, exposure["ts"])
+        self.assertAlmostEqual(2000000.0, exposure["dur"])
+        self.assertEqual({"layer": 2, "planned_ms": 2000.0, "detail": "0002.png"}, exposure["args"])
+
+        self.assertEqual({"layer": 2}, events[2]["args"])
+
+    def test_one_track_per_thread(self):
+        spans = [{"name": "a", "layer": "0", "thread": "print", "start": "0", "duration": "1", "planned": "", "detail": ""},
+                 {"name": "b", "layer": "0", "thread": "prefetch", "start": "0", "duration": "1", "planned": "", "detail": ""},
+                 {"name": "c", "layer": "1", "thread": "print", "start": "1", "duration": "1", "planned": "", "detail": ""}]
+
+        events = chrome_trace(spans)["traceEvents"]
+
+        self.assertEqual(["M", "X", "M", "X", "X"], [e["ph"] for e in events])
+        self.assertEqual([1, 1, 2, 2, 1], [e["tid"] for e in events])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+# Copyright (C) 2015  Drew Garrido
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, shutil, tempfile, unittest, urllib, zipfile
+from string import Template
+from HTMLParser import HTMLParser
+from StringIO import StringIO
+
+from PIL import Image
+
+import upload
+import view
+import slicepack
+
+
+###############################################################################
+##
+#   Collects the option values of a page, as the browser would submit them
+##
+###############################################################################
+class option_values(HTMLParser):
+    def __init__(self, page):
+        HTMLParser.__init__(self)
+        self.values = []
+        self.feed(page)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "option":
+            self.values.append(dict(attrs)["value"])
+
+
+class stub_model:
+    is_paused = False
+    is_printing = False
+    lift_amount = lift_speed = cali_min_time = cali_max_time = exposure_time = 0
+
+    def __init__(self, object_paths):
+        self.object_paths = object_paths
+        self.object_indexes = {}
+
+
+class parse_url_args_test(unittest.TestCase):
+    def test_plain_fields(self):
+        self.assertEqual(upload.parse_url_args("command=Pause&since=4"), {"command": "Pause", "since": "4"})
+
+    def test_empty(self):
+        self.assertEqual(upload.parse_url_args(""), {})
+        self.assertEqual(upload.parse_url_args("command="), {"command": ""})
+
+    def test_escaped_values(self):
+        args = upload.parse_url_args("object_path=part+1.zip%23part+1.slice&lift_speed=5280")
+        self.assertEqual(args["object_path"], "part 1.zip#part 1.slice")
+        self.assertEqual(args["lift_speed"], "5280")
+
+
+class zip_object_form_test(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.folder, "cube & co.zip")
+
+        image = StringIO()
+        Image.new('L', (8, 8), 255).save(image, "PNG")
+        z = zipfile.ZipFile(self.zip_path, 'w')
+        for layer in xrange(3):
+            z.writestr("cube.slice/cube{:04d}.png".format(layer), image.getvalue())
+        z.close()
+
+    def tearDown(self):
+        slicepack.close_archive(self.zip_path)
+        shutil.rmtree(self.folder)
+
+    ###########################################################################
+    ##
+    #   The object picked on the page comes back through the urlencoded
+    #   Start Print form as a name open_slices can open
+    ##
+    ###########################################################################
+    def test_zip_object_round_trip(self):
+        object_paths = slicepack.open_archive(self.zip_path).object_paths()
+        self.assertEqual(object_paths, [self.zip_path + "#cube.slice"])
+
+        view.SYNC_MODEL = stub_model(object_paths)
+        view.INDEX_TEMPLATE = Template("<select>$object_path_options</select>")
+        selected = option_values(view.index()).values[0]
+
+        body = urllib.urlencode([("command", "print_object"), ("object_path", selected)])
+        self.assertIn("%23", body)
+
+        args = upload.parse_url_args(body)
+        self.assertEqual(args["command"], "print_object")
+
+        slices = slicepack.open_slices(args["object_path"])
+        self.assertIsNotNone(slices)
+        self.assertEqual(slices.num_slices, 3)
+
+
+BOUNDARY = "----pidish7MA4YWxk"
+
+UPLOAD_CHUNK = upload.UPLOAD_CHUNK
+
+# Looks like the start of a boundary, but is not one
+PAYLOAD = "PK\x03\x04" + "\r\n--" + BOUNDARY[:-1] + "\0" * 300 + "\r\n\r\n--"
+
+
+###############################################################################
+##
+#   Builds a multipart/form-data body as a browser sends it
+#
+#   @param  fields  list of (name, filename or None, value)
+##
+###############################################################################
+def multipart_body(fields):
+    parts = []
+    for name, filename, value in fields:
+        disposition = 'form-data; name="{:s}"'.format(name)
+        if filename:
+            disposition += '; filename="{:s}"'.format(filename)
+            headers = "Content-Disposition: " + disposition + "\r\nContent-Type: application/zip"
+        else:
+            headers = "Content-Disposition: " + disposition
+        parts.append("--" + BOUNDARY + "\r\n" + headers + "\r\n\r\n" + value + "\r\n")
+    return "".join(parts) + "--" + BOUNDARY + "--\r\n"
+
+
+class upload_test(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+
+    def tearDown(self):
+        upload.UPLOAD_CHUNK = UPLOAD_CHUNK
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+
+class parse_multipart_test(upload_test):
+    def parse(self, body, progress=None):
+        return upload.parse_multipart(StringIO(body), {"boundary": BOUNDARY}, len(body), progress)
+
+    def check_fields(self, fields):
+        self.assertEqual(fields["command"], ["upload"])
+        self.assertEqual(fields["datafile"], ["datafile.upload"])
+        with open("datafile.upload", "rb") as f:
+            self.assertEqual(f.read(), PAYLOAD)
+
+    ###########################################################################
+    ##
+    #   Every delimiter and header ends up split across chunks at some size
+    ##
+    ###########################################################################
+    def test_delimiters_split_across_chunks(self):
+        body = multipart_body([("command", None, "upload"), ("datafile", "cube.zip", PAYLOAD)])
+
+        for chunk in xrange(1, 2 * len(BOUNDARY) + 8):
+            upload.UPLOAD_CHUNK = chunk
+            self.check_fields(self.parse(body))
+
+    def test_file_around_the_chunk_size(self):
+        # The closing delimiter lands on each side of the first chunk boundary
+        header_size = len(multipart_body([("datafile", "cube.zip", "")])) - len("\r\n--" + BOUNDARY + "--\r\n")
+        for size in xrange(UPLOAD_CHUNK - header_size - 50, UPLOAD_CHUNK - header_size + 10):
+            data = PAYLOAD + "x" * (size - len(PAYLOAD))
+            fields = self.parse(multipart_body([("datafile", "cube.zip", data)]))
+            self.assertEqual(os.path.getsize(fields["datafile"][0]), size)
+
+    def test_progress(self):
+        body = multipart_body([("command", None, "upload"), ("datafile", "cube.zip", PAYLOAD * 500)])
+        reports = []
+        self.parse(body, lambda done, total: reports.append((done, total)))
+
+        self.assertEqual(reports[-1], (len(body), len(body)))
+        self.assertEqual(len(reports), (len(body) + UPLOAD_CHUNK - 1) // UPLOAD_CHUNK)
+
+    def test_truncated_body(self):
+        body = multipart_body([("datafile", "cube.zip", PAYLOAD)])
+        self.assertRaises(upload.UploadError, upload.parse_multipart,
+                          StringIO(body[:-30]), {"boundary": BOUNDARY}, len(body))
+
+    def test_large_field(self):
+        body = multipart_body([("command", None, "x" * (upload.MAX_FIELD_SIZE + 1))])
+        self.assertRaises(upload.UploadError, self.parse, body)
+
+
+class receive_range_test(upload_test):
+    def send(self, data, first, total):
+        content_range = "bytes {:d}-{:d}/{:d}".format(first, first + len(data) - 1, total)
+        return upload.receive_range(StringIO(data), "cube.zip", content_range, len(data))
+
+    def test_resume(self):
+        self.assertEqual(upload.received_bytes("cube.zip"), 0)
+        self.assertEqual(self.send(PAYLOAD[:100], 0, len(PAYLOAD)), (100, len(PAYLOAD)))
+        self.assertEqual(upload.received_bytes("cube.zip"), 100)
+
+        self.assertEqual(self.send(PAYLOAD[100:], 100, len(PAYLOAD)), (len(PAYLOAD), len(PAYLOAD)))
+        with open(upload.partial_path("cube.zip"), "rb") as f:
+            self.assertEqual(f.read(), PAYLOAD)
+
+    def test_piece_must_start_at_the_end(self):
+        self.send(PAYLOAD[:100], 0, len(PAYLOAD))
+
+        self.assertRaises(upload.UploadError, self.send, PAYLOAD[50:], 50, len(PAYLOAD))
+        self.assertEqual(upload.received_bytes("cube.zip"), 100)
+
+    def test_bad_range(self):
+        self.assertRaises(upload.UploadError, upload.receive_range,
+                          StringIO("abc"), "cube.zip", "bytes 0-5/10", 3)
+        self.assertRaises(upload.UploadError, upload.receive_range,
+                          StringIO("abc"), "cube.zip", None, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()